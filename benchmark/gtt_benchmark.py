@@ -0,0 +1,281 @@
+import argparse
+import copy
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from datetime import timezone
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "mtk_common" / "src"))
+sys.path.insert(0, str(ROOT / "green_transport_twin"))
+
+import green_transport_twin as gtt
+import mtk_common.utils as mtk_utils
+from mtk_common.model import (ngsi_template_trafficflow_observed,
+                              ngsi_template_vehicle, traffic_sensor_locations)
+from mtk_common.utils import translate_transport_mode
+
+from mock_servers import MockBroker, MockOverpass
+from poll_state import PollState
+
+
+def generate_observations(n: int, vehicle_share: float, intensity: int, seed: int):
+    """
+    generate n observations at the traffic sensors in traffic_sensor_locations:
+    vehicle_share of them as Vehicle entities and the rest as
+    TrafficFlowObserved entities with the given intensity. Returns the Vehicle
+    entities and the normal and temporal representation of the
+    TrafficFlowObserved entities.
+    """
+
+    rnd = random.Random(seed)
+    observedAt = datetime.datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    weights = [sensor["traffic"] for sensor in traffic_sensor_locations]
+
+    def pick():
+        sensor = rnd.choices(traffic_sensor_locations, weights=weights)[0]
+        modes = sensor["transport_modes"]
+        mode = rnd.choices(list(modes), weights=list(modes.values()))[0]
+        return sensor, translate_transport_mode(mode)
+
+    vehicles = []
+    n_vehicles = int(n * vehicle_share)
+    for i in range(n_vehicles):
+        sensor, mode = pick()
+        payload = copy.deepcopy(ngsi_template_vehicle)
+        payload["id"] = "urn:ngsi-ld:Vehicle:benchmark%s" % i
+        payload["description"]["value"] = sensor["id"]
+        payload["vehicleType"]["value"] = mode
+        payload["location"]["value"]["coordinates"] = sensor["loc"]
+        payload["location"]["observedAt"] = observedAt
+        payload["speed"]["observedAt"] = observedAt
+        payload["heading"]["observedAt"] = observedAt
+        vehicles.append(payload)
+
+    tf_normal = []
+    tf_temporal = []
+    for i in range(int(math.ceil((n - n_vehicles) / intensity))):
+        sensor, mode = pick()
+        payload = copy.deepcopy(ngsi_template_trafficflow_observed)
+        payload["id"] = "urn:ngsi-ld:TrafficFlowObserved:benchmark%s" % i
+        payload["description"]["value"] = sensor["id"]
+        payload["vehicleType"]["value"] = mode
+        payload["vehicleType"]["observedAt"] = observedAt
+        payload["intensity"]["value"] = min(intensity, n - n_vehicles - i * intensity)
+        payload["intensity"]["observedAt"] = observedAt
+        payload["location"]["value"]["coordinates"] = sensor["loc"]
+        payload["location"]["observedAt"] = observedAt
+        tf_normal.append(payload)
+        tf_temporal.append(
+            {
+                "id": payload["id"],
+                "type": payload["type"],
+                "intensity": [payload["intensity"]],
+                "location": [payload["location"]],
+                "vehicleType": [payload["vehicleType"]],
+            }
+        )
+    return vehicles, tf_normal, tf_temporal
+
+
+class StageTimer(object):
+    """
+    Collects wall-clock durations per stage from wrapped functions.
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, duration: float) -> None:
+        with self.lock:
+            self.samples.setdefault(stage, []).append(duration)
+
+    def wrap(self, stage: str, func):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - t0)
+
+        return timed
+
+    def summary(self) -> dict:
+        return {
+            stage: {
+                "calls": len(durations),
+                "total_s": float(np.sum(durations)),
+                "p50_ms": float(np.percentile(durations, 50) * 1000),
+                "p99_ms": float(np.percentile(durations, 99) * 1000),
+            }
+            for stage, durations in self.samples.items()
+        }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def run_scenario(
+    n: int, broker: MockBroker, overpass: MockOverpass, timer: StageTimer, args
+) -> dict:
+    vehicles, tf_normal, tf_temporal = generate_observations(
+        n, args.vehicle_share, args.intensity, args.seed
+    )
+    broker.entities = {"Vehicle": vehicles, "TrafficFlowObserved": tf_normal}
+    broker.temporal = {"TrafficFlowObserved": tf_temporal}
+    broker.upserted = 0
+    overpass.queries = 0
+
+    logger = logging.getLogger("gtt_benchmark")
+    twin = gtt.GreenTransportTwin(
+        broker_url=broker.url,
+        poll_intervall=600,
+        simulate_mode=False,
+        logger=logger,
+        workers=args.workers,
+        seed=args.seed,
+        overpass_urls=[overpass.url],
+    )
+    timer.samples = {}
+    twin.get_trafficflow_entities = timer.wrap(
+        "get_trafficflow_entities", twin.get_trafficflow_entities
+    )
+    twin.get_entity_data = timer.wrap("get_entity_data", twin.get_entity_data)
+    twin.estimate_emission = timer.wrap("estimate_emission", twin.estimate_emission)
+    twin.get_simulated_point = timer.wrap(
+        "get_simulated_point", twin.get_simulated_point
+    )
+
+    for _ in range(args.repeat):
+        # forget processed observations so every cycle does the full work
+        twin.state = PollState("", logger)
+        t0 = time.perf_counter()
+        twin.poll()
+        timer.record("poll_cycle", time.perf_counter() - t0)
+
+    stages = timer.summary()
+    return {
+        "observations": n,
+        "upserted_per_cycle": broker.upserted / args.repeat,
+        "overpass_queries": overpass.queries,
+        "throughput_per_s": n / float(np.median(timer.samples["poll_cycle"])),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+    }
+
+
+def print_result(result: dict) -> None:
+    print(
+        "\n%s observations: %.0f observations/s, %s upserted per cycle, "
+        "%s Overpass queries, peak RSS %.1f MB"
+        % (
+            result["observations"],
+            result["throughput_per_s"],
+            result["upserted_per_cycle"],
+            result["overpass_queries"],
+            result["peak_rss_mb"],
+        )
+    )
+    print("%-26s %8s %10s %10s %10s" % ("stage", "calls", "total s", "p50 ms", "p99 ms"))
+    for stage, s in result["stages"].items():
+        print(
+            "%-26s %8s %10.3f %10.3f %10.3f"
+            % (stage, s["calls"], s["total_s"], s["p50_ms"], s["p99_ms"])
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Green Transport Twin poll cycle against a mock broker and a mock Overpass server"
+    )
+    parser.add_argument(
+        "--observations",
+        dest="observations",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Number of observations per scenario",
+    )
+    parser.add_argument(
+        "--vehicle_share",
+        dest="vehicle_share",
+        type=float,
+        default=0.5,
+        help="Share of observations generated as Vehicle entities",
+    )
+    parser.add_argument(
+        "--intensity",
+        dest="intensity",
+        type=int,
+        default=50,
+        help="Intensity of generated TrafficFlowObserved entities",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=8,
+        help="Number of concurrent workers for emission estimation",
+    )
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        type=int,
+        default=3,
+        help="Poll cycles per scenario; the first one runs with a cold road network cache",
+    )
+    parser.add_argument(
+        "--broker_latency",
+        dest="broker_latency",
+        type=float,
+        default=0.0,
+        help="Latency added to every mock broker request in seconds",
+    )
+    parser.add_argument(
+        "--overpass_latency",
+        dest="overpass_latency",
+        type=float,
+        default=0.0,
+        help="Latency added to every mock Overpass request in seconds",
+    )
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed")
+    parser.add_argument(
+        "--json",
+        dest="json",
+        type=str,
+        default="",
+        help="Write results as JSON to this file",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # GreenTransportTwin reads ./overpass_template
+    os.chdir(ROOT / "green_transport_twin")
+    mtk_utils.configure_broker_client(pool_size=args.workers + 1)
+    timer = StageTimer()
+    mtk_utils.post_chunk = timer.wrap("post_chunk", mtk_utils.post_chunk)
+
+    broker = MockBroker(latency=args.broker_latency)
+    overpass = MockOverpass(latency=args.overpass_latency, seed=args.seed)
+    results = []
+    for n in sorted(args.observations):
+        result = run_scenario(n, broker, overpass, timer, args)
+        print_result(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
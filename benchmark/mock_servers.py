@@ -0,0 +1,151 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status_code: int, body=None) -> None:
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockBrokerHandler(MockHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        entity_type = params.get("type", [""])[0]
+        offset = int(params.get("offset", [0])[0])
+        limit = int(params.get("limit", [1000])[0])
+        if url.path.startswith("/ngsi-ld/v1/temporal/entities"):
+            entities = self.server.temporal.get(entity_type, [])
+        elif url.path.startswith("/ngsi-ld/v1/entities"):
+            entities = self.server.entities.get(entity_type, [])
+        else:
+            self.send_json(404, {})
+            return
+        self.send_json(200, entities[offset : offset + limit])
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        body = self.read_body()
+        if self.path.startswith("/ngsi-ld/v1/entityOperations/upsert"):
+            with self.server.lock:
+                self.server.upserted = self.server.upserted + len(json.loads(body))
+            self.send_json(204)
+        else:
+            self.send_json(201)
+
+
+class MockBroker(ThreadingHTTPServer):
+    """
+    Minimal NGSI-LD broker serving a fixed set of entities for normal and
+    temporal queries (type, limit and offset are honoured, q and time
+    filters are ignored) and counting upserted entities.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0):
+        super().__init__(("127.0.0.1", port), MockBrokerHandler)
+        self.latency = latency
+        self.entities = {}
+        self.temporal = {}
+        self.upserted = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%s" % self.server_port
+
+
+class MockOverpassHandler(MockHandler):
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        query = self.read_body().decode("utf-8")
+        match = re.search(r"around:(\d+),([-\d.]+),([-\d.]+)", query)
+        radius, lat, lon = int(match[1]), float(match[2]), float(match[3])
+        with self.server.lock:
+            self.server.queries = self.server.queries + 1
+        self.send_json(200, self.server.road_network(lon, lat, radius))
+
+
+class MockOverpass(ThreadingHTTPServer):
+    """
+    Overpass stand-in that answers every "around" query with a synthetic road
+    network of ways_per_query ways of random highway types.
+    """
+
+    daemon_threads = True
+    highways = [
+        "motorway",
+        "trunk",
+        "primary",
+        "secondary",
+        "tertiary",
+        "residential",
+        "living_street",
+        "cycleway",
+        "footway",
+        "busway",
+    ]
+
+    def __init__(
+        self, port: int = 0, latency: float = 0, ways_per_query: int = 200, seed=0
+    ):
+        super().__init__(("127.0.0.1", port), MockOverpassHandler)
+        self.latency = latency
+        self.ways_per_query = ways_per_query
+        self.seed = seed
+        self.queries = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%s/api/interpreter" % self.server_port
+
+    def road_network(self, lon: float, lat: float, radius: int) -> dict:
+        rnd = random.Random("%s:%s:%s" % (self.seed, lon, lat))
+        spread = radius / 111320
+        elements = []
+        node_id = 0
+        for way_id in range(self.ways_per_query):
+            nodes = []
+            for _ in range(rnd.randint(2, 10)):
+                node_id = node_id + 1
+                nodes.append(node_id)
+                elements.append(
+                    {
+                        "type": "node",
+                        "id": node_id,
+                        "lon": lon + rnd.uniform(-spread, spread),
+                        "lat": lat + rnd.uniform(-spread, spread),
+                    }
+                )
+            elements.append(
+                {
+                    "type": "way",
+                    "id": way_id,
+                    "nodes": nodes,
+                    "tags": {"highway": rnd.choice(self.highways)},
+                }
+            )
+        return {"elements": elements}
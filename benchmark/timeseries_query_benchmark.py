@@ -0,0 +1,244 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+EMISSION_ROOT = ROOT / "emission_adapter"
+sys.path.insert(0, str(EMISSION_ROOT))
+
+# the emission code reads its configuration relative to the working directory
+CWD = os.getcwd()
+os.chdir(EMISSION_ROOT)
+
+import emission.core.get_database as edb
+import emission.storage.timeseries.abstract_timeseries as esta
+import emission.storage.timeseries.timequery as estt
+
+DAY = 24 * 60 * 60
+
+
+def location(user_id, key, ts, lon, lat):
+    return {
+        "user_id": user_id,
+        "metadata": {"key": key, "write_ts": ts + 1, "type": "sensor-data"},
+        "data": {
+            "ts": ts,
+            "loc": {"type": "Point", "coordinates": [lon, lat]},
+            "longitude": lon,
+            "latitude": lat,
+            "accuracy": 10,
+            "altitude": 0,
+            "heading": 0,
+            "speed": 0,
+            "sensed_speed": 0,
+            "distance": 0,
+        },
+    }
+
+
+def trip_like(user_id, key, start_ts, end_ts, start_loc, end_loc, extra=None):
+    data = {
+        "start_ts": start_ts,
+        "end_ts": end_ts,
+        "start_loc": {"type": "Point", "coordinates": start_loc},
+        "end_loc": {"type": "Point", "coordinates": end_loc},
+        "duration": end_ts - start_ts,
+        "distance": 1000,
+    }
+    data.update(extra or {})
+    return {
+        "user_id": user_id,
+        "metadata": {"key": key, "write_ts": end_ts + 1, "type": "analysis-result"},
+        "data": data,
+    }
+
+
+def generate_history(user_id, start_ts, days, trips_per_day, points_per_trip, rnd):
+    """
+    generate days of history for a user: trips_per_day trips per day, each with
+    points_per_trip raw, filtered and recreated locations and a cleaned and
+    inferred section, and a place between consecutive trips. Returns the
+    entries for the timeseries and the analysis timeseries.
+    """
+    raw = []
+    analysis = []
+    lon, lat = -122.08, 37.39
+    for day in range(days):
+        for trip in range(trips_per_day):
+            trip_start = start_ts + day * DAY + (trip + 1) * DAY / (trips_per_day + 1)
+            start_loc = [lon, lat]
+            for i in range(points_per_trip):
+                ts = trip_start + i * 30
+                lon = lon + rnd.gauss(0, 0.0005)
+                lat = lat + rnd.gauss(0, 0.0005)
+                raw.append(location(user_id, "background/location", ts, lon, lat))
+                raw.append(location(user_id, "background/filtered_location", ts, lon, lat))
+                analysis.append(location(user_id, "analysis/recreated_location", ts, lon, lat))
+            trip_end = trip_start + (points_per_trip - 1) * 30
+            for key in ["analysis/cleaned_trip", "analysis/cleaned_section", "analysis/inferred_section"]:
+                analysis.append(
+                    trip_like(user_id, key, trip_start, trip_end, start_loc, [lon, lat],
+                              {"sensed_mode": rnd.randint(0, 5)})
+                )
+            analysis.append(
+                {
+                    "user_id": user_id,
+                    "metadata": {"key": "analysis/cleaned_place", "write_ts": trip_end + 1,
+                                 "type": "analysis-result"},
+                    "data": {"enter_ts": trip_end, "exit_ts": trip_end + 600,
+                             "location": {"type": "Point", "coordinates": [lon, lat]}},
+                }
+            )
+    return raw, analysis
+
+
+def get_queries(ts, start_ts, days, rnd):
+    """
+    the queries that the pipeline and the adapter issue, against random
+    days/weeks of the history
+    """
+
+    def day_range(time_key, n_days=1):
+        day = rnd.randrange(0, max(days - n_days, 1))
+        return estt.TimeQuery(time_key, start_ts + day * DAY, start_ts + (day + n_days) * DAY)
+
+    return {
+        "filtered_location_day": lambda: list(ts.find_entries(
+            ["background/filtered_location"], day_range("data.ts"))),
+        "raw_locations_write_ts": lambda: list(ts.find_entries(
+            ["background/location", "background/filtered_location"], day_range("metadata.write_ts"))),
+        "recreated_location_day": lambda: list(ts.find_entries(
+            ["analysis/recreated_location"], day_range("data.ts"))),
+        "recreated_location_projected": lambda: list(ts.find_entries(
+            ["analysis/recreated_location"], day_range("data.ts"),
+            projection=["data.ts", "data.loc"])),
+        "inferred_section_df_week": lambda: ts.get_data_df(
+            "analysis/inferred_section", day_range("data.start_ts", 7)),
+        "cleaned_place_week": lambda: list(ts.find_entries(
+            ["analysis/cleaned_place"], day_range("data.enter_ts", 7))),
+    }
+
+
+def winning_stages(tsdb, query, sort_key):
+    plan = tsdb.find(query).sort(sort_key, 1).explain()["queryPlanner"]["winningPlan"]
+    # with the slot based engine (MongoDB 7+), the stages are under queryPlan
+    plan = plan.get("queryPlan", plan)
+    stages = []
+    while plan is not None:
+        stages.append(plan["stage"] + ("(%s)" % plan["indexName"] if "indexName" in plan else ""))
+        plan = plan.get("inputStage", plan.get("inputStages", [None])[0])
+    return " <- ".join(stages)
+
+
+def drop_query_indices():
+    for tsdb in [edb.get_timeseries_db(), edb.get_analysis_timeseries_db()]:
+        for name, info in tsdb.index_information().items():
+            fields = [field for field, _ in info["key"]]
+            if fields[:2] == ["user_id", "metadata.key"] and len(fields) == 3:
+                tsdb.drop_index(name)
+
+
+def create_query_indices():
+    edb._create_query_indices(edb.get_timeseries_db(), edb.TIMESERIES_QUERY_TIME_KEYS)
+    edb._create_query_indices(edb.get_analysis_timeseries_db(),
+                              edb.ANALYSIS_TIMESERIES_QUERY_TIME_KEYS)
+
+
+def run_queries(ts, start_ts, args) -> dict:
+    rnd = random.Random(args.seed)
+    queries = get_queries(ts, start_ts, args.days, rnd)
+    samples = {name: [] for name in queries}
+    for _ in range(args.repeat):
+        for name, query in queries.items():
+            t0 = time.perf_counter()
+            query()
+            samples[name].append(time.perf_counter() - t0)
+    tq = estt.TimeQuery("data.ts", start_ts, start_ts + DAY)
+    plan = winning_stages(ts.analysis_timeseries_db,
+                          ts._get_query(["analysis/recreated_location"], tq), "data.ts")
+    return {
+        "plan_recreated_location_day": plan,
+        "queries": {
+            name: {
+                "p50_ms": float(np.percentile(durations, 50) * 1000),
+                "p99_ms": float(np.percentile(durations, 99) * 1000),
+            }
+            for name, durations in samples.items()
+        },
+    }
+
+
+def print_result(label: str, result: dict) -> None:
+    print("\n%s: %s" % (label, result["plan_recreated_location_day"]))
+    print("%-32s %10s %10s" % ("query", "p50 ms", "p99 ms"))
+    for name, q in result["queries"].items():
+        print("%-32s %10.2f %10.2f" % (name, q["p50_ms"], q["p99_ms"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark BuiltinTimeSeries queries against a synthetic per-user history in MongoDB"
+    )
+    parser.add_argument("--dburl", dest="dburl", type=str, default="localhost",
+                        help="MongoDB URL; the history is written to (and removed from) its Stage_database")
+    parser.add_argument("--days", dest="days", type=int, default=365,
+                        help="Days of history for the benchmarked user")
+    parser.add_argument("--trips_per_day", dest="trips_per_day", type=int, default=4,
+                        help="Trips per day")
+    parser.add_argument("--points_per_trip", dest="points_per_trip", type=int, default=60,
+                        help="Locations per trip, one every 30 seconds")
+    parser.add_argument("--other_users", dest="other_users", type=int, default=5,
+                        help="Other users with the same history, so that the collections are not single-user")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=50,
+                        help="Runs of every query")
+    parser.add_argument("--compare", dest="compare", action="store_true",
+                        help="Also run the queries without the compound (user_id, metadata.key, time) indices")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed")
+    parser.add_argument("--json", dest="json", type=str, default="",
+                        help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # the entries are inserted through the same client as the rest of the
+    # code, so the user ids are stored with the same UUID representation
+    esta.TimeSeries._reset_url(args.dburl)
+
+    rnd = random.Random(args.seed)
+    start_ts = time.time() - args.days * DAY
+    user_ids = [uuid.uuid4() for _ in range(args.other_users + 1)]
+    t0 = time.perf_counter()
+    for user_id in user_ids:
+        raw, analysis = generate_history(user_id, start_ts, args.days, args.trips_per_day,
+                                         args.points_per_trip, rnd)
+        edb.get_timeseries_db().insert_many(raw, ordered=False)
+        edb.get_analysis_timeseries_db().insert_many(analysis, ordered=False)
+    print("Inserted %s entries per user for %s users in %.1f s"
+          % (len(raw) + len(analysis), len(user_ids), time.perf_counter() - t0))
+
+    ts = esta.TimeSeries.get_time_series(user_ids[0])
+    # the queries look the user up by UUID, make sure that they find its entries
+    n_found = len(list(ts.find_entries(["analysis/cleaned_trip"])))
+    assert n_found == args.days * args.trips_per_day, n_found
+    results = {}
+    try:
+        if args.compare:
+            drop_query_indices()
+            results["single_field_indices"] = run_queries(ts, start_ts, args)
+            print_result("single_field_indices", results["single_field_indices"])
+            create_query_indices()
+        results["compound_indices"] = run_queries(ts, start_ts, args)
+        print_result("compound_indices", results["compound_indices"])
+    finally:
+        for tsdb in [edb.get_timeseries_db(), edb.get_analysis_timeseries_db()]:
+            tsdb.delete_many({"user_id": {"$in": user_ids}})
+    if args.json:
+        with open(os.path.join(CWD, args.json), "w") as f:
+            json.dump(results, f, indent=2)
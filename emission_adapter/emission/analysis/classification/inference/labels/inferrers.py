@@ -141,6 +141,14 @@ def n_to_confidence_coeff(n, max_confidence=None, first_confidence=None, confide
 # predict_two_stage_bin_cluster but with the above reduction in confidence
 def predict_cluster_confidence_discounting(trip, max_confidence=None, first_confidence=None, confidence_multiplier=None):
     labels, n = lp.predict_labels_with_n(trip)
+    return discount_confidence(labels, n, max_confidence, first_confidence, confidence_multiplier)
+
+# predict_cluster_confidence_discounting for a list of trips, with the models of each user loaded once
+def predict_cluster_confidence_discounting_batch(trips, max_confidence=None, first_confidence=None, confidence_multiplier=None):
+    return [discount_confidence(labels, n, max_confidence, first_confidence, confidence_multiplier)
+        for (labels, n) in lp.predict_labels_with_n_batch(trips)]
+
+def discount_confidence(labels, n, max_confidence=None, first_confidence=None, confidence_multiplier=None):
     if n <= 0:  # No model data or trip didn't match a cluster
         logging.debug(f"In predict_cluster_confidence_discounting: n={n}; returning as-is")
         return labels
@@ -20,6 +20,13 @@ primary_algorithms = {
     ecwl.AlgorithmTypes.CONFIDENCE_DISCOUNTED_CLUSTER: eacili.predict_cluster_confidence_discounting
 }
 
+# Optional versions of the primary algorithms that take the list of all the trips to predict
+# and return the list of their predictions, e.g. so that a model is only loaded once per run.
+# The algorithms that are not listed here are run on one trip at a time.
+primary_batch_algorithms = {
+    ecwl.AlgorithmTypes.CONFIDENCE_DISCOUNTED_CLUSTER: eacili.predict_cluster_confidence_discounting_batch
+}
+
 # ensemble specifies which algorithm in eacile to run.
 # This makes it easy to test various ways of combining various algorithms.
 ensemble = eacile.ensemble_first_prediction
@@ -55,37 +62,63 @@ class LabelInferencePipeline:
         self.ts = esta.TimeSeries.get_time_series(user_id)
         self.toPredictTrips = esda.get_entries(
             esda.CLEANED_TRIP_KEY, user_id, time_query=time_range)
+        # Create the inferred trips
+        inferred_trips = []
         for cleaned_trip in self.toPredictTrips:
-            # Create an inferred trip
             cleaned_trip_dict = copy.copy(cleaned_trip)["data"]
-            inferred_trip = ecwe.Entry.create_entry(user_id, "analysis/inferred_trip", cleaned_trip_dict)
-            
+            inferred_trips.append(ecwe.Entry.create_entry(user_id, "analysis/inferred_trip", cleaned_trip_dict))
+        batch_predictions = self.compute_batch_algorithms(inferred_trips)
+
+        # The predictions and inferred trips are buffered and written together at the end,
+        # and progress is only recorded once they have been written
+        last_trip_done = None
+        for i, (cleaned_trip, inferred_trip) in enumerate(zip(self.toPredictTrips, inferred_trips)):
             # Run the algorithms and the ensemble, store results
-            results = self.compute_and_save_algorithms(inferred_trip)
+            precomputed = {algorithm_id: predictions[i]
+                for algorithm_id, predictions in batch_predictions.items()}
+            results = self.compute_and_save_algorithms(inferred_trip, precomputed)
             ensemble = self.compute_and_save_ensemble(inferred_trip, results)
 
             # Put final results into the inferred trip and store it
             inferred_trip["data"]["cleaned_trip"] = cleaned_trip.get_id()
             inferred_trip["data"]["inferred_labels"] = ensemble["prediction"]
-            self.ts.insert(inferred_trip)
+            self.ts.insert_buffered(inferred_trip)
+
+            if last_trip_done is None or last_trip_done["data"]["end_ts"] < cleaned_trip["data"]["end_ts"]:
+                last_trip_done = cleaned_trip
+        self.ts.flush()
+        self._last_trip_done = last_trip_done
 
-            if self._last_trip_done is None or self._last_trip_done["data"]["end_ts"] < cleaned_trip["data"]["end_ts"]:
-                self._last_trip_done = cleaned_trip
+    # Runs the primary algorithms that have a batch version on all the trips at once.
+    # Returns a dict of algorithm id -> list of predictions, in the order of the trips.
+    def compute_batch_algorithms(self, trips):
+        batch_predictions = {}
+        if len(trips) == 0:
+            return batch_predictions
+        for algorithm_id, batch_fn in primary_batch_algorithms.items():
+            if algorithm_id in primary_algorithms:
+                batch_predictions[algorithm_id] = batch_fn(trips)
+        return batch_predictions
     
     # This is where the labels for a given trip are actually predicted.
     # Though the only information passed in is the trip object, the trip object can provide the
     # user_id and other potentially useful information.
-    def compute_and_save_algorithms(self, trip):
+    # precomputed optionally maps algorithm ids to the prediction for this trip that was already
+    # computed by compute_batch_algorithms; the other algorithms are run here.
+    def compute_and_save_algorithms(self, trip, precomputed=None):
         predictions = []
         for algorithm_id, algorithm_fn in primary_algorithms.items():
-            prediction = algorithm_fn(trip)
+            if precomputed is not None and algorithm_id in precomputed:
+                prediction = precomputed[algorithm_id]
+            else:
+                prediction = algorithm_fn(trip)
             lp = ecwl.Labelprediction()
             lp.trip_id = trip.get_id()
             lp.algorithm_id = algorithm_id
             lp.prediction = prediction
             lp.start_ts = trip["data"]["start_ts"]
             lp.end_ts = trip["data"]["end_ts"]
-            self.ts.insert_data(self.user_id, "inference/labels", lp)
+            self.ts.insert_data_buffered(self.user_id, "inference/labels", lp)
             predictions.append(lp)
         return predictions
 
@@ -98,5 +131,5 @@ class LabelInferencePipeline:
         il.start_ts = trip["data"]["start_ts"]
         il.end_ts = trip["data"]["end_ts"]
         (il.algorithm_id, il.prediction) = ensemble(trip, predictions)
-        self.ts.insert_data(self.user_id, "analysis/inferred_labels", il)
+        self.ts.insert_data_buffered(self.user_id, "analysis/inferred_labels", il)
         return il
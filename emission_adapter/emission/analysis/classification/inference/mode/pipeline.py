@@ -8,12 +8,14 @@ import scipy as sp
 import time
 import json
 import copy
+import threading
 
 # Get the configuration for the classifier
 import emission.analysis.config as eac
 
 # Our imports
 import emission.storage.timeseries.abstract_timeseries as esta
+import emission.storage.timeseries.timequery as estt
 import emission.storage.decorations.analysis_timeseries_queries as esda
 import emission.storage.decorations.trip_queries as esdt
 import emission.storage.pipeline_queries as epq
@@ -33,6 +35,47 @@ from uuid import UUID
 # problem, so we don't need to solve it right now.
 minTrainingSetSize = 1000
 
+# The recreated locations for feature generation are read for this many
+# consecutive sections at a time, so that a large backlog is neither read
+# into memory at once nor cut off by edb.result_limit
+SECTION_LOCATIONS_BATCH_SIZE = 100
+
+MODE_MAPPING_FILENAME = "emission/analysis/classification/inference/mode/mode_id_old2new.txt"
+
+# The seed model and the mode mapping are the same for all users, so we load
+# them once per process instead of once per user. The model is reloaded if
+# the saved model file changes.
+_seed_model = None
+_seed_model_version = None
+_seed_modes_mapping = None
+_seed_lock = threading.Lock()
+
+def get_seed_model():
+    # TODO: Consider removing this import by moving the model save/load code to
+    # its own module so that we can eventually remove the old pipeline code
+    import emission.analysis.classification.inference.mode.seed.pipeline as seedp
+
+    global _seed_model, _seed_model_version
+    with _seed_lock:
+        version = seedp.ModeInferencePipelineMovesFormat.getSavedModelVersion()
+        if _seed_model is None or _seed_model_version != version:
+            if eac.get_config().get("classification.inference.mode.useBinaryModelCache", False):
+                _seed_model = seedp.ModeInferencePipelineMovesFormat.loadModelFromCache()
+            else:
+                _seed_model = seedp.ModeInferencePipelineMovesFormat.loadModel()
+            _seed_model_version = version
+            logging.info("Loaded seed model with version %s" % version)
+        return _seed_model
+
+def get_seed_modes_mapping():
+    global _seed_modes_mapping
+    with _seed_lock:
+        if _seed_modes_mapping is None:
+            with open(MODE_MAPPING_FILENAME) as fp:
+                _seed_modes_mapping = json.load(fp)
+            logging.debug("Loaded modes %s" % _seed_modes_mapping)
+        return _seed_modes_mapping
+
 def predict_mode(user_id):
     time_query = epq.get_time_range_for_mode_inference(user_id)
     try:
@@ -110,9 +153,7 @@ class ModeInferencePipeline:
                           "start hour", "end hour", "close to bus stop", "close to train stop",
                           "close to airport"]
     self.last_section_done = None
-    with open("emission/analysis/classification/inference/mode/mode_id_old2new.txt") as fp:
-        self.seed_modes_mapping = json.load(fp)
-    logging.debug("Loaded modes %s" % self.seed_modes_mapping)
+    self.seed_modes_mapping = get_seed_modes_mapping()
 
   def getLastSectionDone(self):
     return self.last_section_done
@@ -150,10 +191,7 @@ class ModeInferencePipeline:
     logging.info("savePredictionsStep DONE")
 
   def loadModelStage(self):
-    # TODO: Consider removing this import by moving the model save/load code to
-    # its own module so that we can eventually remove the old pipeline code
-    import emission.analysis.classification.inference.mode.seed.pipeline as seedp
-    self.model = seedp.ModeInferencePipelineMovesFormat.loadModel()
+    self.model = get_seed_model()
 
 # Features are:
 # 0. distance
@@ -178,7 +216,7 @@ class ModeInferencePipeline:
 # 19. both start and end close to bus stop
 # 20. both start and end close to train station
 # 21. both start and end close to airport
-  def updateFeatureMatrixRowWithSection(self, featureMatrix, i, section_entry):
+  def updateFeatureMatrixRowWithSection(self, featureMatrix, i, section_entry, locations=None):
     section = section_entry.data
     featureMatrix[i, 0] = section.distance
     featureMatrix[i, 1] = section.duration
@@ -206,7 +244,7 @@ class ModeInferencePipeline:
         pass
 
     featureMatrix[i, 9] = False
-    featureMatrix[i, 10] = easf.calHCR(section_entry)
+    featureMatrix[i, 10] = easf.calHCR(section_entry, locations)
     featureMatrix[i, 11] = easf.calSR(section_entry)
     featureMatrix[i, 12] = easf.calVCR(section_entry)
     if 'start_loc' in section and section['end_loc'] != None:
@@ -262,15 +300,59 @@ class ModeInferencePipeline:
     featureMatrix = np.zeros([numsections, len(self.featureLabels)])
     sectionIds = []
     tripIds = []
+    sectionLocations = self.loadSectionLocationsStep(toPredictSections)
     for (i, section) in enumerate(toPredictSections):
       if i % 50 == 0:
         logging.debug("Processing test record %s " % i)
-      self.updateFeatureMatrixRowWithSection(featureMatrix, i, section)
+      self.updateFeatureMatrixRowWithSection(featureMatrix, i, section, sectionLocations[i])
       sectionIds.append(section['_id'])
       tripIds.append(section.data.trip_id)
 
     return (featureMatrix[:,self.selFeatureIndices], tripIds, sectionIds)
 
+  def loadSectionLocationsStep(self, toPredictSections):
+    """
+    Reads the recreated locations for the sections with one query per
+    SECTION_LOCATIONS_BATCH_SIZE consecutive sections instead of one query
+    per section, and splits them up by section. Returns a list with the
+    locations of each section, using the same (inclusive) time range that
+    easf.calHCR would query for. Only the fields that calHCR uses are read.
+    """
+    if len(toPredictSections) == 0:
+        return []
+    user_id = toPredictSections[0].user_id
+    assert all(s.user_id == user_id for s in toPredictSections), \
+        "Sections of multiple users passed to loadSectionLocationsStep"
+    ts = esta.TimeSeries.get_time_series(user_id)
+    sectionLocations = []
+    for i in range(0, len(toPredictSections), SECTION_LOCATIONS_BATCH_SIZE):
+        sectionLocations.extend(self._loadLocationsForSections(ts,
+            toPredictSections[i:i + SECTION_LOCATIONS_BATCH_SIZE]))
+    return sectionLocations
+
+  def _loadLocationsForSections(self, ts, sections):
+    tq = estt.TimeQuery("data.ts",
+                        min(s.data.start_ts for s in sections),
+                        max(s.data.end_ts for s in sections))
+    # This is sorted by data.ts since that is the time query key
+    locations = list(ts.find_entries(["analysis/recreated_location"], tq,
+                                     projection=["data.ts", "data.loc"]))
+    if len(locations) >= edb.result_limit and len(sections) > 1:
+        # the result may have been cut off, read the halves separately
+        logging.debug("Read %d locations for %d sections, splitting" %
+                      (len(locations), len(sections)))
+        mid = len(sections) // 2
+        return self._loadLocationsForSections(ts, sections[:mid]) + \
+            self._loadLocationsForSections(ts, sections[mid:])
+    locationTs = np.array([l["data"]["ts"] for l in locations])
+    logging.debug("Read %d locations for %d sections" % (len(locations), len(sections)))
+    sectionLocations = []
+    for section in sections:
+        start = np.searchsorted(locationTs, section.data.start_ts, side="left")
+        end = np.searchsorted(locationTs, section.data.end_ts, side="right")
+        sectionLocations.append(locations[start:end])
+    return sectionLocations
+
   def predictModesStep(self):
     return self.model.predict_proba(self.toPredictFeatureMatrix)
 
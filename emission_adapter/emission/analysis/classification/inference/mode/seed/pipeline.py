@@ -18,6 +18,7 @@ import time
 from datetime import datetime
 
 # Pickling imports
+import pickle
 import jsonpickle as jpickle
 import jsonpickle.ext.numpy as jsonpickle_numpy
 jsonpickle_numpy.register_handlers()
@@ -33,6 +34,10 @@ import emission.analysis.config as eac
 # problem, so we don't need to solve it right now.
 minTrainingSetSize = 1000
 SAVED_MODEL_FILENAME = 'seed_model.json'
+# Binary copy of the saved model, which loads much faster than the
+# jsonpickle representation. It is only used if it was created from the
+# current SAVED_MODEL_FILENAME with the current library versions.
+SAVED_MODEL_CACHE_FILENAME = 'seed_model.pkl'
 
 class ModeInferencePipelineMovesFormat:
   def __init__(self):
@@ -95,6 +100,49 @@ class ModeInferencePipelineMovesFormat:
     fd.close()
     return jpickle.loads(model_rep)
 
+  @staticmethod
+  def getSavedModelVersion():
+    """
+    Identifies the saved model file and the libraries that the model is
+    unpickled with, so that we can tell whether a cached copy is still valid
+    """
+    import sklearn
+
+    stat = os.stat(SAVED_MODEL_FILENAME)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+            "python": list(sys.version_info[:2]),
+            "numpy": np.__version__, "sklearn": sklearn.__version__}
+
+  @staticmethod
+  def loadModelFromCache():
+    """
+    Same as loadModel, but reads the model from SAVED_MODEL_CACHE_FILENAME if
+    that is up to date, and (re)creates the cache otherwise
+    """
+    version = ModeInferencePipelineMovesFormat.getSavedModelVersion()
+    try:
+      with open(SAVED_MODEL_CACHE_FILENAME, "rb") as fd:
+        # The version is pickled separately before the model, so that we
+        # don't try to unpickle a model created with other library versions
+        cached_version = pickle.load(fd)
+        if cached_version == version:
+          logging.debug("Loading model from cache %s" % SAVED_MODEL_CACHE_FILENAME)
+          return pickle.load(fd)
+        logging.info("Model cache version %s != %s, recreating it" % (cached_version, version))
+    except Exception as e:
+      logging.info("Unable to load model from cache %s: %s, recreating it" % (SAVED_MODEL_CACHE_FILENAME, e))
+
+    model = ModeInferencePipelineMovesFormat.loadModel()
+    try:
+      tmp_filename = SAVED_MODEL_CACHE_FILENAME + ".tmp"
+      with open(tmp_filename, "wb") as fd:
+        pickle.dump(version, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(model, fd, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_filename, SAVED_MODEL_CACHE_FILENAME)
+    except OSError as e:
+      logging.warning("Unable to save model cache %s: %s" % (SAVED_MODEL_CACHE_FILENAME, e))
+    return model
+
   # TODO: Refactor into generic steps and results
   def loadTrainingDataStep(self, sectionQuery, sectionDb = None):
     logging.debug("START TRAINING DATA STEP")
@@ -39,6 +39,7 @@ import emission.storage.timeseries.abstract_timeseries as esta
 import emission.storage.pipeline_queries as epq
 
 import emission.analysis.intake.cleaning.location_smoothing as eaicl
+import emission.analysis.intake.parallel as eaip
 
 import emission.core.wrapper.entry as ecwe
 import emission.core.wrapper.cleanedtrip as ecwct
@@ -53,6 +54,7 @@ import emission.core.wrapper.motionactivity as ecwm
 import emission.core.common as ecc
 
 import emission.net.ext_service.geocoder.nominatim as eco
+import emission.net.ext_service.geocoder.reverse_cache as eco_cache
 
 import attrdict as ad
 
@@ -111,25 +113,17 @@ def save_cleaned_segments_for_timeline(user_id, tl):
     ts = esta.TimeSeries.get_time_series(user_id)
     trip_map = {}
     id_or_none = lambda wrapper: wrapper.get_id() if wrapper is not None else None
-    for trip in tl.trips:
-        try:
-            if trip.metadata.key == esda.RAW_UNTRACKED_KEY:
-                filtered_trip = get_filtered_untracked(ts, trip)
-            else:
-                filtered_trip = get_filtered_trip(ts, trip)
-            logging.debug("For raw trip %s, found filtered trip %s" %
-                          (id_or_none(trip), id_or_none(filtered_trip)))
-            if filtered_trip is not None:
-                trip_map[trip.get_id()] = filtered_trip
-        except KeyError as e:
-            # We ran into key errors while dealing with mixed filter trip_entries.
-            # I think those should be resolved for now, so we can raise the error again
-            # But if this is preventing us from making progress, we can comment out the raise
-            logging.exception("Found key error %s while processing trip %s" % (e, trip))
-            # raise e
-        except Exception as e:
-            logging.exception("Found error %s while processing trip %s" % (e, trip))
-            raise e
+    # The trips are filtered independently, possibly in parallel, but the
+    # points, sections and stops are inserted here, in trip order
+    filtered_trip_results = eaip.imap_ordered(get_filtered_trip_like_entries,
+                                              [(trip,) for trip in tl.trips])
+    for trip, (filtered_trip, entry_list) in zip(tl.trips, filtered_trip_results):
+        logging.debug("For raw trip %s, found filtered trip %s" %
+                      (id_or_none(trip), id_or_none(filtered_trip)))
+        if filtered_trip is not None:
+            trip_map[trip.get_id()] = filtered_trip
+        if len(entry_list) > 0:
+            ts.bulk_insert(entry_list, esta.EntryType.ANALYSIS_TYPE)
 
     (last_cleaned_place, filtered_tl) = create_and_link_timeline(tl, user_id, trip_map)
 
@@ -143,6 +137,30 @@ def save_cleaned_segments_for_timeline(user_id, tl):
         ts.bulk_insert(list(filtered_tl), esta.EntryType.ANALYSIS_TYPE)
     return tl.last_place()
 
+def get_filtered_trip_like_entries(trip):
+    """
+    Filters a raw trip or untracked time. Returns the filtered trip (or None
+    if the trip was skipped) and the list of points, sections and stops that
+    need to be inserted with it. Does not write to the database, so that it
+    can run in a worker process.
+    """
+    try:
+        if trip.metadata.key == esda.RAW_UNTRACKED_KEY:
+            ts = esta.TimeSeries.get_time_series(trip.user_id)
+            return (get_filtered_untracked(ts, trip), [])
+        else:
+            return get_filtered_trip_entries(trip)
+    except KeyError as e:
+        # We ran into key errors while dealing with mixed filter trip_entries.
+        # I think those should be resolved for now, so we can raise the error again
+        # But if this is preventing us from making progress, we can comment out the raise
+        logging.exception("Found key error %s while processing trip %s" % (e, trip))
+        # raise e
+        return (None, [])
+    except Exception as e:
+        logging.exception("Found error %s while processing trip %s" % (e, trip))
+        raise e
+
 def get_filtered_untracked(ts, untracked):
     # untracked time is very simple, but we need to map them in a basic way to avoid
     # holes in the timeline
@@ -158,13 +176,23 @@ def get_filtered_untracked(ts, untracked):
     return filtered_untracked_entry
 
 def get_filtered_trip(ts, trip):
+    (filtered_trip_entry, entry_list) = get_filtered_trip_entries(trip)
+    if len(entry_list) > 0:
+        ts.bulk_insert(entry_list, esta.EntryType.ANALYSIS_TYPE)
+    return filtered_trip_entry
+
+def get_filtered_trip_entries(trip):
+    """
+    Returns the cleaned trip for this raw trip, and the list of its points,
+    sections and stops, or (None, []) if the trip is skipped.
+    """
     logging.debug("Filtering trip %s" % trip)
     trip_tl = esdtq.get_raw_timeline_for_trip(trip.user_id, trip.get_id())
     # trip_tl is the timeline for this particular trip, which contains the
     # section_entries and trip_entries
     if len(trip_tl.trips) == 0:
         logging.info("Found zero section trip %s " % trip)
-        return None
+        return (None, [])
 
     # Else, this is a non-zero section trip
     filtered_trip_data = ecwct.Cleanedtrip()
@@ -215,22 +243,22 @@ def get_filtered_trip(ts, trip):
         logging.info("Skipped single point trip %s (%s -> %s) of length %s" %
                      (trip.get_id(), trip.data.start_fmt_time,
                       trip.data.end_fmt_time, filtered_trip_data.distance))
-        return None
+        return (None, [])
 
     # But then we want to check the stop distance to determine whether the trip is valid
     # or not, and to not store any of the sections or stops if it is not. So the validity
     # check should be before the insert
 
+    entry_list = []
     for section_id, points in list(point_map.items()):
         # We should have filtered out zero point sections already
         logging.debug("About to store %s points for section %s" %
                       (len(points), section_id))
-        if len(points) > 0:
-            ts.bulk_insert(points, esta.EntryType.ANALYSIS_TYPE)
+        entry_list.extend(points)
 
     if not linked_tl.is_empty():
-        ts.bulk_insert(list(linked_tl), esta.EntryType.ANALYSIS_TYPE)
-    return filtered_trip_entry
+        entry_list.extend(linked_tl)
+    return (filtered_trip_entry, entry_list)
 
 def get_filtered_place(raw_place):
     filtered_place_data = ecwcp.Cleanedplace()
@@ -243,8 +271,8 @@ def get_filtered_place(raw_place):
     filtered_place_data.append_raw_place(raw_place.get_id())
 
     try:
-        reverse_geocoded_json = eco.Geocoder.get_json_reverse(filtered_place_data.location.coordinates[1],
-                                                              filtered_place_data.location.coordinates[0])
+        reverse_geocoded_json = eco_cache.get_json_reverse(filtered_place_data.location.coordinates[1],
+                                                           filtered_place_data.location.coordinates[0])
         if reverse_geocoded_json is not None:
             filtered_place_data.display_name = format_result(reverse_geocoded_json)
     except KeyError as e:
@@ -260,6 +288,19 @@ def get_filtered_place(raw_place):
                                                      create_id=True)
     return curr_cleaned_end_place
 
+def prefetch_place_names(tl, trip_map):
+    """
+    Reverse geocodes the places that get_filtered_place may be called for,
+    all at once, so that get_filtered_place reads them from the cache
+    """
+    raw_places = [tl.first_place()] + [tl.get_object(raw_trip.data.end_place)
+        for raw_trip in tl.trips if raw_trip.get_id() in trip_map]
+    try:
+        eco_cache.get_json_reverse_batch([(p.data.location.coordinates[1], p.data.location.coordinates[0])
+            for p in raw_places if p is not None])
+    except:
+        logging.info("Unable to prefetch reverse geocoded information, looking up places one by one")
+
 def get_filtered_section(new_trip_entry, section):
     """
     Save the filtered points associated with this section.
@@ -789,11 +830,9 @@ def resample(filtered_loc_df, interval):
     lat_new = lat_fn(ts_new)
     lng_new = lng_fn(ts_new)
     alt_new = altitude_fn(ts_new)
-    tz_new = [_get_timezone(ts, tz_ranges_df) for ts in ts_new]
-    ld_new = [ecwld.LocalDate.get_local_date(ts, tz) for (ts, tz) in zip(ts_new, tz_new)]
+    tz_new = _get_timezones(ts_new, tz_ranges_df)
+    (ld_new, fmt_time_new) = _get_local_dates(ts_new, tz_new)
     loc_new = [gj.Point((lng, lat)) for (lng, lat) in zip(lng_new, lat_new)]
-    fmt_time_new = [arrow.get(ts).to(tz).isoformat() for
-                        (ts, tz) in zip(ts_new, tz_new)]
     loc_df_new = pd.DataFrame({"latitude": lat_new, "longitude": lng_new,
                                "loc": loc_new, "ts": ts_new, "local_dt": ld_new,
                                "fmt_time": fmt_time_new, "altitude": alt_new})
@@ -812,32 +851,96 @@ def _get_timezone(ts, tz_ranges_df):
         sel_entry = sel_entry[sel_entry.duration == sel_entry.duration.max()]
     return sel_entry.timezone.iloc[0]
 
+def _get_timezones(ts_arr, tz_ranges_df):
+    """
+    Same as calling _get_timezone for every entry of ts_arr, but looks up the
+    ranges with a binary search instead of filtering tz_ranges_df every time.
+    """
+    if len(tz_ranges_df) == 1:
+        return np.full(len(ts_arr), tz_ranges_df.timezone.iloc[0], dtype=object)
+    start_ts = tz_ranges_df.start_ts.to_numpy()
+    end_ts = tz_ranges_df.end_ts.to_numpy()
+    if not (np.all(np.diff(start_ts) >= 0) and np.all(np.diff(end_ts) >= 0)):
+        logging.debug("tz_ranges_df is not sorted, looking up timezones one by one")
+        return np.array([_get_timezone(ts, tz_ranges_df) for ts in ts_arr], dtype=object)
+    timezones = tz_ranges_df.timezone.to_numpy()
+    # Since the ranges are sorted, the ones containing ts go from the first
+    # one that ends at or after ts to the last one that starts at or before ts
+    first = np.searchsorted(end_ts, ts_arr, side="left")
+    last = np.searchsorted(start_ts, ts_arr, side="right") - 1
+    tz_new = timezones[np.minimum(first, len(timezones) - 1)]
+    # Multiple matches happen on the boundary between two ranges, and no
+    # matches outside all ranges. These are rare, so we fall back to the
+    # single lookup to resolve them
+    for i in np.flatnonzero(first != last):
+        tz_new[i] = _get_timezone(ts_arr[i], tz_ranges_df)
+    return tz_new
+
+def _get_local_dates(ts_arr, tz_arr):
+    """
+    Same as calling ecwld.LocalDate.get_local_date(ts, tz) and
+    arrow.get(ts).to(tz).isoformat() for every (ts, tz) pair, but converts all
+    the timestamps in a timezone at once.
+    Returns the list of local dates (as dicts, which the wrappers convert into
+    LocalDate objects when they are read) and the list of formatted times.
+    """
+    # Round to microseconds the same way that arrow (i.e. datetime) does
+    secs = np.floor(ts_arr)
+    usecs = np.round((ts_arr - secs) * 1e6)
+    secs = np.where(usecs >= 1e6, secs + 1, secs)
+    usecs = np.where(usecs >= 1e6, usecs - 1e6, usecs).astype(np.int64)
+    utc_dt = pd.to_datetime(secs.astype(np.int64) * 1000000 + usecs, unit="us", utc=True)
+
+    ld_list = [None] * len(ts_arr)
+    fmt_time_arr = np.empty(len(ts_arr), dtype=object)
+    for tz in pd.unique(tz_arr):
+        sel = np.flatnonzero(tz_arr == tz)
+        local_dt = utc_dt[sel].tz_convert(tz)
+        for (i, year, month, day, hour, minute, second, weekday) in zip(sel.tolist(),
+                local_dt.year.tolist(), local_dt.month.tolist(), local_dt.day.tolist(),
+                local_dt.hour.tolist(), local_dt.minute.tolist(), local_dt.second.tolist(),
+                local_dt.dayofweek.tolist()):
+            ld_list[i] = {'year': year, 'month': month, 'day': day,
+                          'hour': hour, 'minute': minute, 'second': second,
+                          'weekday': weekday, 'timezone': tz}
+
+        # isoformat() only includes the microseconds if they are non-zero, and
+        # the seconds of the utc offset if they are non-zero
+        sel_usecs = usecs[sel]
+        fraction = np.where(sel_usecs > 0,
+                            np.char.add(".", np.char.zfill(sel_usecs.astype(str), 6)), "")
+        offset = (local_dt.tz_localize(None) - utc_dt[sel].tz_localize(None)).total_seconds().to_numpy().astype(np.int64)
+        abs_offset = np.abs(offset)
+        offset_str = np.char.add(np.char.add(np.char.add(
+                                 np.where(offset < 0, "-", "+"),
+                                 np.char.zfill((abs_offset // 3600).astype(str), 2)), ":"),
+                                 np.char.zfill((abs_offset % 3600 // 60).astype(str), 2))
+        offset_str = np.char.add(offset_str,
+                                 np.where(abs_offset % 60 > 0,
+                                          np.char.add(":", np.char.zfill((abs_offset % 60).astype(str), 2)), ""))
+        fmt_time_arr[sel] = np.char.add(np.char.add(
+                                local_dt.strftime("%Y-%m-%dT%H:%M:%S").to_numpy().astype(str),
+                                fraction), offset_str)
+    return (ld_list, fmt_time_arr.tolist())
+
 def _get_tz_ranges(loc_df):
     tz_ranges = []
     if len(loc_df) == 0:
         logging.debug("Called with loc_df of length 0, returning empty" % len(loc_df))
         return tz_ranges
 
-    # We know that there is at least one entry, so we can access it with impunity
-    curr_start_ts = loc_df.ts.iloc[0]
-    curr_tz = loc_df.local_dt_timezone.iloc[0]
-    for row in loc_df.to_dict('records'):
-        loc_data = ad.AttrDict(row)
-        if loc_data.local_dt_timezone != curr_tz:
-            tz_ranges.append({'timezone': curr_tz,
-                              'start_ts': curr_start_ts,
-                              'end_ts': loc_data.ts})
-            curr_start_ts = loc_data.ts
-            curr_tz = loc_data.local_dt_timezone
-
-    # At the end, always add an entry
-    # For cases in which there is only one timezone (common case),
-    # this will be the only entry
-    tz_ranges.append({'timezone': curr_tz,
-                      'start_ts': curr_start_ts,
-                      'end_ts': loc_df.ts.iloc[-1]})
+    # A new range starts at every point whose timezone is different from the
+    # timezone of the previous point, and ends at the start of the next one.
+    # For cases in which there is only one timezone (common case), there will
+    # be only one range
+    ts = loc_df.ts.to_numpy()
+    tz = loc_df.local_dt_timezone.to_numpy()
+    range_starts = np.concatenate([[0], np.flatnonzero(tz[1:] != tz[:-1]) + 1])
+    tz_ranges = pd.DataFrame({'timezone': tz[range_starts],
+                              'start_ts': ts[range_starts],
+                              'end_ts': np.append(ts[range_starts[1:]], ts[-1])})
     logging.debug("tz_ranges = %s" % tz_ranges)
-    return pd.DataFrame(tz_ranges)
+    return tz_ranges
 
 def link_trip_timeline(tl, section_map, stop_map):
     filled_in_sections = [_fill_section(s, section_map[s.get_id()], stop_map) for s in tl.trips]
@@ -887,6 +990,7 @@ def _copy_prefixed_fields(stop_data, stop_prefix, section_data, section_prefix):
 def create_and_link_timeline(tl, user_id, trip_map):
     ts = esta.TimeSeries.get_time_series(user_id)
     last_cleaned_place = esdp.get_last_place_entry(esda.CLEANED_PLACE_KEY, user_id)
+    prefetch_place_names(tl, trip_map)
     cleaned_places = []
     curr_cleaned_start_place = last_cleaned_place
     if curr_cleaned_start_place is None:
@@ -19,10 +19,9 @@ import logging
 import math
 import pandas as pd
 import numpy as np
-import attrdict as ad
 from enum import Enum
 
-import emission.analysis.point_features as pf
+import emission.analysis.point_kinematics as eapk
 import emission.core.common as ec
 # logging.basicConfig(level=logging.DEBUG)
 
@@ -33,21 +32,32 @@ class SmoothBoundary(object):
     def filter(self, with_speeds_df):
         self.inlier_mask_ = [True] * with_speeds_df.shape[0]
 
-        prev_pt = None
-        for (i, pt) in enumerate(with_speeds_df[["mLatitude", "mLongitude", "mTime", "speed"]].to_dict('records')):
-            pt = ad.AttrDict(dict(pt))
-            if prev_pt is None:
+        lon = with_speeds_df.longitude.to_numpy()
+        lat = with_speeds_df.latitude.to_numpy()
+        ts = with_speeds_df.ts.to_numpy()
+        # The speed to the previous retained point is the speed to the
+        # previous point unless we have just removed some points, so we only
+        # need to compute speeds separately after a removal
+        (_, speeds, _) = eapk.calPointKinematics(lon, lat, ts)
+        prev_idx = None
+        for i in range(len(ts)):
+            if prev_idx is None:
                 # Don't have enough data yet, so don't make any decisions
-                prev_pt = pt
+                prev_idx = i
             else:
-                currSpeed = pf.calSpeed(prev_pt, pt)
-                logging.debug("while considering point %s(%s), prev_pt (%s) speed = %s" % (pt, i, prev_pt, currSpeed))
+                if prev_idx == i - 1:
+                    currSpeed = speeds[i]
+                else:
+                    currSpeed = float(eapk.calSpeeds(
+                        eapk.calDistances(lon[prev_idx], lat[prev_idx], lon[i], lat[i]),
+                        ts[i] - ts[prev_idx]))
+                logging.debug("while considering point %s, prev_pt (%s) speed = %s" % (i, prev_idx, currSpeed))
                 if currSpeed > self.maxSpeed:
                     logging.debug("currSpeed > %s, removing index %s " % (self.maxSpeed, i))
                     self.inlier_mask_[i] = False
                 else:
                     logging.debug("currSpeed < %s, retaining index %s " % (self.maxSpeed, i))
-                    prev_pt = pt
+                    prev_idx = i
         logging.info("Filtering complete, removed indices = %s" % np.nonzero(self.inlier_mask_))
 
 # We intentionally don't use a dataframe for the segment list, using a
@@ -88,7 +98,9 @@ class SmoothZigzag(object):
     def end_points_distance(segment):
         if segment.start == segment.end:
             raise RuntimeError("This is messed up segment. Investigate further")
-        return pf.calDistance(segment.segment_df.iloc[0], segment.segment_df.iloc[-1])
+        lon = segment.segment_df.longitude.to_numpy()
+        lat = segment.segment_df.latitude.to_numpy()
+        return float(eapk.calDistances(lon[0], lat[0], lon[-1], lat[-1]))
 
     @staticmethod
     def shortest_non_cluster_segment(segment_list):
@@ -150,10 +162,10 @@ class SmoothZigzag(object):
         jumps = self.with_speeds_df[(self.with_speeds_df.speed > self.maxSpeed) &
                                     (self.with_speeds_df.distance > 100)].index
         logging.debug("After first step, jumps = %s" % jumps)
+        far_indices = self.with_speeds_df[self.with_speeds_df.distance > 100].index
         all_jumps = []
         for jump in jumps.tolist():
-            jump_to = self.with_speeds_df[(self.with_speeds_df.index < jump) & (
-                self.with_speeds_df.distance > 100)].index[-1]
+            jump_to = far_indices[far_indices < jump][-1]
             logging.debug("for jump %s, jump_to = %s" % (jump, jump_to))
             all_jumps.append(jump_to)
             all_jumps.append(jump)
@@ -281,15 +293,16 @@ class SmoothPosdap(object):
 
         quality_segments = []
         curr_segment = []
-        prev_pt = None
+        (_, speeds, _) = eapk.calPointKinematics(with_speeds_df.longitude.to_numpy(),
+                                                 with_speeds_df.latitude.to_numpy(),
+                                                 with_speeds_df.ts.to_numpy())
 
-        for (i, pt) in enumerate(with_speeds_df.to_dict('records')):
-            pt = ad.AttrDict(pt)
-            if prev_pt is None:
+        for i in range(with_speeds_df.shape[0]):
+            if i == 0:
                 # Don't have enough data yet, so don't make any decisions
-                prev_pt = pt
+                pass
             else:
-                currSpeed = pf.calSpeed(prev_pt, pt)
+                currSpeed = speeds[i]
                 print("while considering point %s, speed = %s" % (i, currSpeed))
                 # Should make this configurable
                 if currSpeed > self.maxSpeed:
@@ -298,7 +311,6 @@ class SmoothPosdap(object):
                     curr_segment = []
                 else:
                     print("currSpeed < %d, retaining index %s in existing quality segment " % (self.maxSpeed, i))
-                prev_pt = pt
                 curr_segment.append(i)
         # Append the last segment once we are at the end
         quality_segments.append(curr_segment)
@@ -14,14 +14,14 @@ import logging
 from dateutil import parser
 import math
 import pandas as pd
-import attrdict as ad
 import datetime as pydt
 import time as time
 import pytz
 import geojson as gj
 
 # Our imports
-import emission.analysis.point_features as pf
+import emission.analysis.point_kinematics as eapk
+import emission.analysis.intake.parallel as eaip
 import emission.analysis.intake.cleaning.cleaning_methods.speed_outlier_detection as eaico
 import emission.analysis.intake.cleaning.cleaning_methods.jump_smoothing as eaicj
 
@@ -53,13 +53,10 @@ def recalc_speed(points_df):
     """
     stripped_df = points_df.drop("speed", axis=1).drop("distance", axis=1)
     logging.debug("columns in points_df = %s" % points_df.columns)
-    point_list = [ad.AttrDict(row) for row in points_df.to_dict('records')]
-    zipped_points_list = list(zip(point_list, point_list[1:]))
-    distances = [pf.calDistance(p1, p2) for (p1, p2) in zipped_points_list]
-    distances.insert(0, 0)
+    (distances, speeds, _) = eapk.calPointKinematics(points_df.longitude.to_numpy(),
+                                                     points_df.latitude.to_numpy(),
+                                                     points_df.ts.to_numpy())
     with_speeds_df = pd.concat([stripped_df, pd.Series(distances, index=points_df.index, name="distance")], axis=1)
-    speeds = [pf.calSpeed(p1, p2) for (p1, p2) in zipped_points_list]
-    speeds.insert(0, 0)
     with_speeds_df = pd.concat([with_speeds_df, pd.Series(speeds, index=points_df.index, name="speed")], axis=1)
     return with_speeds_df
 
@@ -70,15 +67,9 @@ def add_dist_heading_speed(points_df):
     The speed column has the speed between each point and its previous point.
     The first row has a speed of zero.
     """
-    point_list = [ad.AttrDict(row) for row in points_df.to_dict('records')]
-    zipped_points_list = list(zip(point_list, point_list[1:]))
-
-    distances = [pf.calDistance(p1, p2) for (p1, p2) in zipped_points_list]
-    distances.insert(0, 0)
-    speeds = [pf.calSpeed(p1, p2) for (p1, p2) in zipped_points_list]
-    speeds.insert(0, 0)
-    headings = [pf.calHeading(p1, p2) for (p1, p2) in zipped_points_list]
-    headings.insert(0, 0)
+    (distances, speeds, headings) = eapk.calPointKinematics(points_df.longitude.to_numpy(),
+                                                            points_df.latitude.to_numpy(),
+                                                            points_df.ts.to_numpy())
 
     with_distances_df = pd.concat([points_df, pd.Series(distances, name="distance")], axis=1)
     with_speeds_df = pd.concat([with_distances_df, pd.Series(speeds, name="speed")], axis=1)
@@ -93,11 +84,8 @@ def add_heading_change(points_df):
     The heading change column has the heading change between this point and the
     two points preceding it. The first two rows have a speed of zero.
     """
-    point_list = [ad.AttrDict(row) for row in points_df.to_dict('records')]
-    zipped_points_list = list(zip(point_list, point_list[1:], point_list[2:]))
-    hcs = [pf.calHC(p1, p2, p3) for (p1, p2, p3) in zipped_points_list]
-    hcs.insert(0, 0)
-    hcs.insert(1, 0)
+    hcs = eapk.calHeadingChanges(points_df.longitude.to_numpy(),
+                                 points_df.latitude.to_numpy())
     with_hcs_df = pd.concat([points_df, pd.Series(hcs, name="heading_change")], axis=1)
     return with_hcs_df
 
@@ -106,9 +94,15 @@ def filter_current_sections(user_id):
     try:
         sections_to_process = esda.get_entries(esda.RAW_SECTION_KEY, user_id,
                                                time_query)
-        for section in sections_to_process:
-            logging.info("^" * 20 + ("Smoothing section %s for user %s" % (section.get_id(), user_id)) + "^" * 20)
-            filter_jumps(user_id, section.get_id())
+        ts = esta.TimeSeries.get_time_series(user_id)
+        # The sections are smoothed independently, possibly in parallel, but
+        # the results are inserted here, in section order
+        result_entries = eaip.imap_ordered(get_filter_result,
+            [(user_id, section.get_id()) for section in sections_to_process])
+        for section, result_entry in zip(sections_to_process, result_entries):
+            logging.info("^" * 20 + ("Smoothed section %s for user %s" % (section.get_id(), user_id)) + "^" * 20)
+            if result_entry is not None:
+                ts.insert(result_entry)
         if len(sections_to_process) == 0:
             # Didn't process anything new so start at the same point next time
             last_section_processed = None
@@ -127,8 +121,18 @@ def filter_jumps(user_id, section_id):
     :param section_id: the section_id to filter the trips for
     :return: none. saves an entry with the filtered points into the database.
     """
+    result_entry = get_filter_result(user_id, section_id)
+    if result_entry is not None:
+        esta.TimeSeries.get_time_series(user_id).insert(result_entry)
 
-    logging.debug("filter_jumps(%s, %s) called" % (user_id, section_id))
+def get_filter_result(user_id, section_id):
+    """
+    Same as filter_jumps, but returns the analysis/smoothing entry instead of
+    saving it, or None if there are no points to delete. Does not write to
+    the database, so that it can run in a worker process.
+    """
+
+    logging.debug("get_filter_result(%s, %s) called" % (user_id, section_id))
     outlier_algo = eaico.BoxplotOutlier()
 
     tq = esda.get_time_query_for_trip_like(esda.RAW_SECTION_KEY, section_id)
@@ -144,7 +148,7 @@ def filter_jumps(user_id, section_id):
     points_to_ignore_df = get_points_to_filter(section_points_df, outlier_algo, filtering_algo)
     if points_to_ignore_df is None:
         # There were no points to delete
-        return
+        return None
     points_to_ignore_df_filtered = points_to_ignore_df._id.dropna()
     logging.debug("after filtering ignored points, %s -> %s" %
                   (len(points_to_ignore_df), len(points_to_ignore_df_filtered)))
@@ -160,8 +164,7 @@ def filter_jumps(user_id, section_id):
     filter_result.outlier_algo = "BoxplotOutlier"
     filter_result.filtering_algo = "SmoothZigzag"
 
-    result_entry = ecwe.Entry.create_entry(user_id, "analysis/smoothing", filter_result)
-    ts.insert(result_entry)
+    return ecwe.Entry.create_entry(user_id, "analysis/smoothing", filter_result)
 
 def get_points_to_filter(section_points_df, outlier_algo, filtering_algo):
     """
@@ -0,0 +1,71 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+# Standard imports
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+import logging
+import collections
+import concurrent.futures as cf
+import multiprocessing as mp
+
+# Our imports
+import emission.analysis.config as eac
+
+# Once a raw trip has been segmented, the sections of one trip and the trips
+# of one timeline can be cleaned independently of each other. The intake
+# stages compute the new entries for each trip or section through imap_ordered
+# and insert them in the parent process, in the same order as before, so that
+# only the computation is spread over multiple processes and the database
+# writes and pipeline state updates are unchanged.
+
+def get_num_workers():
+    """
+    Number of worker processes per stage, intake.parallel.numWorkers.
+    1 (the default) runs the stages serially, as before. This is on top of
+    the processes in emission.pipeline.scheduler, so set it above 1 only
+    when there are fewer users than cores, e.g. to catch up on one large
+    backlog.
+    """
+    return eac.get_config().get("intake.parallel.numWorkers", 1) or mp.cpu_count()
+
+def get_batch_size():
+    return eac.get_config().get("intake.parallel.batchSize", 32)
+
+def imap_ordered(func, args_list, n_workers=None, batch_size=None):
+    """
+    Yields func(*args) for every args in args_list, in the order of args_list.
+    With more than one worker, the calls run in a pool of spawned processes,
+    with at most batch_size calls submitted ahead of the result that is
+    currently being consumed, so that a large backlog does not keep every
+    result in memory. func must be a module level function, and the
+    arguments and results are pickled. An exception in func is raised when
+    its result is reached, and the calls that were not started are cancelled.
+    """
+    if n_workers is None:
+        n_workers = get_num_workers()
+    if batch_size is None:
+        batch_size = get_batch_size()
+    if n_workers <= 1 or len(args_list) <= 1:
+        for args in args_list:
+            yield func(*args)
+        return
+
+    n_workers = min(n_workers, len(args_list))
+    logging.debug("Running %s calls to %s on %s processes" %
+                  (len(args_list), func.__name__, n_workers))
+    with cf.ProcessPoolExecutor(max_workers=n_workers,
+                                mp_context=mp.get_context('spawn')) as executor:
+        pending = collections.deque()
+        try:
+            for args in args_list:
+                if len(pending) >= max(batch_size, n_workers):
+                    yield pending.popleft().result()
+                pending.append(executor.submit(func, *args))
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -15,6 +15,8 @@ import emission.storage.decorations.analysis_timeseries_queries as esda
 
 import emission.storage.timeseries.abstract_timeseries as esta
 
+import emission.analysis.intake.parallel as eaip
+
 import emission.core.wrapper.motionactivity as ecwm
 import emission.core.wrapper.location as ecwl
 import emission.core.wrapper.section as ecwc
@@ -47,9 +49,15 @@ def segment_current_sections(user_id):
     time_query = epq.get_time_range_for_sectioning(user_id)
     try:
         trips_to_process = esda.get_entries(esda.RAW_TRIP_KEY, user_id, time_query)
-        for trip_entry in trips_to_process:
-            logging.info("+" * 20 + ("Processing trip %s for user %s" % (trip_entry.get_id(), user_id)) + "+" * 20)
-            segment_trip_into_sections(user_id, trip_entry, trip_entry.data.source)
+        ts = esta.TimeSeries.get_time_series(user_id)
+        # The trips are segmented independently, possibly in parallel, but
+        # the sections and stops are inserted here, in trip order
+        trip_section_entries = eaip.imap_ordered(get_section_entries,
+            [(user_id, trip_entry, trip_entry.data.source) for trip_entry in trips_to_process])
+        for trip_entry, section_entries in zip(trips_to_process, trip_section_entries):
+            logging.info("+" * 20 + ("Processed trip %s for user %s" % (trip_entry.get_id(), user_id)) + "+" * 20)
+            for entry in section_entries:
+                ts.insert(entry)
         if len(trips_to_process) == 0:
             # Didn't process anything new so start at the same point next time
             last_trip_processed = None
@@ -61,6 +69,16 @@ def segment_current_sections(user_id):
         epq.mark_sectioning_failed(user_id)
 
 def segment_trip_into_sections(user_id, trip_entry, trip_source):
+    ts = esta.TimeSeries.get_time_series(user_id)
+    for entry in get_section_entries(user_id, trip_entry, trip_source):
+        ts.insert(entry)
+
+def get_section_entries(user_id, trip_entry, trip_source):
+    """
+    Segments the trip into sections, and returns the section and stop entries,
+    stitched together, in the order section, stop, section, ... Does not write
+    to the database, so that it can run in a worker process.
+    """
     ts = esta.TimeSeries.get_time_series(user_id)
     time_query = esda.get_time_query_for_trip_like(esda.RAW_TRIP_KEY, trip_entry.get_id())
     distance_from_place = _get_distance_from_start_place_to_end(trip_entry)
@@ -88,6 +106,7 @@ def segment_trip_into_sections(user_id, trip_entry, trip_source):
     # Again, since this is segmenting a trip, we can just start with a section
 
     prev_section_entry = None
+    section_entries = []
 
     # TODO: Should we link the locations to the trips this way, or by using a foreign key?
     # If we want to use a foreign key, then we need to include the object id in the data df as well so that we can
@@ -132,13 +151,13 @@ def segment_trip_into_sections(user_id, trip_entry, trip_source):
                                                     stop, create_id=True)
             logging.debug("stop = %s, stop_entry = %s" % (stop, stop_entry))
             stitch_together(prev_section_entry, stop_entry, section_entry)
-            ts.insert(stop_entry)
-            ts.update(prev_section_entry)
+            section_entries.append(stop_entry)
 
         # After we go through the loop, we will be left with the last section,
-        # which does not have an ending stop. We insert that too.
-        ts.insert(section_entry)
+        # which does not have an ending stop. We return that too.
+        section_entries.append(section_entry)
         prev_section_entry = section_entry
+    return section_entries
 
 
 def fill_section(section, start_loc, end_loc, sensed_mode):
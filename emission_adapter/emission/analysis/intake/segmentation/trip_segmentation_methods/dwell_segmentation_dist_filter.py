@@ -56,12 +56,19 @@ class DwellSegmentationDistFilter(eaist.TripSegmentationMethod):
 
         logging.info("Last ts processed = %s" % self.last_ts_processed)
 
+        # has_trip_ended only considers ending the trip if the gap to the
+        # previous point is larger than the time threshold, so we compute the
+        # gaps for all points at once and only look at those points in detail
+        ts = filtered_points_df.ts.to_numpy()
+        timeDeltas = np.diff(ts, prepend=np.nan)
+        filtered_points = filtered_points_df.to_dict("records")
+
         segmentation_points = []
         last_trip_end_point = None
         curr_trip_start_point = None
         just_ended = True
-        for idx, row in filtered_points_df.iterrows():
-            currPoint = ad.AttrDict(row)
+        for idx, point in enumerate(filtered_points):
+            currPoint = ad.AttrDict(point)
             currPoint.update({"idx": idx})
             logging.debug("-" * 30 + str(currPoint.fmt_time) + "-" * 30)
             if curr_trip_start_point is None:
@@ -69,7 +76,7 @@ class DwellSegmentationDistFilter(eaist.TripSegmentationMethod):
                 # segmentation_points.append(currPoint)
 
             if just_ended:
-                if self.continue_just_ended(idx, currPoint, filtered_points_df):
+                if self.continue_just_ended(idx, currPoint, filtered_points):
                     # We have "processed" the currPoint by deciding to glom it
                     self.last_ts_processed = currPoint.metadata_write_ts
                     continue
@@ -80,12 +87,10 @@ class DwellSegmentationDistFilter(eaist.TripSegmentationMethod):
                 logging.debug("Setting new trip start point %s with idx %s" % (sel_point, sel_point.idx))
                 curr_trip_start_point = sel_point
                 just_ended = False
-            else:
-                # Using .loc here causes problems if we have filtered out some points and so the index is non-consecutive.
-                # Using .iloc just ends up including points after this one.
-                # So we reset_index upstream and use it here.
-                last10Points_df = filtered_points_df.iloc[max(idx-self.point_threshold, curr_trip_start_point.idx):idx+1]
-                lastPoint = ad.AttrDict(filtered_points_df.iloc[idx-1])
+            elif timeDeltas[idx] > self.time_threshold:
+                # We use positions here, not labels, since the index may be
+                # non-consecutive if we have filtered out some points.
+                lastPoint = ad.AttrDict(filtered_points[idx-1])
                 if self.has_trip_ended(lastPoint, currPoint, timeseries):
                     last_trip_end_point = lastPoint
                     logging.debug("Appending last_trip_end_point %s with index %s " %
@@ -99,7 +104,7 @@ class DwellSegmentationDistFilter(eaist.TripSegmentationMethod):
                     # end or not. But we still need to process this point by seeing
                     # whether it should represent a new trip start, or a glom to the
                     # previous trip
-                    if not self.continue_just_ended(idx, currPoint, filtered_points_df):
+                    if not self.continue_just_ended(idx, currPoint, filtered_points):
                         sel_point = currPoint
                         logging.debug("Setting new trip start point %s with idx %s" % (sel_point, sel_point.idx))
                         curr_trip_start_point = sel_point
@@ -208,7 +213,7 @@ class DwellSegmentationDistFilter(eaist.TripSegmentationMethod):
                 return False
 
 
-    def continue_just_ended(self, idx, currPoint, filtered_points_df):
+    def continue_just_ended(self, idx, currPoint, filtered_points):
         """
         Normally, since the logic here and the
         logic on the phone are the same, if we have detected a trip
@@ -223,13 +228,13 @@ class DwellSegmentationDistFilter(eaist.TripSegmentationMethod):
 
         :param idx: Index of the current point
         :param currPoint: current point
-        :param filtered_points_df: dataframe of filtered points
+        :param filtered_points: list of filtered points, as dicts
         :return: True if we should continue the just ended trip, False otherwise
         """
         if idx == 0:
             return False
         else:
-            lastPoint = ad.AttrDict(filtered_points_df.iloc[idx - 1])
+            lastPoint = ad.AttrDict(filtered_points[idx - 1])
 
             deltaDist = pf.calDistance(lastPoint, currPoint)
             deltaTime = currPoint.ts - lastPoint.ts
@@ -16,6 +16,7 @@ import datetime as pydt
 
 # Our imports
 import emission.analysis.point_features as pf
+import emission.analysis.point_kinematics as eapk
 import emission.analysis.intake.segmentation.trip_segmentation as eaist
 import emission.core.wrapper.location as ecwl
 
@@ -78,13 +79,34 @@ class DwellSegmentationTimeFilter(eaist.TripSegmentationMethod):
 
         logging.info("Last ts processed = %s" % self.last_ts_processed)
 
+        # Both windows that we check for a trip end only look back a bounded
+        # amount, so instead of filtering the whole dataframe for every point,
+        # we work on numpy arrays. The distances to the last point_threshold
+        # points are computed for all points in one strided pass, and the
+        # points in the time window are found by binary search on ts, which
+        # keeps the segmentation linear in the number of points.
+        ts = filtered_points_df.ts.to_numpy()
+        lon = filtered_points_df.longitude.to_numpy()
+        lat = filtered_points_df.latitude.to_numpy()
+        filtered_points = filtered_points_df.to_dict("records")
+        lastPointsDistances = eapk.calLaggedDistances(lon, lat, self.point_threshold)
+        # The binary search needs the points sorted by ts. They normally are,
+        # but the time query can be on metadata.write_ts, so we fall back to
+        # masks on the arrays if they are not.
+        ts_sorted = bool(np.all(np.diff(ts) >= 0))
+        if ts_sorted:
+            timeWindowStart = np.searchsorted(ts, ts - self.time_threshold, side="right")
+            timeWindowEnd = np.searchsorted(ts, ts, side="left")
+        else:
+            logging.debug("filtered points are not sorted by ts, falling back to masks")
+
         segmentation_points = []
         last_trip_end_point = None
         curr_trip_start_point = None
         just_ended = True
         prevPoint = None
-        for idx, row in filtered_points_df.iterrows():
-            currPoint = ad.AttrDict(row)
+        for idx, point in enumerate(filtered_points):
+            currPoint = ad.AttrDict(point)
             currPoint.update({"idx": idx})
             logging.debug("-" * 30 + str(currPoint.fmt_time) + "-" * 30)
             if curr_trip_start_point is None:
@@ -92,7 +114,7 @@ class DwellSegmentationTimeFilter(eaist.TripSegmentationMethod):
                 # segmentation_points.append(currPoint)
 
             if just_ended:
-                if self.continue_just_ended(idx, currPoint, filtered_points_df):
+                if self.continue_just_ended(idx, currPoint, filtered_points):
                     # We have "processed" the currPoint by deciding to glom it
                     self.last_ts_processed = currPoint.metadata_write_ts
                     continue
@@ -102,37 +124,39 @@ class DwellSegmentationTimeFilter(eaist.TripSegmentationMethod):
                 curr_trip_start_point = sel_point
                 just_ended = False
 
-            last5MinsPoints_df = filtered_points_df[np.logical_and(
-                                                        np.logical_and(
-                                                                filtered_points_df.ts > currPoint.ts - self.time_threshold,
-                                                                filtered_points_df.ts < currPoint.ts),
-                                                        filtered_points_df.ts >= curr_trip_start_point.ts)]
-            # Using .loc here causes problems if we have filtered out some points and so the index is non-consecutive.
-            # Using .iloc just ends up including points after this one.
-            # So we reset_index upstream and use it here.
+            # Points in (currPoint.ts - time_threshold, currPoint.ts) that are
+            # not before the start of the current trip
+            if ts_sorted:
+                tripStart = np.searchsorted(ts, curr_trip_start_point.ts, side="left")
+                last5MinsIdx = np.arange(max(timeWindowStart[idx], tripStart), timeWindowEnd[idx])
+            else:
+                last5MinsIdx = np.flatnonzero((ts > currPoint.ts - self.time_threshold) &
+                                              (ts < currPoint.ts) &
+                                              (ts >= curr_trip_start_point.ts))
+            # We use positions here, not labels, since we may have filtered out
+            # some points and so the index is non-consecutive.
             # We are going to use the last 8 points for now.
             # TODO: Change this back to last 10 points once we normalize phone and this
-            last10Points_df = filtered_points_df.iloc[max(idx-self.point_threshold, curr_trip_start_point.idx):idx+1]
-            distanceToLast = lambda row: pf.calDistance(ad.AttrDict(row), currPoint)
-            timeToLast = lambda row: currPoint.ts - ad.AttrDict(row).ts
-            last5MinsDistances = last5MinsPoints_df.apply(distanceToLast, axis=1)
-            logging.debug("last5MinsDistances = %s with length %d" % (last5MinsDistances.to_numpy(), len(last5MinsDistances)))
-            last10PointsDistances = last10Points_df.apply(distanceToLast, axis=1)
-            logging.debug("last10PointsDistances = %s with length %d, shape %s" % (last10PointsDistances.to_numpy(),
-                                                                           len(last10PointsDistances),
-                                                                           last10PointsDistances.shape))
+            last10PointsIdx = np.arange(max(idx-self.point_threshold, curr_trip_start_point.idx), idx+1)
+            last5MinsDistances = eapk.calDistances(lon[last5MinsIdx], lat[last5MinsIdx],
+                                                   currPoint.longitude, currPoint.latitude)
+            logging.debug("last5MinsDistances = %s with length %d", last5MinsDistances, len(last5MinsDistances))
+            # column k of lastPointsDistances is the distance to the point k steps back
+            last10PointsDistances = lastPointsDistances[idx, :len(last10PointsIdx)]
+            logging.debug("last10PointsDistances = %s with length %d, shape %s", last10PointsDistances,
+                          len(last10PointsDistances), last10PointsDistances.shape)
 
             # Fix for https://github.com/e-mission/e-mission-server/issues/348
-            last5MinTimes = last5MinsPoints_df.apply(timeToLast, axis=1)
-            
+            last5MinTimes = currPoint.ts - ts[last5MinsIdx]
+
             logging.debug("len(last10PointsDistances) = %d, len(last5MinsDistances) = %d" %
                   (len(last10PointsDistances), len(last5MinsDistances)))
             logging.debug("last5MinsTimes.max() = %s, time_threshold = %s" %
                           (last5MinTimes.max() if len(last5MinTimes) > 0 else np.NaN, self.time_threshold))
 
             if self.has_trip_ended(prevPoint, currPoint, timeseries, last10PointsDistances, last5MinsDistances, last5MinTimes):
-                (ended_before_this, last_trip_end_point) = self.get_last_trip_end_point(filtered_points_df,
-                                                                                       last10Points_df, last5MinsPoints_df)
+                (ended_before_this, last_trip_end_point) = self.get_last_trip_end_point(filtered_points,
+                                                                                       last10PointsIdx, last5MinsIdx)
                 segmentation_points.append((curr_trip_start_point, last_trip_end_point))
                 logging.info("Found trip end at %s" % last_trip_end_point.fmt_time)
                 # We have processed everything up to the trip end by marking it as a completed trip
@@ -159,8 +183,8 @@ class DwellSegmentationTimeFilter(eaist.TripSegmentationMethod):
             logging.debug("looking after %s, found transitions %s" %
                           (currPoint.ts, stopped_moving_after_last))
             if len(stopped_moving_after_last) > 0:
-                (unused, last_trip_end_point) = self.get_last_trip_end_point(filtered_points_df,
-                                                                             last10Points_df, None)
+                (unused, last_trip_end_point) = self.get_last_trip_end_point(filtered_points,
+                                                                             last10PointsIdx, None)
                 segmentation_points.append((curr_trip_start_point, last_trip_end_point))
                 logging.debug("Found trip end at %s" % last_trip_end_point.fmt_time)
                 # We have processed everything up to the trip end by marking it as a completed trip
@@ -168,7 +192,7 @@ class DwellSegmentationTimeFilter(eaist.TripSegmentationMethod):
 
         return segmentation_points
 
-    def continue_just_ended(self, idx, currPoint, filtered_points_df):
+    def continue_just_ended(self, idx, currPoint, filtered_points):
         """
         Normally, since the logic here and the
         logic on the phone are the same, if we have detected a trip
@@ -183,13 +207,13 @@ class DwellSegmentationTimeFilter(eaist.TripSegmentationMethod):
 
         :param idx: Index of the current point
         :param currPoint: current point
-        :param filtered_points_df: dataframe of filtered points
+        :param filtered_points: list of filtered points, as dicts
         :return: True if we should continue the just ended trip, False otherwise
         """
         if idx == 0:
             return False
         else:
-            prev_point = ad.AttrDict(filtered_points_df.iloc[idx - 1])
+            prev_point = ad.AttrDict(filtered_points[idx - 1])
             logging.debug("Comparing with prev_point = %s" % prev_point)
             if pf.calDistance(prev_point, currPoint) < self.distance_threshold and \
                                     currPoint.ts - prev_point.ts <= 60:
@@ -264,27 +288,25 @@ class DwellSegmentationTimeFilter(eaist.TripSegmentationMethod):
                 return True
 
 
-    def get_last_trip_end_point(self, filtered_points_df, last10Points_df, last5MinsPoints_df):
-        ended_before_this = last5MinsPoints_df is None or len(last5MinsPoints_df) == 0
+    def get_last_trip_end_point(self, filtered_points, last10PointsIdx, last5MinsIdx):
+        ended_before_this = last5MinsIdx is None or len(last5MinsIdx) == 0
         if ended_before_this:
-            logging.debug("trip end transition, so last 10 points are %s" % last10Points_df.index)
-            last10PointsMedian = np.median(last10Points_df.index)
+            logging.debug("trip end transition, so last 10 points are %s" % last10PointsIdx)
+            last10PointsMedian = np.median(last10PointsIdx)
             last_trip_end_index = int(last10PointsMedian)
             logging.debug("last5MinsPoints not found, last_trip_end_index = %s" % last_trip_end_index)
         else:
-            last10PointsMedian = np.median(last10Points_df.index)
-            last5MinsPointsMedian = np.median(last5MinsPoints_df.index)
+            last10PointsMedian = np.median(last10PointsIdx)
+            last5MinsPointsMedian = np.median(last5MinsIdx)
             last_trip_end_index = int(min(last5MinsPointsMedian, last10PointsMedian))
             logging.debug("last5MinsPoints and last10PointsMedian found, last_trip_end_index = %s" % last_trip_end_index)
-        #                     logging.debug("last5MinPoints.median = %s (%s), last10Points_df = %s (%s), sel index = %s" %
-        #                         (np.median(last5MinsPoints_df.index), last5MinsPoints_df.index,
-        #                          np.median(last10Points_df.index), last10Points_df.index,
+        #                     logging.debug("last5MinPoints.median = %s (%s), last10Points = %s (%s), sel index = %s" %
+        #                         (np.median(last5MinsIdx), last5MinsIdx,
+        #                          np.median(last10PointsIdx), last10PointsIdx,
         #                          last_trip_end_index))
 
-        last_trip_end_point_row = filtered_points_df.iloc[last_trip_end_index]
-        last_trip_end_point = ad.AttrDict(filtered_points_df.iloc[last_trip_end_index])
+        last_trip_end_point = ad.AttrDict(filtered_points[last_trip_end_index])
         logging.debug("Appending last_trip_end_point %s with index %s " %
-                      (last_trip_end_point, last_trip_end_point_row.name))
+                      (last_trip_end_point, last_trip_end_index))
         return (ended_before_this, last_trip_end_point)
 
-
@@ -1,9 +1,15 @@
 # Standard imports
 import jsonpickle as jpickle
 import logging
+import collections
+import copy
+import os
+import threading
+import numpy as np
 
 # Our imports
 import emission.storage.timeseries.abstract_timeseries as esta
+import emission.analysis.point_kinematics as eapk
 import emission.analysis.modelling.tour_model.similarity as similarity
 import emission.analysis.modelling.tour_model.similarity as similarity
 import emission.analysis.modelling.tour_model.data_preprocessing as preprocess
@@ -24,6 +30,73 @@ def loadModel(filename):
     return all_model
 
 
+# The models are rebuilt offline, by build_save_model, and are read for every
+# trip that we predict. Keep the most recently used ones in memory, keyed by
+# the file name, and reload a file when its modification time changes.
+MODEL_CACHE_SIZE = 64
+_model_cache = collections.OrderedDict()
+_model_cache_lock = threading.Lock()
+
+def loadModelStageCached(filename):
+    """
+    Same as loadModelStage, but returns the cached model if the file has not
+    changed since it was loaded. Raises IOError if the file does not exist.
+    The returned model is shared, so callers must not modify it.
+    """
+    mtime = os.path.getmtime(filename)
+    with _model_cache_lock:
+        cached = _model_cache.get(filename)
+        if cached is not None and cached[0] == mtime:
+            _model_cache.move_to_end(filename)
+            return cached[1]
+    logging.debug("Loading model %s, modified at %s" % (filename, mtime))
+    model = loadModelStage(filename)
+    with _model_cache_lock:
+        _model_cache[filename] = (mtime, model)
+        _model_cache.move_to_end(filename)
+        while len(_model_cache) > MODEL_CACHE_SIZE:
+            _model_cache.popitem(last=False)
+    return model
+
+def clear_model_cache():
+    with _model_cache_lock:
+        _model_cache.clear()
+
+def get_bin_index(bin_locations):
+    """
+    Flattens the first round bins into arrays for find_bin_vectorized: the
+    bin labels in key order, the (n, 4) array of [start lon, start lat,
+    end lon, end lat] of all the trips in all the bins, and the position of
+    the bin of each of those trips.
+    """
+    bin_labels = list(bin_locations.keys())
+    loc_feat_list = []
+    bin_pos_list = []
+    for i, fl in enumerate(bin_labels):
+        for feat in bin_locations[fl]:
+            loc_feat_list.append(feat[0:4])
+            bin_pos_list.append(i)
+    loc_feat = np.array(loc_feat_list, dtype=float).reshape(-1, 4)
+    return bin_labels, loc_feat, np.array(bin_pos_list, dtype=int)
+
+def find_bin_vectorized(bin_index, new_trip_location_feat, radius):
+    """
+    The label of the first bin for which in_bin is true, or None. Checks the
+    new trip against the start and end of every trip in every bin at once.
+    """
+    bin_labels, loc_feat, bin_pos = bin_index
+    start_dist = eapk.calDistances(loc_feat[:, 0], loc_feat[:, 1],
+                                   new_trip_location_feat[0], new_trip_location_feat[1])
+    end_dist = eapk.calDistances(loc_feat[:, 2], loc_feat[:, 3],
+                                 new_trip_location_feat[2], new_trip_location_feat[3])
+    outside = (start_dist > radius) | (end_dist > radius)
+    # a bin matches if none of its trips is outside the radius, like in_bin
+    n_outside = np.bincount(bin_pos[outside], minlength=len(bin_labels))
+    matched = np.flatnonzero(n_outside == 0)
+    if len(matched) == 0:
+        return None
+    return bin_labels[matched[0]]
+
 def in_bin(bin_location_features,new_trip_location_feat,radius):
     start_b_lon = new_trip_location_feat[0]
     start_b_lat = new_trip_location_feat[1]
@@ -43,52 +116,73 @@ def in_bin(bin_location_features,new_trip_location_feat,radius):
     return True
 
 
+def load_user_models(user):
+    """
+    The (bin_locations, models, user_labels) of the user, see predict_labels,
+    from the model cache
+    """
+    # load locations of bins(1st round of clustering)
+    # e.g.{'0': [[start lon1, start lat1, end lon1, end lat1],[start lon, start lat, end lon, end lat]]}
+    # another explanation: -'0': label from the 1st round
+    #                      - the value of key '0': all trips that in this bin
+    #                      - for every trip: the coordinates of start/end locations
+    bin_locations = loadModelStageCached('locations_' + str(user))[0]
+
+    # load models from the 2nd round of clustering
+    # we use Kmeans to build the model in the previous model building step
+    # assume that we have 2 clusters from the 1st round(that means 2 bins),
+    # the following is an example of the saved models.
+    # e.g. {'0': KMeans(n_clusters=2, random_state=0), '1': KMeans(n_clusters=5, random_state=0)}
+    models = loadModelStageCached('models_' + str(user))[0]
+
+    # load user labels in all clusters
+    # assume that we have 1 cluster(bin) from the 1st round of clustering, which has label '0',
+    # and we have 1 cluster from the 2nd round, which has label '1'
+    # the value of key '0' contains all 2nd round clusters
+    # the value of key '1' contains all user labels and probabilities in this cluster
+    # e.g. {'0': [{'1': [{'labels': {'mode_confirm': 'shared_ride', 'purpose_confirm': 'home', 'replaced_mode': 'drove_alone'}}]}]}
+    user_labels = loadModelStageCached('user_labels_' + str(user))[0]
+    return bin_locations, models, user_labels
+
 def predict_labels(trip):
+    return predict_labels_batch([trip])[0]
+
+def predict_labels_batch(trips):
+    """
+    Same as calling predict_labels for each trip, but the models of each user
+    are loaded and the bins indexed once for all their trips
+    """
     radius = 100
-    user = trip['user_id']
-    logging.debug(f"At stage: extracting features")
-    trip_feat = preprocess.extract_features([trip])[0]
-    trip_loc_feat = trip_feat[0:4]
-    logging.debug(f"At stage: loading model")
-    try:
-        # load locations of bins(1st round of clustering)
-        # e.g.{'0': [[start lon1, start lat1, end lon1, end lat1],[start lon, start lat, end lon, end lat]]}
-        # another explanation: -'0': label from the 1st round
-        #                      - the value of key '0': all trips that in this bin
-        #                      - for every trip: the coordinates of start/end locations
-        bin_locations = loadModelStage('locations_' + str(user))[0]
-
-        # load models from the 2nd round of clustering
-        # we use Kmeans to build the model in the previous model building step
-        # assume that we have 2 clusters from the 1st round(that means 2 bins),
-        # the following is an example of the saved models.
-        # e.g. {'0': KMeans(n_clusters=2, random_state=0), '1': KMeans(n_clusters=5, random_state=0)}
-        models = loadModelStage('models_' + str(user))[0]
-
-        # load user labels in all clusters
-        # assume that we have 1 cluster(bin) from the 1st round of clustering, which has label '0',
-        # and we have 1 cluster from the 2nd round, which has label '1'
-        # the value of key '0' contains all 2nd round clusters
-        # the value of key '1' contains all user labels and probabilities in this cluster
-        # e.g. {'0': [{'1': [{'labels': {'mode_confirm': 'shared_ride', 'purpose_confirm': 'home', 'replaced_mode': 'drove_alone'}}]}]}
-        user_labels = loadModelStage('user_labels_' + str(user))[0]
-
-    except IOError as e:
-        logging.exception(e)
-        return []
+    predictions = [None] * len(trips)
+    trip_idx_by_user = collections.OrderedDict()
+    for i, trip in enumerate(trips):
+        trip_idx_by_user.setdefault(trip['user_id'], []).append(i)
 
+    for user, trip_idx_list in trip_idx_by_user.items():
+        logging.debug(f"At stage: loading model")
+        try:
+            bin_locations, models, user_labels = load_user_models(user)
+        except IOError as e:
+            logging.exception(e)
+            for i in trip_idx_list:
+                predictions[i] = []
+            continue
+
+        bin_index = get_bin_index(bin_locations)
+        logging.debug(f"At stage: extracting features")
+        trip_feats = preprocess.extract_features([trips[i] for i in trip_idx_list])
+        for i, trip_feat in zip(trip_idx_list, trip_feats):
+            predictions[i] = _predict_labels_for_features(trip_feat, bin_index,
+                models, user_labels, radius)
+    return predictions
+
+def _predict_labels_for_features(trip_feat, bin_index, models, user_labels, radius):
     logging.debug(f"At stage: first round labeling")
-    first_round_label_set = list(bin_locations.keys())
-    sel_fl = None
-    for fl in first_round_label_set:
-        # extract location features of selected bin
-        sel_loc_feat = bin_locations[fl]
-        # Check if start/end locations of the new trip and every start/end locations in this bin are within the range of
-        # radius. If so, the new trip falls in this bin. Then predict the second round label of the new trip
-        # using this bin's model
-        if in_bin(sel_loc_feat, trip_loc_feat, radius):
-            sel_fl = fl
-            break
+    trip_loc_feat = trip_feat[0:4]
+    # Check if start/end locations of the new trip and every start/end locations in a bin are within the range of
+    # radius. If so, the new trip falls in this bin. Then predict the second round label of the new trip
+    # using this bin's model
+    sel_fl = find_bin_vectorized(bin_index, trip_loc_feat, radius)
     if not sel_fl:
         logging.debug(f"sel_fl = {sel_fl}, early return")
         return []
@@ -113,7 +207,8 @@ def predict_labels(trip):
     if sel_sl not in second_label_ls:
         return []
     # values of the selected 2nd round label, wrapped in a list
-    sel_2nd_round_val = seccond_round_result[sel_sl]
+    # copied, since the loaded models are shared through the cache
+    sel_2nd_round_val = copy.deepcopy(seccond_round_result[sel_sl])
     logging.debug(f"Found prediction {sel_2nd_round_val}")
 
     return sel_2nd_round_val
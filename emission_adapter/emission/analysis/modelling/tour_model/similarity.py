@@ -18,6 +18,7 @@ from sklearn import metrics
 from numpy.linalg import norm
 import emission.storage.decorations.analysis_timeseries_queries as esda
 import emission.core.common as ecc
+import emission.analysis.point_kinematics as eapk
 
 
 """
@@ -42,10 +43,7 @@ def within_radius(lat1, lon1, lat2, lon2, radius):
     return dist <= radius
 
 def filter_too_short(all_trips, radius):
-    # Since this is a pure function, we should append valid trips
-    # instead of removing invalid trips
-    # But let's go from working to working
-    valid_trips = copy.copy(all_trips)
+    valid_trips = []
     for t in all_trips:
         logging.debug(f"Considering trip {t['_id']}: {t.data.start_fmt_time} -> {t.data.end_fmt_time}, {t.data.start_loc} -> {t.data.end_loc}")
         try:
@@ -55,15 +53,64 @@ def filter_too_short(all_trips, radius):
             end_lat = t.data.end_loc["coordinates"][1]
             logging.debug("endpoints are = (%s, %s) and (%s, %s)" %
                           (start_lon, start_lat, end_lon, end_lat))
-            if within_radius(start_lat, start_lon, end_lat, end_lon, radius):
-                valid_trips.remove(t)
+            if not within_radius(start_lat, start_lon, end_lat, end_lon, radius):
+                valid_trips.append(t)
         except:
             logging.exception("exception while getting start and end places for %s" % t)
-            valid_trips.remove(t)
 
     logging.debug('After removing trips that are points, there are %s data points' % len(valid_trips))
     return valid_trips
 
+def get_endpoints(trips):
+    """
+    Returns an (n, 4) array of [start lon, start lat, end lon, end lat] for
+    the trips. The row of a trip whose locations cannot be read is NaN, so it
+    is not within any radius of any other trip.
+    """
+    endpoints = numpy.full((len(trips), 4), numpy.nan)
+    for i, t in enumerate(trips):
+        try:
+            start = t.data.start_loc["coordinates"]
+            end = t.data.end_loc["coordinates"]
+            endpoints[i] = [start[0], start[1], end[0], end[1]]
+        except:
+            logging.exception("exception while getting start and end places for %s" % t)
+    return endpoints
+
+def get_grid_cells(endpoints, radius):
+    """
+    Hashes the start and end points into a lon/lat grid whose cells are at
+    least radius wide, so that two points within radius of each other are in
+    the same or in adjacent cells. Returns an (n, 4) int array of the
+    [start lon, start lat, end lon, end lat] cells, which is only meaningful
+    for the rows of endpoints that are finite.
+
+    The distance between two points is at least earth radius * the
+    difference in latitude, and at least 2 * earth radius *
+    asin(min cos(lat) * sin(difference in longitude / 2)), which gives the
+    cell sizes in degrees. If that bound does not exist, e.g. close to the
+    poles, or the points are close to the antimeridian, all the points are in
+    the same longitude cell.
+    """
+    finite = numpy.isfinite(endpoints).all(axis=1)
+    # slightly larger than the bounds, so that rounding cannot split neighbours
+    margin = 1.01
+    lat_size = max(math.degrees(radius / eapk.EARTH_RADIUS) * margin, 1e-9)
+    lon_size = 360.0
+    if finite.any():
+        lons = endpoints[finite][:, [0, 2]]
+        lats = endpoints[finite][:, [1, 3]]
+        min_cos = math.cos(math.radians(min(numpy.abs(lats).max(), 90.0)))
+        sin_bound = math.sin(min(radius / (2 * eapk.EARTH_RADIUS), math.pi / 2))
+        if min_cos > 0 and sin_bound < min_cos:
+            lon_size = max(math.degrees(2 * math.asin(sin_bound / min_cos)) * margin, 1e-9)
+            if (numpy.abs(lons) > 180 - lon_size).any():
+                lon_size = 360.0
+    cell_sizes = numpy.array([lon_size, lat_size, lon_size, lat_size])
+    cells = numpy.zeros(endpoints.shape, dtype=numpy.int64)
+    cells[finite] = numpy.floor(endpoints[finite] / cell_sizes).astype(numpy.int64)
+    return cells
+
 class similarity(object):
     def __init__(self, data, radius, shouldFilter=True, cutoff=True):
         if not data:
@@ -115,22 +162,55 @@ class similarity(object):
         
 
     #create bins
+    #every trip is added to the first bin in which it matches all the trips,
+    #or to a new bin. Only a bin whose first trip is within the radius can
+    #match, so the bins are hashed by the grid cells of their first trip, and
+    #a trip is only matched against the bins in the neighbouring cells
     def bin_data(self):
+        endpoints = get_endpoints(self.data)
+        cells = get_grid_cells(endpoints, self.radius)
+        finite = numpy.isfinite(endpoints).all(axis=1)
+        bin_grid = {}
+
+        def add_to_grid(bin_idx, a):
+            if finite[a]:
+                bin_grid.setdefault(tuple(cells[a]), []).append(bin_idx)
+
+        for bin_idx, bin in enumerate(self.bins):
+            add_to_grid(bin_idx, bin[0])
+        neighbours = [(dslon, dslat, delon, delat)
+            for dslon in (-1, 0, 1) for dslat in (-1, 0, 1)
+            for delon in (-1, 0, 1) for delat in (-1, 0, 1)]
+
         for a in range(self.size):
             added = False
-            for bin in self.bins:
-                try:
-                    if self.match(a,bin):
-                        bin.append(a)
+            if finite[a]:
+                candidates = []
+                cell = cells[a]
+                for d in neighbours:
+                    candidates.extend(bin_grid.get((cell[0] + d[0], cell[1] + d[1],
+                        cell[2] + d[2], cell[3] + d[3]), []))
+                for bin_idx in sorted(candidates):
+                    if self.match_all(endpoints, a, self.bins[bin_idx]):
+                        self.bins[bin_idx].append(a)
                         added = True
                         break
-                except:
-                    print(f"Got exception while matching trip {a}, creating new bin")
-                    added = False
             if not added:
                 self.bins.append([a])
+                add_to_grid(len(self.bins) - 1, a)
         self.bins.sort(key=lambda bin: len(bin), reverse=True)
 
+    #check if a trip matches all the trips in a bin, same as match
+    #but with the endpoints from get_endpoints
+    def match_all(self, endpoints, a, bin):
+        members = endpoints[bin]
+        # Same argument order as distance_helper
+        start = eapk.calDistances(endpoints[a, 0], endpoints[a, 1],
+                                  members[:, 0], members[:, 1]) <= self.radius
+        end = eapk.calDistances(endpoints[a, 2], endpoints[a, 3],
+                                members[:, 2], members[:, 3]) <= self.radius
+        return bool(numpy.all(start & end))
+
     def calc_cutoff_bins(self):
         if len(self.bins) <= 1:
             print(f"{len(self.bins)}, no cutoff")
@@ -7,12 +7,8 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import range
 from builtins import *
-import numpy as np
-import math
-from scipy.ndimage import measurements
-
 # Our imports
-import emission.core.common as ec
+import emission.analysis.modelling.tour_model.trajectory_matching.trajectory_distance as eatd
 
 # Tristan Ursell
 # Frechet Distance between two curves
@@ -90,40 +86,7 @@ import emission.core.common as ec
 # 
 
 def Frechet(R1,R2,varargin=None):
-
-    # get path point length
-    L1=len(R1);
-    L2=len(R2);
-
-    frechet1=np.zeros((L1,L2))
-    # print(frechet1)
-    # calculate frechet distance matrix
-    for i in range(L1):
-        for j in range(L2):
-            # frechet1[i,j]=math.sqrt(math.pow(R1[i][0]-R2[j][0],2)+math.pow(R1[i][1]-R2[j][1],2))
-            frechet1[i,j]=ec.calDistance(R1[i],R2[j])
-    fmin=frechet1.min();
-    fmax=frechet1.max();
-    # print(fmin)
-    # print(fmax)
-
-    # handle resolution
-    if varargin==None:
-        varargin=1000
-    # print(frechet1<=3)
-    # print(varargin)
-    # compute frechet distance
-    # print(np.linspace(fmin,fmax,varargin))
-    for q3 in np.linspace(fmin,fmax,varargin):
-        # print(q3)
-        im1=np.asarray(measurements.label(frechet1<=q3))[0]
-        # print(im1.shape)
-        # print(im1[-1,-1])
-        # get region number of beginning and end points
-        if im1[0,0]!=0 and im1[0,0]==im1[-1,-1]:
-            f=q3
-            break
-    return f
+    return eatd.frechet(R1, R2, varargin)
 # R1=[]
 # R2=[]
 # for aa in range(0,51):
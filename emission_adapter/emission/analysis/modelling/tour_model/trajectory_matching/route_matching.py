@@ -18,6 +18,10 @@ import time
 import emission.core.common as ec
 import emission.core.get_database as edb
 import emission.analysis.modelling.tour_model.trajectory_matching as eatm
+import emission.analysis.modelling.tour_model.trajectory_matching.DTW
+import emission.analysis.modelling.tour_model.trajectory_matching.Frechet
+import emission.analysis.modelling.tour_model.trajectory_matching.LCS
+import emission.analysis.modelling.tour_model.trajectory_matching.trajectory_distance as eatd
 
 def find_near(lst,pnt,radius):
     near=[]
@@ -372,27 +376,7 @@ def fullMatchDistance(route1,route2,step1=100000,step2=100000,method='lcs',radiu
     if len(route1) < 2 or len(route2) < 2:
         return dis
 
-## using DTW Iteration
-    if method=='dtw':
-        new_dis=eatm.DTW.dynamicTimeWarp(refineRoute(route1,step1),refineRoute(route2,step2),ec.calDistance)
-## using DTW Recursion
-    if method=='DTW':
-        aa=eatm.DTW.Dtw(refineRoute(route1,step1),refineRoute(route2,step2),ec.calDistance)
-        new_dis=aa.calculate_distance()
-## using symmetric DTW
-    if method=='DTWSym':
-        aa=eatm.DTW.DtwSym(refineRoute(route1,step1),refineRoute(route2,step2),ec.calDistance)
-        new_dis=aa.calculate_distance()
-## using Asymmetric DTW
-    if method=='DTWAsym':
-        aa=eatm.DTW.DtwAsym(refineRoute(route1,step1),refineRoute(route2,step2),ec.calDistance)
-        new_dis=aa.calculate_distance()
-## using Frechet
-    if method=='Frechet':
-        new_dis=eatm.Frechet.Frechet(refineRoute(route1,step1),refineRoute(route2,step2))
-## using lcs
-    if method=='lcs':
-        new_dis=eatm.LCS.lcsScore(refineRoute(route1,step1),refineRoute(route2,step2),radius1)
+    new_dis=eatd.route_distance(refineRoute(route1,step1),refineRoute(route2,step2),method,radius1)
     if new_dis<dis:
         dis=new_dis
 
@@ -433,26 +417,24 @@ def update_user_routeDistanceMatrix(user_id,data_feature,step1=100000,step2=1000
     """
     user_disMat = edb.get_routeDistanceMatrix_db(user_id, method)
 
-    a=0
-
-    # print(len(ids))
-    for _id in ids:
-        if a % 100 == 0:
-            print("In update_user_routeDistanceMatrix, a = %d" % a)
-        a+=1
-        for key in ids:
-            try:
-                user_disMat[_id][key]
-                #print("found it")
-            except KeyError:
-                #print('Updating matrix for the trip ' + _id + '. Doing calculations.')
-                dis=fullMatchDistance(data_feature[_id], data_feature[key],step1,step2,method,radius1)
-                #user_disMat[_id] = {}
-                if _id not in user_disMat:
-                    user_disMat[_id] = {}
-                user_disMat[_id][key] = dis
-                #print('Update successful.')
-                #print(user_disMat[_id])
+    # Only compute the missing pairs, with the routes refined once per route
+    # instead of once per pair
+    missing = [(i, j) for i, _id in enumerate(ids) for j, key in enumerate(ids)
+               if key not in user_disMat.get(_id, {})]
+    print("In update_user_routeDistanceMatrix, computing %d of %d distances" % (len(missing), len(ids) ** 2))
+    if len(missing) > 0:
+        refined1 = [refineRoute(data_feature[_id],step1) for _id in ids]
+        refined2 = refined1 if step1 == step2 else [refineRoute(data_feature[_id],step2) for _id in ids]
+        valid = [len(data_feature[_id]) >= 2 for _id in ids]
+        disMat = eatd.route_distance_matrix(refined1, method, radius1,
+            pairs=[(i, j) for (i, j) in missing if valid[i] and valid[j]],
+            columns=refined2)
+        for (i, j) in missing:
+            if ids[i] not in user_disMat:
+                user_disMat[ids[i]] = {}
+            # same as fullMatchDistance, including the cap for routes with
+            # fewer than two points
+            user_disMat[ids[i]][ids[j]] = min(float(disMat[i, j]), 999999) if valid[i] and valid[j] else 999999
 
     #edb.get_routeDistanceMatrix_db().update({'$and':[{'user':user_id},{'method':method}]},{'user':user_id,'method':method,'disMat':user_disMat})
     print(type(user_disMat))
@@ -0,0 +1,254 @@
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+# Standard imports
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+from builtins import *
+import logging
+import numpy as np
+import scipy.ndimage as ndimage
+
+# Our imports
+import emission.core.common as ec
+import emission.analysis.point_kinematics as eapk
+
+# Trajectory similarity measures (DTW, Frechet and LCS) for routes that are
+# lists of [lon, lat] points. The dynamic programs fill preallocated numpy
+# arrays one row at a time, and the local distances are computed up front as
+# a haversine cost matrix, so that there is no recursion and no per-cell
+# python call. The DTW.py, Frechet.py and LCS.py modules are thin wrappers
+# around these functions.
+
+# Normalizations of the accumulated DTW cost, see dtw()
+DTW_STEP_PATTERNS = {
+    # plain DTW, normalized by the length of the warping path (Dtw)
+    "path": (1, 1, 1),
+    # plain DTW, normalized by the sum of the lengths (dynamicTimeWarp)
+    "sum": (1, 1, 1),
+    # diagonal steps count twice, normalized by the sum of the lengths (DtwSym)
+    "symmetric": (1, 2, 1),
+    # only steps along route1 count, normalized by len(route1) (DtwAsym)
+    "asymmetric": (1, 1, 0),
+}
+
+def to_coords(route):
+    """
+    Returns the route as an (n, 2) float array of [lon, lat]
+    """
+    coords = np.asarray(route, dtype=float)
+    return coords.reshape(-1, 2)
+
+def downsample(route, max_points=100):
+    """
+    Keeps every (n // max_points)th point of the route and the last point,
+    same as the downsampling in the original recursive Dtw
+    """
+    coords = to_coords(route)
+    if len(coords) <= max_points:
+        return coords
+    indexes = np.arange(0, len(coords), len(coords) // max_points)
+    return np.concatenate([coords[indexes], coords[-1:]])
+
+def get_cost_matrix(route1, route2, distance_func=None):
+    """
+    Matrix of the distances between every point of route1 and every point of
+    route2. The haversine distance is computed with numpy; any other
+    distance_func is called for every pair of points.
+    """
+    if distance_func is None or distance_func is ec.calDistance:
+        coords1 = to_coords(route1)
+        coords2 = to_coords(route2)
+        return eapk.calDistances(coords1[:, np.newaxis, 0], coords1[:, np.newaxis, 1],
+                                 coords2[np.newaxis, :, 0], coords2[np.newaxis, :, 1])
+    cost = np.empty((len(route1), len(route2)))
+    for i, p1 in enumerate(route1):
+        for j, p2 in enumerate(route2):
+            cost[i, j] = distance_func(p1, p2)
+    return cost
+
+def _get_band(n, m, window):
+    """
+    Sakoe-Chiba band, scaled to the diagonal for routes of different
+    lengths. Returns the first and last (inclusive) column of every row.
+    """
+    if window is None:
+        return np.zeros(n, dtype=int), np.full(n, m - 1)
+    centers = np.arange(n) * ((m - 1) / max(n - 1, 1))
+    # the band has to be at least as wide as one diagonal step, otherwise
+    # there is no path from one corner to the other
+    width = max(window, (m - 1) / max(n - 1, 1), 1)
+    lo = np.clip(np.ceil(centers - width), 0, m - 1).astype(int)
+    hi = np.clip(np.floor(centers + width), 0, m - 1).astype(int)
+    return lo, hi
+
+def dtw_accumulated_cost(cost, step_pattern="path", window=None, max_cost=None):
+    """
+    Iterative DTW over a cost matrix. Returns the (n+1, m+1) matrix of
+    accumulated costs, where [i+1, j+1] is the DTW cost of aligning the first
+    i+1 points of route1 with the first j+1 points of route2, or None if every
+    cell of a row is above max_cost (early abandon).
+
+    Within a row, acc[j] = min(from_above[j], acc[j-1] + horizontal cost[j])
+    is a running minimum once the horizontal costs are moved out with a
+    cumulative sum, so every row is a handful of numpy operations.
+    """
+    vertical, diagonal, horizontal = DTW_STEP_PATTERNS[step_pattern]
+    n, m = cost.shape
+    acc = np.full((n + 1, m + 1), np.inf)
+    acc[0, 0] = 0
+    lo, hi = _get_band(n, m, window)
+    for i in range(n):
+        row_cost = cost[i, lo[i]:hi[i] + 1]
+        from_above = np.minimum(acc[i, lo[i] + 1:hi[i] + 2] + vertical * row_cost,
+                                acc[i, lo[i]:hi[i] + 1] + diagonal * row_cost)
+        if horizontal == 0:
+            row = np.minimum.accumulate(from_above)
+        else:
+            # the cumsum is offset by the first cost so that it stays small
+            horizontal_cost = np.cumsum(horizontal * row_cost) - horizontal * row_cost[0]
+            row = np.minimum.accumulate(from_above - horizontal_cost) + horizontal_cost
+        acc[i + 1, lo[i] + 1:hi[i] + 2] = row
+        if max_cost is not None and row.min() > max_cost:
+            return None
+    return acc
+
+def dtw_path(acc):
+    """
+    Warping path through an accumulated cost matrix from dtw_accumulated_cost,
+    from the last pair of points back to the first one. Ties are broken in the
+    same order as the original recursive Dtw.
+    """
+    path = []
+    i1, i2 = acc.shape[0] - 2, acc.shape[1] - 2
+    while (i1, i2) != (-1, -1):
+        path.append((i1, i2))
+        i1, i2 = min((i1 - 1, i2), (i1, i2 - 1), (i1 - 1, i2 - 1),
+                     key=lambda x: acc[x[0] + 1, x[1] + 1])
+    return path
+
+def _dtw_normalization(step_pattern, n, m):
+    if step_pattern == "path":
+        # upper bound of the path length, used for early abandon
+        return n + m - 1
+    if step_pattern == "asymmetric":
+        return n
+    return n + m
+
+def dtw(route1, route2, step_pattern="path", window=None, max_distance=None,
+        distance_func=None):
+    """
+    Normalized DTW distance between two routes.
+
+    step_pattern is one of DTW_STEP_PATTERNS.
+    window is the Sakoe-Chiba band width in points; None for no band.
+    max_distance abandons the computation as soon as the distance is known to
+    be larger, and returns inf instead.
+    """
+    if len(route1) == 0 or len(route2) == 0:
+        return np.inf
+    cost = get_cost_matrix(route1, route2, distance_func)
+    n, m = cost.shape
+    normalization = _dtw_normalization(step_pattern, n, m)
+    max_cost = max_distance * normalization if max_distance is not None else None
+    acc = dtw_accumulated_cost(cost, step_pattern, window, max_cost)
+    if acc is None or np.isinf(acc[-1, -1]):
+        return np.inf
+    if step_pattern == "path":
+        distance = acc[-1, -1] / len(dtw_path(acc))
+    else:
+        distance = acc[-1, -1] / normalization
+    if max_distance is not None and distance > max_distance:
+        return np.inf
+    return distance
+
+def frechet(route1, route2, res=None, distance_func=None):
+    """
+    Estimate of the Frechet distance with resolution res, same as the original
+    Frechet: the smallest of res thresholds between the smallest and largest
+    point distance at which the first and last pair of points are connected
+    through pairs that are within the threshold. Connectivity only grows with
+    the threshold, so this does a binary search over the thresholds instead of
+    trying every one of them.
+    """
+    cost = get_cost_matrix(route1, route2, distance_func)
+    if res is None:
+        res = 1000
+    thresholds = np.linspace(cost.min(), cost.max(), res)
+
+    def connected(q):
+        labels = ndimage.label(cost <= q)[0]
+        return labels[0, 0] != 0 and labels[0, 0] == labels[-1, -1]
+
+    lo, hi = 0, len(thresholds) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if connected(thresholds[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return thresholds[lo]
+
+def lcs(route1, route2, radius, distance_func=None):
+    """
+    Length of the longest common subsequence of the two routes, where two
+    points match if they are within radius meters of each other.
+    """
+    matches = get_cost_matrix(route1, route2, distance_func) <= radius
+    lengths = np.zeros(len(route2) + 1, dtype=int)
+    for match in matches:
+        # a match always extends the diagonal, so the row is a running
+        # maximum of the diagonal + 1 for matches and the value above otherwise
+        candidates = np.where(match, lengths[:-1] + 1, lengths[1:])
+        lengths[1:] = np.maximum.accumulate(candidates)
+    return int(lengths[-1])
+
+def lcs_score(route1, route2, radius, distance_func=None):
+    return 1 - lcs(route1, route2, radius, distance_func) / min(len(route1), len(route2))
+
+# Measures used by route_matching, keyed by its method names. Each one takes
+# two routes and the matching radius.
+ROUTE_DISTANCE_FUNCS = {
+    "dtw": lambda r1, r2, radius: dtw(r1, r2, "sum"),
+    "DTW": lambda r1, r2, radius: dtw(downsample(r1), downsample(r2), "path"),
+    "DTWSym": lambda r1, r2, radius: dtw(r1, r2, "symmetric"),
+    "DTWAsym": lambda r1, r2, radius: dtw(r1, r2, "asymmetric"),
+    "Frechet": lambda r1, r2, radius: frechet(r1, r2),
+    "lcs": lambda r1, r2, radius: lcs_score(r1, r2, radius),
+}
+
+# The measures for which distance(r1, r2) == distance(r2, r1) by definition
+SYMMETRIC_METHODS = ["dtw", "DTWSym", "Frechet", "lcs"]
+
+def route_distance(route1, route2, method="lcs", radius=2000):
+    return ROUTE_DISTANCE_FUNCS[method](route1, route2, radius)
+
+def route_distance_matrix(routes, method="lcs", radius=2000, pairs=None, columns=None):
+    """
+    Distances between all pairs of routes, or between routes (rows) and
+    columns if that is a different list of routes. The routes are converted
+    to arrays once, and for symmetric methods every pair of routes is only
+    computed once. If pairs is a list of (row, column) index pairs, only those
+    are computed and the rest of the matrix is NaN.
+    """
+    row_coords = [to_coords(route) for route in routes]
+    if columns is None or columns is routes:
+        col_coords = row_coords
+        symmetric = method in SYMMETRIC_METHODS
+    else:
+        col_coords = [to_coords(route) for route in columns]
+        symmetric = False
+    distances = np.full((len(row_coords), len(col_coords)), np.nan)
+    if pairs is None:
+        pairs = [(i, j) for i in range(len(row_coords)) for j in range(len(col_coords))]
+    for i, j in pairs:
+        if not np.isnan(distances[i, j]):
+            continue
+        distances[i, j] = route_distance(row_coords[i], col_coords[j], method, radius)
+        if symmetric:
+            distances[j, i] = distances[i, j]
+    logging.debug("Computed %s distances between %s and %s routes" %
+                  (len(pairs), len(row_coords), len(col_coords)))
+    return distances
@@ -1,9 +1,12 @@
 # Standard imports
 import jsonpickle as jpickle
 import logging
+import collections
+import copy
 
 # Our imports
 import emission.storage.timeseries.abstract_timeseries as esta
+import emission.analysis.modelling.tour_model.load_predict as eamtl
 import emission.analysis.modelling.tour_model.similarity as similarity
 import emission.analysis.modelling.tour_model.similarity as similarity
 import emission.analysis.modelling.tour_model.data_preprocessing as preprocess
@@ -46,17 +49,10 @@ def in_bin(bin_location_features,new_trip_location_feat,radius):
 def find_bin(trip, bin_locations, radius):
     trip_feat = preprocess.extract_features([trip])[0]
     trip_loc_feat = trip_feat[0:4]
-    first_round_label_set = list(bin_locations.keys())
-    sel_fl = None
-    for fl in first_round_label_set:
-        # extract location features of selected bin
-        sel_loc_feat = bin_locations[fl]
-        # Check if start/end locations of the new trip and every start/end locations in this bin are within the range of
-        # radius. If so, the new trip falls in this bin. Then predict the second round label of the new trip
-        # using this bin's model
-        if in_bin(sel_loc_feat, trip_loc_feat, radius):
-            sel_fl = fl
-            break
+    # Check if start/end locations of the new trip and every start/end locations in a bin are within the range of
+    # radius. If so, the new trip falls in this bin. Then predict the second round label of the new trip
+    # using this bin's model
+    sel_fl = eamtl.find_bin_vectorized(eamtl.get_bin_index(bin_locations), trip_loc_feat, radius)
     if not sel_fl:
         logging.debug(f"sel_fl = {sel_fl}, early return")
         return -1
@@ -64,53 +60,83 @@ def find_bin(trip, bin_locations, radius):
 
 # Predict labels and also return the number of trips in the matched cluster
 def predict_labels_with_n(trip):
-    user = trip['user_id']
-    logging.debug(f"At stage: extracting features")
-    trip_feat = preprocess.extract_features([trip])[0]
-    trip_loc_feat = trip_feat[0:4]
-    logging.debug(f"At stage: loading model")
-    try:
-        # load locations of bins(1st round of clustering)
-        # e.g.{'0': [[start lon1, start lat1, end lon1, end lat1],[start lon, start lat, end lon, end lat]]}
-        # another explanation: -'0': label from the 1st round
-        #                      - the value of key '0': all trips that in this bin
-        #                      - for every trip: the coordinates of start/end locations
-        bin_locations = loadModelStage('locations_first_round_' + str(user))
-
-        # load user labels in all clusters
-        # assume that we have 1 cluster(bin) from the 1st round of clustering, which has label '0',
-        # and we have 1 cluster from the 2nd round, which has label '1'
-        # the value of key '0' contains all 2nd round clusters
-        # the value of key '1' contains all user labels and probabilities in this cluster
-        # e.g. {'0': [{'1': [{'labels': {'mode_confirm': 'shared_ride', 'purpose_confirm': 'home', 'replaced_mode': 'drove_alone'}}]}]}
-        user_labels = loadModelStage('user_labels_first_round_' + str(user))
-
-        # Get the number of trips in each cluster from the number of locations in each bin
-        # This is a bit hacky; in the future, we might want the model stage to save a metadata file with this and potentially other information
-        cluster_sizes = {k: len(bin_locations[k]) for k in bin_locations}
-
-    except IOError as e:
-        logging.info(f"No models found for {user}, no prediction")
-        return [], -1
-
-
-    logging.debug(f"At stage: first round prediction")
-    pred_bin = find_bin(trip, bin_locations, RADIUS)
-    logging.debug(f"At stage: matched with bin {pred_bin}")
-
-    if pred_bin == -1:
-        logging.info(f"No match found for {trip['data']['start_fmt_time']} early return")
-        return [], 0
-
-    user_input_pred_list = user_labels[pred_bin]
-    this_cluster_size = cluster_sizes[pred_bin]
-    logging.debug(f"At stage: looked up user input {user_input_pred_list}")
-    return user_input_pred_list, this_cluster_size
+    return predict_labels_with_n_batch([trip])[0]
+
+def load_user_models(user):
+    """
+    The (bin_locations, user_labels, cluster_sizes) of the user, see
+    predict_labels_with_n, from the model cache
+    """
+    # load locations of bins(1st round of clustering)
+    # e.g.{'0': [[start lon1, start lat1, end lon1, end lat1],[start lon, start lat, end lon, end lat]]}
+    # another explanation: -'0': label from the 1st round
+    #                      - the value of key '0': all trips that in this bin
+    #                      - for every trip: the coordinates of start/end locations
+    bin_locations = eamtl.loadModelStageCached('locations_first_round_' + str(user))
+
+    # load user labels in all clusters
+    # assume that we have 1 cluster(bin) from the 1st round of clustering, which has label '0',
+    # and we have 1 cluster from the 2nd round, which has label '1'
+    # the value of key '0' contains all 2nd round clusters
+    # the value of key '1' contains all user labels and probabilities in this cluster
+    # e.g. {'0': [{'1': [{'labels': {'mode_confirm': 'shared_ride', 'purpose_confirm': 'home', 'replaced_mode': 'drove_alone'}}]}]}
+    user_labels = eamtl.loadModelStageCached('user_labels_first_round_' + str(user))
+
+    # Get the number of trips in each cluster from the number of locations in each bin
+    # This is a bit hacky; in the future, we might want the model stage to save a metadata file with this and potentially other information
+    cluster_sizes = {k: len(bin_locations[k]) for k in bin_locations}
+    return bin_locations, user_labels, cluster_sizes
+
+def predict_labels_with_n_batch(trips):
+    """
+    Same as calling predict_labels_with_n for each trip, but the models of
+    each user are loaded and the bins indexed once for all their trips
+    """
+    predictions = [None] * len(trips)
+    trip_idx_by_user = collections.OrderedDict()
+    for i, trip in enumerate(trips):
+        trip_idx_by_user.setdefault(trip['user_id'], []).append(i)
+
+    for user, trip_idx_list in trip_idx_by_user.items():
+        logging.debug(f"At stage: loading model")
+        try:
+            bin_locations, user_labels, cluster_sizes = load_user_models(user)
+        except IOError as e:
+            logging.info(f"No models found for {user}, no prediction")
+            for i in trip_idx_list:
+                predictions[i] = ([], -1)
+            continue
+
+        bin_index = eamtl.get_bin_index(bin_locations)
+        logging.debug(f"At stage: extracting features")
+        trip_feats = preprocess.extract_features([trips[i] for i in trip_idx_list])
+        for i, trip_feat in zip(trip_idx_list, trip_feats):
+            logging.debug(f"At stage: first round prediction")
+            # same as find_bin, with the bins indexed once for all the trips
+            pred_bin = eamtl.find_bin_vectorized(bin_index, trip_feat[0:4], RADIUS)
+            if not pred_bin:
+                pred_bin = -1
+            logging.debug(f"At stage: matched with bin {pred_bin}")
+
+            if pred_bin == -1:
+                logging.info(f"No match found for {trips[i]['data']['start_fmt_time']} early return")
+                predictions[i] = ([], 0)
+                continue
+
+            # copied, since the loaded models are shared through the cache
+            user_input_pred_list = copy.deepcopy(user_labels[pred_bin])
+            this_cluster_size = cluster_sizes[pred_bin]
+            logging.debug(f"At stage: looked up user input {user_input_pred_list}")
+            predictions[i] = (user_input_pred_list, this_cluster_size)
+    return predictions
 
 # For backwards compatibility
 def predict_labels(trip):
     return predict_labels_with_n(trip)[0]
 
+def predict_labels_batch(trips):
+    return [labels for (labels, n) in predict_labels_with_n_batch(trips)]
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
         level=logging.DEBUG)
@@ -0,0 +1,116 @@
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+# Standard imports
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+import logging
+import numpy as np
+
+# Vectorized counterparts of the per-pair functions in
+# emission.analysis.point_features. They work on numpy arrays of coordinates
+# instead of pairs of AttrDicts, so that a whole trace can be processed in a
+# single pass. They use the same formulas as the per-pair versions, so the
+# results match.
+
+EARTH_RADIUS = 6371000
+
+def calDistances(lon1, lat1, lon2, lat2):
+    """
+    Haversine distance in meters between (lon1, lat1) and (lon2, lat2), same
+    as emission.core.common.calDistance. The arguments can be arrays or
+    scalars and are broadcast against each other.
+    """
+    lon1 = np.asarray(lon1, dtype=float)
+    lat1 = np.asarray(lat1, dtype=float)
+    lon2 = np.asarray(lon2, dtype=float)
+    lat2 = np.asarray(lat2, dtype=float)
+    dLat = np.radians(lat1 - lat2)
+    dLon = np.radians(lon1 - lon2)
+    a = (np.sin(dLat / 2) ** 2) + ((np.sin(dLon / 2) ** 2) * np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)))
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS * c
+
+def calLaggedDistances(lon, lat, max_lag):
+    """
+    Distances from every point to each of the max_lag points before it.
+    Returns an array of shape (len(lon), max_lag + 1) where [i, k] is the
+    distance from point i - k to point i, and NaN where i - k < 0.
+    The windows are strided views, so the only copies are the padded
+    coordinates and the result.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    if len(lon) == 0:
+        return np.empty((0, max_lag + 1))
+    padding = np.full(max_lag, np.nan)
+    # reverse the windows so that column k is the point k steps back
+    lagged_lon = np.lib.stride_tricks.sliding_window_view(
+        np.concatenate([padding, lon]), max_lag + 1)[:, ::-1]
+    lagged_lat = np.lib.stride_tricks.sliding_window_view(
+        np.concatenate([padding, lat]), max_lag + 1)[:, ::-1]
+    return calDistances(lagged_lon, lagged_lat, lon[:, np.newaxis], lat[:, np.newaxis])
+
+def calHeadings(lon1, lat1, lon2, lat2):
+    """
+    Initial bearing in degrees from (lon1, lat1) to (lon2, lat2), same as
+    emission.analysis.section_features.calHeading.
+    """
+    phi1 = np.radians(np.asarray(lat1, dtype=float))
+    phi2 = np.radians(np.asarray(lat2, dtype=float))
+    lambda1 = np.radians(np.asarray(lon1, dtype=float))
+    lambda2 = np.radians(np.asarray(lon2, dtype=float))
+
+    y = np.sin(lambda2-lambda1) * np.cos(phi2)
+    x = np.cos(phi1)*np.sin(phi2) - \
+        np.sin(phi1)*np.cos(phi2)*np.cos(lambda2-lambda1)
+    return np.degrees(np.arctan2(y, x))
+
+def calSpeeds(distances, time_deltas):
+    """
+    distances / time_deltas, with a speed of 0 where the time delta is 0,
+    same as emission.analysis.point_features.calSpeed
+    """
+    distances = np.asarray(distances, dtype=float)
+    time_deltas = np.asarray(time_deltas, dtype=float)
+    same_time = time_deltas == 0
+    moved = np.count_nonzero(same_time & (distances > 0.01))
+    if moved > 0:
+        # https://github.com/e-mission/e-mission-server/issues/407#issuecomment-248974661
+        logging.warning("%s pairs of points are more than 0.01 m apart, although the time delta = 0" % moved)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(same_time, 0, distances / time_deltas)
+
+def calPointKinematics(lon, lat, ts):
+    """
+    Distance, speed and heading between each point and its previous point for
+    a whole trace. Returns three arrays of the same length as the input, whose
+    first elements are zero.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    ts = np.asarray(ts, dtype=float)
+    distances = np.zeros(len(lon))
+    speeds = np.zeros(len(lon))
+    headings = np.zeros(len(lon))
+    if len(lon) > 1:
+        distances[1:] = calDistances(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        speeds[1:] = calSpeeds(distances[1:], np.diff(ts))
+        headings[1:] = calHeadings(lon[:-1], lat[:-1], lon[1:], lat[1:])
+    return distances, speeds, headings
+
+def calHeadingChanges(lon, lat):
+    """
+    Heading changes for a whole trace. Element i is the heading change at
+    point i - 1, between points i - 2, i - 1 and i, same as
+    emission.analysis.section_features.calHC. The first two elements are zero.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    hcs = np.zeros(len(lon))
+    if len(lon) > 2:
+        headings = calHeadings(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        hcs[2:] = headings[1:] - headings[:-1]
+    return hcs
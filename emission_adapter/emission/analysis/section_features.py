@@ -73,12 +73,17 @@ def calHC(point1, point2, point3):
     HC = calHeading(point2, point3) - calHeading(point1, point2)
     return HC
 
-def calHCR(section_entry):
+def calHCR(section_entry, locations=None):
+    """
+    locations are the recreated locations of the section, which are read
+    from the timeseries if they are not passed in
+    """
     section = section_entry.data
 
-    ts = esta.TimeSeries.get_time_series(section_entry.user_id)
-    tq = esda.get_time_query_for_trip_like_object(section)
-    locations = list(ts.find_entries(["analysis/recreated_location"], tq))
+    if locations is None:
+        ts = esta.TimeSeries.get_time_series(section_entry.user_id)
+        tq = esda.get_time_query_for_trip_like_object(section)
+        locations = list(ts.find_entries(["analysis/recreated_location"], tq))
 
     if len(locations) < 3:
         return 0
@@ -25,6 +25,8 @@ def populate_expectations(user_id):
                 last_trip_done = expected_trip
     
     try:
+        # the expected trips are buffered, write them before recording progress
+        ts.flush()
         if last_trip_done is None:
             logging.debug("After run, last_trip_done == None, must be early return")
         epq.mark_expectation_population_done(user_id, last_trip_done)
@@ -44,7 +46,7 @@ def _process_and_save_trip(user_id, inferred_trip, ts):
     expected_trip["data"]["inferred_trip"] = inferred_trip.get_id()
     expected_trip["data"]["expectation"] = expectation
     expected_trip["data"]["confidence_threshold"] = confidence_threshold
-    ts.insert(expected_trip)
+    ts.insert_buffered(expected_trip)
     return expected_trip  # Fixes https://github.com/e-mission/e-mission-docs/issues/654
 
 # This is a placeholder. TODO: implement the real algorithm
@@ -4,6 +4,7 @@ import copy
 # Get the configuration for the classifier
 import emission.analysis.config as eac
 
+import emission.core.get_database as edb
 import emission.storage.timeseries.abstract_timeseries as esta
 import emission.storage.decorations.analysis_timeseries_queries as esda
 import emission.storage.decorations.trip_queries as esdt
@@ -34,17 +35,22 @@ def match_incoming_inputs(user_id, timerange):
     if len(toMatchInputs) == 0:
         logging.debug("len(toMatchInputs) == 0, early return")
         return None
-    for ui in toMatchInputs:
-        confirmed_trip = esdt.get_trip_for_user_input_obj(ts, ui)
+    # All the inputs are matched against one read of the candidate trips, and
+    # a trip that matches several inputs is only written once, with all of them
+    confirmed_trips = esdt.get_trips_for_user_input_objs(ts, toMatchInputs)
+    updated_trip_map = {}
+    for ui, confirmed_trip in zip(toMatchInputs, confirmed_trips):
         if confirmed_trip is not None:
             input_name = obj_to_dict_key(ui.metadata.key)
             confirmed_trip["data"]["user_input"][input_name] = ui.data.label
-            import emission.storage.timeseries.builtin_timeseries as estbt
-            estbt.BuiltinTimeSeries.update(confirmed_trip)
+            updated_trip_map[confirmed_trip.get_id()] = confirmed_trip
         else:
             logging.warn("No match found for user input %s, moving forward anyway" % ui)
         lastInputProcessed = ui
 
+    logging.debug("Updating %d confirmed trips" % len(updated_trip_map))
+    edb.save_all(ts.get_timeseries_db("analysis/confirmed_trip"),
+                 list(updated_trip_map.values()))
     return lastInputProcessed
 
 
@@ -71,28 +77,38 @@ def create_confirmed_trips(user_id, timerange):
         logging.debug("len(toConfirmTrips) == 0, early return")
         return None
     input_key_list = eac.get_config()["userinput.keylist"]
-    for tct in toConfirmTrips:
+    user_input_dicts = get_user_input_dicts(ts, toConfirmTrips, input_key_list)
+    for tct, user_input_dict in zip(toConfirmTrips, user_input_dicts):
         # Copy the trip and fill in the new values
         confirmed_trip_dict = copy.copy(tct)
         del confirmed_trip_dict["_id"]
         confirmed_trip_dict["metadata"]["key"] = "analysis/confirmed_trip"
         confirmed_trip_dict["data"]["expected_trip"] = tct.get_id()
-        confirmed_trip_dict["data"]["user_input"] = \
-            get_user_input_dict(ts, tct, input_key_list)
-        confirmed_trip_entry = ecwe.Entry(confirmed_trip_dict)
-        # save the entry
-        ts.insert(confirmed_trip_entry)
-        # if everything is successful, then update the last successful trip
-        lastTripProcessed = tct
+        confirmed_trip_dict["data"]["user_input"] = user_input_dict
+        ts.insert_buffered(ecwe.Entry(confirmed_trip_dict))
+    # save the entries, this raises if any of them could not be written
+    ts.flush()
+    # if everything is successful, then update the last successful trip
+    lastTripProcessed = toConfirmTrips[-1]
 
     return lastTripProcessed
 
 def get_user_input_dict(ts, tct, input_key_list):
-    tct_userinput = {}
-    for ikey in input_key_list:
-        matched_userinput = esdt.get_user_input_for_trip_object(ts, tct, ikey)
-        if matched_userinput is not None:
-            ikey_name = obj_to_dict_key(ikey)
-            tct_userinput[ikey_name] = matched_userinput.data.label
-    logging.debug("for trip %s, returning user input dict %s" % (tct.get_id(), tct_userinput))
-    return tct_userinput
+    return get_user_input_dicts(ts, [tct], input_key_list)[0]
+
+def get_user_input_dicts(ts, tct_list, input_key_list):
+    """
+    The user input dict (input name -> label) of each trip in tct_list, with
+    the user inputs for all the trips read at once
+    """
+    tct_userinput_list = []
+    matched_userinput_maps = esdt.get_user_inputs_for_trip_objects(ts, tct_list, input_key_list)
+    for tct, matched_userinput_map in zip(tct_list, matched_userinput_maps):
+        tct_userinput = {}
+        for ikey in input_key_list:
+            if ikey in matched_userinput_map:
+                ikey_name = obj_to_dict_key(ikey)
+                tct_userinput[ikey_name] = matched_userinput_map[ikey].data.label
+        logging.debug("for trip %s, returning user input dict %s" % (tct.get_id(), tct_userinput))
+        tct_userinput_list.append(tct_userinput)
+    return tct_userinput_list
@@ -9,6 +9,7 @@ from pymongo import MongoClient
 import pymongo
 import os
 import json
+import threading
 
 try:
     config_file = open('conf/storage/db.conf')
@@ -19,15 +20,51 @@ except:
 config_data = json.load(config_file)
 url = config_data["timeseries"]["url"]
 result_limit = config_data["timeseries"]["result_limit"]
+# Passed through to MongoClient, e.g. {"maxPoolSize": 100, "minPoolSize": 10}
+pool_config = config_data["timeseries"].get("pool", {})
+# The user ids are stored as UUIDs in the legacy python representation (binary
+# subtype 3), which was the pymongo default before 4.0. Newer versions of
+# pymongo cannot store UUIDs at all unless the representation is configured.
+client_config = dict(pool_config, uuidRepresentation="pythonLegacy")
+# If this is false, the indices are not checked when a collection is first
+# used, and have to be created with `python -m emission.core.get_database`
+create_indices_on_first_use = config_data["timeseries"].get("create_indices_on_first_use", True)
 config_file.close()
 
 print("Connecting to database URL "+url)
-_current_db = MongoClient(url).Stage_database
+_current_db = MongoClient(url, **client_config).Stage_database
 #config_file.close()
 
+# Collections whose indices have already been created in this process.
+# create_index is idempotent, but every call is a round trip to the database,
+# and the analysis timeseries alone has ~30 indices.
+_indexed_collections = {}
+_indexed_collections_lock = threading.Lock()
+
 def _get_current_db():
     return _current_db
 
+def _reset_indexed_collections():
+    """
+    Forget the collections whose indices have been created, so that they are
+    created again on next use. Needed when the database is switched or its
+    collections are dropped.
+    """
+    with _indexed_collections_lock:
+        _indexed_collections.clear()
+
+def _get_indexed_collection(coll_name, create_indices):
+    coll = _indexed_collections.get(coll_name)
+    if coll is not None:
+        return coll
+    with _indexed_collections_lock:
+        if coll_name not in _indexed_collections:
+            coll = _get_current_db()[coll_name]
+            if create_indices_on_first_use:
+                create_indices(coll)
+            _indexed_collections[coll_name] = coll
+        return _indexed_collections[coll_name]
+
 def get_mode_db():
     # #current_db = MongoClient().Stage_database
     Modes= _get_current_db().Stage_Modes
@@ -147,25 +184,29 @@ def get_perturbed_trips_db():
 
 def get_usercache_db():
     #current_db = MongoClient().Stage_database
-    UserCache = _get_current_db().Stage_usercache
+    UserCache = _get_indexed_collection("Stage_usercache", _create_usercache_indices)
+    return UserCache
+
+def _create_usercache_indices(UserCache):
     UserCache.create_index([("user_id", pymongo.ASCENDING)])
     UserCache.create_index([("metadata.type", pymongo.ASCENDING)])
     UserCache.create_index([("metadata.key", pymongo.ASCENDING)])
     UserCache.create_index([("metadata.write_ts", pymongo.DESCENDING)])
     UserCache.create_index([("data.ts", pymongo.DESCENDING)], sparse=True)
-    return UserCache
 
 def get_timeseries_db():
     #current_db = MongoClient().Stage_database
-    TimeSeries = _get_current_db().Stage_timeseries
+    TimeSeries = _get_indexed_collection("Stage_timeseries", _create_timeseries_indices)
+    return TimeSeries
+
+def _create_timeseries_indices(TimeSeries):
     TimeSeries.create_index([("user_id", pymongo.HASHED)])
     TimeSeries.create_index([("metadata.key", pymongo.HASHED)])
     TimeSeries.create_index([("metadata.write_ts", pymongo.DESCENDING)])
     TimeSeries.create_index([("data.ts", pymongo.DESCENDING)], sparse=True)
 
     TimeSeries.create_index([("data.loc", pymongo.GEOSPHERE)], sparse=True)
-
-    return TimeSeries
+    _create_query_indices(TimeSeries, TIMESERIES_QUERY_TIME_KEYS)
 
 def get_timeseries_error_db():
     #current_db = MongoClient().Stage_database
@@ -177,20 +218,38 @@ def get_analysis_timeseries_db():
     " Stores the results of the analysis performed on the raw timeseries
     """
     #current_db = MongoClient().Stage_database
-    AnalysisTimeSeries = _get_current_db().Stage_analysis_timeseries
-    AnalysisTimeSeries.create_index([("user_id", pymongo.HASHED)])
-    _create_analysis_result_indices(AnalysisTimeSeries)
+    AnalysisTimeSeries = _get_indexed_collection("Stage_analysis_timeseries",
+        _create_analysis_timeseries_indices)
     return AnalysisTimeSeries
 
 def get_non_user_timeseries_db():
     """
     " Stores the data that is not associated with a particular user
     """
-    NonUserTimeSeries = _get_current_db().Stage_analysis_timeseries
-    NonUserTimeSeries.create_index([("user_id", pymongo.HASHED)])
-    _create_analysis_result_indices(NonUserTimeSeries)
+    NonUserTimeSeries = _get_indexed_collection("Stage_analysis_timeseries",
+        _create_analysis_timeseries_indices)
     return NonUserTimeSeries
 
+def _create_analysis_timeseries_indices(tscoll):
+    tscoll.create_index([("user_id", pymongo.HASHED)])
+    _create_analysis_result_indices(tscoll)
+    _create_query_indices(tscoll, ANALYSIS_TIMESERIES_QUERY_TIME_KEYS)
+
+# The time fields that the timeseries are queried and sorted by. The
+# queries built by BuiltinTimeSeries are an equality on user_id and
+# metadata.key and a range on one of these fields, sorted by the same field,
+# so a compound index per time field serves both the filter and the sort.
+# Queries without a time query are sorted by metadata.write_ts.
+TIMESERIES_QUERY_TIME_KEYS = ["metadata.write_ts", "data.ts"]
+ANALYSIS_TIMESERIES_QUERY_TIME_KEYS = ["metadata.write_ts", "data.ts",
+    "data.start_ts", "data.end_ts", "data.enter_ts", "data.exit_ts"]
+
+def _create_query_indices(tscoll, time_keys):
+    for time_key in time_keys:
+        tscoll.create_index([("user_id", pymongo.ASCENDING),
+                             ("metadata.key", pymongo.ASCENDING),
+                             (time_key, pymongo.ASCENDING)])
+
 def _create_analysis_result_indices(tscoll):
     tscoll.create_index([("metadata.key", pymongo.HASHED)])
 
@@ -249,6 +308,17 @@ def get_common_trip_db():
     CommonTrips = _get_current_db().Stage_common_trips
     return CommonTrips
 
+def get_geocode_cache_db():
+    """
+    " Reverse geocoding results, see emission.net.ext_service.geocoder.reverse_cache
+    """
+    GeocodeCache = _get_indexed_collection("Stage_geocode_cache",
+        _create_geocode_cache_indices)
+    return GeocodeCache
+
+def _create_geocode_cache_indices(GeocodeCache):
+    GeocodeCache.create_index([("key", pymongo.ASCENDING)], unique=True)
+
 def get_fake_trips_db():
     #current_db = MongoClient().Stage_database
     FakeTrips = _get_current_db().Stage_fake_trips
@@ -270,3 +340,28 @@ def save(db, entry):
     else:
         result = db.insert_one(entry)
         # logging.debug("entry has id, calling without match, result = %s" % result.inserted_id)
+
+# Same as calling save() for every entry, but in one round trip
+def save_all(db, entries):
+    if len(entries) == 0:
+        return
+    db.bulk_write([pymongo.ReplaceOne({'_id': entry['_id']}, entry, upsert=True)
+                   if '_id' in entry else pymongo.InsertOne(entry)
+                   for entry in entries])
+
+def create_all_indices():
+    """
+    Creates the indices of all the collections that have them. Run this once
+    after setting up or upgrading the database if the indices are not created
+    on first use.
+    """
+    for coll_name, create_indices in [
+            ("Stage_usercache", _create_usercache_indices),
+            ("Stage_timeseries", _create_timeseries_indices),
+            ("Stage_analysis_timeseries", _create_analysis_timeseries_indices),
+            ("Stage_geocode_cache", _create_geocode_cache_indices)]:
+        print("Creating indices for %s" % coll_name)
+        create_indices(_get_current_db()[coll_name])
+
+if __name__ == '__main__':
+    create_all_indices()
@@ -113,6 +113,14 @@ class WrapperBase(ad.AttrDict):
     parentResult = super(WrapperBase, self).__repr__()
     return parentResult.replace("AttrDict", self.__class__.__name__)
 
+  def __reduce__(self):
+    """
+    AttrDict pickles its configuration (sequence type, recursion) as
+    attributes, which __setattr__ rejects since they are not props. Pickle
+    (e.g. to pass wrappers between processes) just the underlying dict instead.
+    """
+    return (self.__class__, (dict(self),))
+
   def __call__(self, key):
     print("_call called with %s, %s" % (self, key))
     return super(WrapperBase, self).__call__(key)
@@ -20,9 +20,13 @@ try:
 except:
     print("google maps key not configured, falling back to nominatim")
 
+# Overrides of reverse_cache.CACHE_CONFIG_DEFAULTS
+NOMINATIM_CACHE_CONFIG = {}
 try:
     nominatim_file = open("conf/net/ext_service/nominatim.json")
-    NOMINATIM_QUERY_URL = json.load(nominatim_file)["query_url"]
+    nominatim_config = json.load(nominatim_file)
+    NOMINATIM_QUERY_URL = nominatim_config["query_url"]
+    NOMINATIM_CACHE_CONFIG = nominatim_config.get("cache", {})
     nominatim_file.close()
 except:
     print("nominatim not configured either, place decoding must happen on the client")
@@ -79,9 +83,12 @@ class Geocoder(object):
         return url
 
     @classmethod
-    def get_json_reverse(cls, lat, lng):
+    def get_json_reverse(cls, lat, lng, timeout=None):
         request = urllib.request.Request(cls.make_url_reverse(lat, lng))
-        response = urllib.request.urlopen(request)
+        if timeout is None:
+            response = urllib.request.urlopen(request)
+        else:
+            response = urllib.request.urlopen(request, timeout=timeout)
         parsed_response = json.loads(response.read())
         logging.debug("parsed_response = %s" % parsed_response)
         return parsed_response
@@ -0,0 +1,164 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+# Standard imports
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+import logging
+import time
+import collections
+import threading
+import concurrent.futures as cf
+import pymongo
+
+# Our imports
+import emission.core.get_database as edb
+import emission.net.ext_service.geocoder.nominatim as eco
+
+# Users go back to the same places every day, so most of the places that we
+# reverse geocode have been looked up before. The results are cached in the
+# database, keyed by the coordinates rounded to `precision` decimal places
+# (4 decimal places is ~10 meters), and the lookup is done for the rounded
+# coordinates so that every point in the same key gets the same result. The
+# most recently used results are also kept in memory.
+#
+# If the geocoder fails or times out, there are no lookups for `backoff_secs`,
+# and the places are saved without a name, which the client then fills in.
+
+CACHE_CONFIG_DEFAULTS = {
+    "precision": 4,
+    "ttl_secs": 30 * 24 * 60 * 60,
+    "timeout_secs": 5,
+    "max_workers": 4,
+    "backoff_secs": 5 * 60
+}
+
+MEMORY_CACHE_SIZE = 10000
+# key -> (write_ts, result)
+_memory_cache = collections.OrderedDict()
+_memory_cache_lock = threading.Lock()
+# no lookups until this time, after a failure
+_backoff_until = 0
+
+def get_config():
+    config = dict(CACHE_CONFIG_DEFAULTS)
+    config.update(eco.NOMINATIM_CACHE_CONFIG)
+    return config
+
+def get_rounded(lat, lon, precision):
+    if precision is None:
+        return (lat, lon)
+    return (round(lat, precision), round(lon, precision))
+
+def get_key(rounded_lat, rounded_lon):
+    return "%s,%s" % (repr(float(rounded_lat)), repr(float(rounded_lon)))
+
+def clear_memory_cache():
+    """
+    Clears the memory cache and the backoff, e.g. between tests
+    """
+    global _backoff_until
+    with _memory_cache_lock:
+        _memory_cache.clear()
+    _backoff_until = 0
+
+def get_json_reverse(lat, lon):
+    """
+    Same as Geocoder.get_json_reverse for the rounded coordinates, but from
+    the cache if possible. Returns None if the lookup fails.
+    """
+    return get_json_reverse_batch([(lat, lon)])[0]
+
+def get_json_reverse_batch(coord_list):
+    """
+    Reverse geocodes a list of (lat, lon). The results are read from the
+    memory cache, then from the database, and the remaining rounded
+    coordinates are looked up concurrently, with at most max_workers requests
+    in flight. Returns the list of results, with None for the lookups that
+    failed.
+    """
+    config = get_config()
+    rounded_list = [get_rounded(lat, lon, config["precision"]) for (lat, lon) in coord_list]
+    key_list = [get_key(*rounded) for rounded in rounded_list]
+    rounded_map = dict(zip(key_list, rounded_list))
+    min_write_ts = time.time() - config["ttl_secs"]
+
+    results = _get_from_memory(list(rounded_map.keys()), min_write_ts)
+    missing_keys = [k for k in rounded_map if k not in results]
+    if len(missing_keys) > 0:
+        db_results = _get_from_db(missing_keys, min_write_ts)
+        _add_to_memory(db_results)
+        results.update({k: result for k, (write_ts, result) in db_results.items()})
+        missing_keys = [k for k in missing_keys if k not in results]
+
+    if len(missing_keys) > 0:
+        logging.debug("Reverse geocoding %d of %d places, the others are cached" %
+                      (len(missing_keys), len(rounded_map)))
+        fetch_fn = lambda k: _fetch(rounded_map[k], config)
+        n_workers = min(config["max_workers"], len(missing_keys))
+        if n_workers <= 1:
+            fetched_list = [fetch_fn(k) for k in missing_keys]
+        else:
+            with cf.ThreadPoolExecutor(max_workers=n_workers) as executor:
+                fetched_list = list(executor.map(fetch_fn, missing_keys))
+        write_ts = time.time()
+        fetched = {k: (write_ts, result)
+            for k, result in zip(missing_keys, fetched_list) if result is not None}
+        _save_to_db(fetched)
+        _add_to_memory(fetched)
+        results.update({k: result for k, (write_ts, result) in fetched.items()})
+
+    return [results.get(k) for k in key_list]
+
+def _get_from_memory(key_list, min_write_ts):
+    results = {}
+    with _memory_cache_lock:
+        for k in key_list:
+            cached = _memory_cache.get(k)
+            if cached is not None and cached[0] >= min_write_ts:
+                _memory_cache.move_to_end(k)
+                results[k] = cached[1]
+    return results
+
+def _add_to_memory(cached_map):
+    with _memory_cache_lock:
+        for k, cached in cached_map.items():
+            _memory_cache[k] = cached
+            _memory_cache.move_to_end(k)
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+def _get_from_db(key_list, min_write_ts):
+    try:
+        cursor = edb.get_geocode_cache_db().find(
+            {"key": {"$in": key_list}, "write_ts": {"$gte": min_write_ts}})
+        return {doc["key"]: (doc["write_ts"], doc["result"]) for doc in cursor}
+    except Exception as e:
+        logging.info("Unable to read cached reverse geocoding results: %s" % e)
+        return {}
+
+def _save_to_db(cached_map):
+    if len(cached_map) == 0:
+        return
+    try:
+        edb.get_geocode_cache_db().bulk_write([
+            pymongo.UpdateOne({"key": k},
+                {"$set": {"key": k, "write_ts": write_ts, "result": result}}, upsert=True)
+            for k, (write_ts, result) in cached_map.items()], ordered=False)
+    except Exception as e:
+        logging.info("Unable to cache reverse geocoding results: %s" % e)
+
+def _fetch(rounded, config):
+    global _backoff_until
+    if time.time() < _backoff_until:
+        return None
+    try:
+        return eco.Geocoder.get_json_reverse(rounded[0], rounded[1],
+                                             timeout=config["timeout_secs"])
+    except Exception as e:
+        logging.info("Reverse geocoding %s failed with %s, no lookups for %s secs" %
+                     (rounded, e, config["backoff_secs"]))
+        _backoff_until = time.time() + config["backoff_secs"]
+        return None
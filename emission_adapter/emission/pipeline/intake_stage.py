@@ -8,6 +8,7 @@ from builtins import str
 from builtins import *
 import json
 import logging
+import logging.config
 import numpy as np
 import arrow
 from uuid import UUID
@@ -48,6 +49,37 @@ def run_intake_pipeline(process_number, uuid_list):
     :param uuid_list: the list of UUIDs that this process will handle
     :return:
     """
+    _configure_intake_logging(process_number)
+
+    logging.info("processing UUID list = %s" % uuid_list)
+
+    for uuid in uuid_list:
+        _run_intake_pipeline_for_user_or_skip(uuid)
+
+def run_intake_pipeline_worker(process_number, job_queue, status_queue):
+    """
+    Run the intake pipeline for UUIDs pulled from a shared queue until it
+    returns None. Used by emission.pipeline.scheduler, so that a process that
+    finishes its users early picks up the next pending user instead of
+    sitting idle while another process works through a long list.
+    :param process_number: id representing the process number, used for the log file name
+    :param job_queue: multiprocessing queue of UUIDs, terminated by one None per worker
+    :param status_queue: multiprocessing queue that (process_number, uuid, "start"/"done")
+        is reported to, so that the scheduler can enforce per-user timeouts
+    :return:
+    """
+    _configure_intake_logging(process_number)
+
+    while True:
+        uuid = job_queue.get()
+        if uuid is None:
+            logging.info("No more UUIDs in the queue, exiting")
+            return
+        status_queue.put((process_number, uuid, "start"))
+        _run_intake_pipeline_for_user_or_skip(uuid)
+        status_queue.put((process_number, uuid, "done"))
+
+def _configure_intake_logging(process_number):
     try:
         with open("conf/log/intake.conf", "r") as cf:
             intake_log_config = json.load(cf)
@@ -63,22 +95,20 @@ def run_intake_pipeline(process_number, uuid_list):
     logging.config.dictConfig(intake_log_config)
     np.random.seed(61297777)
 
-    logging.info("processing UUID list = %s" % uuid_list)
+def _run_intake_pipeline_for_user_or_skip(uuid):
+    if uuid is None:
+        return
 
-    for uuid in uuid_list:
-        if uuid is None:
-            continue
-
-        # Skip entry with mixed time and distance filters
-        if uuid == UUID("2c3996d1-49b1-4dce-82f8-d0cda85d3475"):
-            continue
-
-        try:
-            run_intake_pipeline_for_user(uuid)
-        except Exception as e:
-            esds.store_pipeline_error(uuid, "WHOLE_PIPELINE", time.time(), None)
-            logging.exception("Found error %s while processing pipeline "
-                              "for user %s, skipping" % (e, uuid))
+    # Skip entry with mixed time and distance filters
+    if uuid == UUID("2c3996d1-49b1-4dce-82f8-d0cda85d3475"):
+        return
+
+    try:
+        run_intake_pipeline_for_user(uuid)
+    except Exception as e:
+        esds.store_pipeline_error(uuid, "WHOLE_PIPELINE", time.time(), None)
+        logging.exception("Found error %s while processing pipeline "
+                          "for user %s, skipping" % (e, uuid))
 
 def run_intake_pipeline_for_user(uuid):
         uh = euah.UserCacheHandler.getUserCacheHandler(uuid)
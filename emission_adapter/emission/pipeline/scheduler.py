@@ -8,15 +8,28 @@ from builtins import range
 from builtins import *
 import logging
 import multiprocessing as mp
+import queue
+import time
 import pandas as pd
+import pymongo
 from uuid import UUID
 
 import emission.core.get_database as edb
+import emission.core.wrapper.pipelinestate as ecwp
+import emission.analysis.config as eac
 import emission.net.usercache.abstract_usercache as enua
 import emission.storage.timeseries.aggregate_timeseries as estag
 import emission.storage.decorations.user_queries as esdu
+import emission.storage.decorations.stats_queries as esds
+import emission.storage.pipeline_queries as epq
 import emission.pipeline.intake_stage as epi
 
+# The raw entries that trip segmentation, the first expensive stage, reads
+PENDING_ENTRY_KEYS = ["background/location", "background/filtered_location"]
+# How long to wait for status reports from the workers before checking for
+# timeouts and exited workers
+STATUS_POLL_INTERVAL = 5
+
 def get_split_uuid_lists(n_splits):
     get_count = lambda u: enua.UserCache.getUserCache(u).getMessageCount()
 
@@ -72,5 +85,157 @@ def dispatch(split_lists):
         p.start()
         process_list.append(p)
 
+def get_pending_entry_count(user_id):
+    """
+    Number of raw locations that have been moved to the long-term timeseries
+    but not yet segmented into trips. The usercache count misses these, but
+    they are what the bulk of the pipeline has to work through.
+    """
+    query = {"user_id": user_id, "metadata.key": {"$in": PENDING_ENTRY_KEYS}}
+    curr_state = epq.get_current_state(user_id, ecwp.PipelineStages.TRIP_SEGMENTATION)
+    if curr_state is not None and curr_state.last_processed_ts is not None:
+        query["metadata.write_ts"] = {"$gt": curr_state.last_processed_ts}
+    return edb.get_timeseries_db().count_documents(query)
+
+def get_recent_pipeline_time(user_id):
+    """
+    Total time in seconds of the stages of the last pipeline run for this user,
+    from the stats/pipeline_time entries that intake_stage stores after every
+    stage. Zero if the pipeline has never run for this user.
+    """
+    n_stages = len(ecwp.PipelineStages)
+    recent_stats = edb.get_timeseries_db().find(
+        {"user_id": user_id, "metadata.key": "stats/pipeline_time"},
+        {"data.name": 1, "data.reading": 1}).sort(
+        "metadata.write_ts", pymongo.DESCENDING).limit(n_stages)
+    # only the latest reading of each stage, in case the last run was partial
+    last_readings = {}
+    for s in recent_stats:
+        last_readings.setdefault(s["data"]["name"], s["data"]["reading"])
+    return sum(r for r in last_readings.values() if r is not None)
+
+def get_job_costs(uuid_list, seconds_per_entry=None):
+    """
+    Estimated pipeline cost, in seconds, of each user in uuid_list: the time of
+    the last run plus seconds_per_entry for every entry that is pending in the
+    usercache or the timeseries. The recent time covers the fixed per-user
+    overhead (model loads, output generation) and the pending entries cover
+    the new data. Returns a dataframe sorted by decreasing cost.
+    """
+    if seconds_per_entry is None:
+        seconds_per_entry = eac.get_config()["pipeline.scheduler.secondsPerEntry"]
+    jobs = []
+    for u in uuid_list:
+        usercache_count = enua.UserCache.getUserCache(u).getMessageCount()
+        pending_count = get_pending_entry_count(u)
+        recent_time = get_recent_pipeline_time(u)
+        jobs.append((u, usercache_count, pending_count, recent_time,
+                     recent_time + seconds_per_entry * (usercache_count + pending_count)))
+    jobs_df = pd.DataFrame(jobs, columns=["user_id", "usercache_count",
+        "pending_count", "recent_time", "cost"])
+    # mergesort is stable, so users with equal costs stay in the input order
+    jobs_df = jobs_df.sort_values(by="cost", ascending=False, kind="mergesort")
+    logging.debug("Estimated total cost %s for %s users, max %s" %
+                  (jobs_df.cost.sum(), len(jobs_df), jobs_df.cost.max()))
+    return jobs_df
+
+def get_sorted_uuid_list(seconds_per_entry=None):
+    """
+    All users, most expensive first. Starting the longest jobs first keeps a
+    heavy user from being picked up at the end, when the other workers have
+    nothing left to do.
+    """
+    sel_uuids = esdu.get_all_uuids()
+    return get_job_costs(sel_uuids, seconds_per_entry).user_id.tolist()
+
+def _start_worker(ctx, process_number, job_queue, status_queue):
+    p = ctx.Process(target=epi.run_intake_pipeline_worker,
+                    args=(process_number, job_queue, status_queue))
+    p.start()
+    logging.info("Created worker %s with process number %s" % (p, process_number))
+    return p
+
+def dispatch_queue(uuid_list, n_workers=None, user_timeout=None):
+    """
+    Run the intake pipeline for uuid_list on n_workers processes that pull the
+    next user from a shared queue as soon as they are done with the previous
+    one, so that the wall clock time tracks the total work divided by the
+    workers instead of the slowest fixed partition. Pass the list in
+    decreasing order of cost (get_sorted_uuid_list).
+
+    A user that takes longer than user_timeout seconds is stopped by
+    terminating its worker. Since the worker cannot mark the stage that it
+    was in as failed, the stages of the user that are still marked as running
+    are marked as failed here, so that the next run starts them again. The
+    user gets a WHOLE_PIPELINE error, and a new worker with the same process
+    number takes over the rest of the queue. A worker that dies is handled in
+    the same way, unless it dies before it starts its first user. Blocks
+    until every user is done.
+    """
+    config = eac.get_config()
+    if n_workers is None:
+        n_workers = config["pipeline.scheduler.numWorkers"] or mp.cpu_count()
+    if user_timeout is None:
+        user_timeout = config["pipeline.scheduler.userTimeoutSecs"]
+
+    ctx = mp.get_context('spawn')
+    job_queue = ctx.Queue()
+    status_queue = ctx.Queue()
+    for u in uuid_list:
+        job_queue.put(u)
+    # one end marker per worker. A worker that is terminated or dies does not
+    # consume its marker, so its replacement will.
+    for i in range(n_workers):
+        job_queue.put(None)
 
+    workers = {i: _start_worker(ctx, i, job_queue, status_queue)
+               for i in range(n_workers)}
+    # process number -> (user_id, start_ts) of the user being processed
+    running = {}
+    # process numbers whose current worker has started at least one user
+    started = set()
+    while len(workers) > 0:
+        try:
+            process_number, user_id, status = status_queue.get(timeout=STATUS_POLL_INTERVAL)
+            while True:
+                if status == "start":
+                    running[process_number] = (user_id, time.time())
+                    started.add(process_number)
+                else:
+                    running.pop(process_number, None)
+                process_number, user_id, status = status_queue.get_nowait()
+        except queue.Empty:
+            pass
 
+        now = time.time()
+        for process_number, p in list(workers.items()):
+            curr_job = running.get(process_number)
+            timed_out = user_timeout is not None and curr_job is not None and \
+                now - curr_job[1] > user_timeout
+            if timed_out:
+                logging.error("Pipeline for user %s did not finish in %s secs, terminating %s" %
+                              (curr_job[0], user_timeout, p))
+                p.terminate()
+            elif p.is_alive():
+                continue
+            p.join()
+            running.pop(process_number, None)
+            if p.exitcode == 0:
+                logging.info("Worker %s is done" % p)
+                del workers[process_number]
+                continue
+            if process_number not in started:
+                # it failed before it started a user, e.g. while setting up
+                # its logging, so a replacement would fail in the same way
+                logging.error("Worker %s exited with %s before it started a user, not replacing it" %
+                              (p, p.exitcode))
+                del workers[process_number]
+                continue
+            if curr_job is not None:
+                epq.mark_running_stages_failed(curr_job[0])
+                esds.store_pipeline_error(curr_job[0], "WHOLE_PIPELINE", now, None)
+            started.discard(process_number)
+            logging.warning("Worker %s exited with %s, replacing it" % (p, p.exitcode))
+            workers[process_number] = _start_worker(ctx, process_number,
+                                                    job_queue, status_queue)
+    logging.info("Finished processing %s users" % len(uuid_list))
@@ -6,6 +6,7 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import *
 import logging
+import bisect
 import pymongo
 import arrow
 import pandas as pd
@@ -193,6 +194,85 @@ def get_trip_for_user_input_obj(ts, ui_obj):
     potential_candidates = ts.find_entries(["analysis/confirmed_trip"], tq)
     return final_candidate(valid_trip(ts, ui_obj), potential_candidates)
 
+# Batch versions of get_trip_for_user_input_obj and
+# get_user_input_for_trip_object, for the pipeline stages that match many
+# inputs or trips at a time. They read all the candidates for the whole batch
+# with one query, index them by start_ts, and apply the same rules
+# (final_candidate with valid_user_input_for_trip) to the candidates that the
+# per-object query would have returned.
+
+def _get_start_ts_index(entries):
+    sorted_entries = sorted(entries, key=lambda e: e["data"]["start_ts"])
+    return ([e["data"]["start_ts"] for e in sorted_entries], sorted_entries)
+
+def _get_entries_in_start_ts_range(start_ts_index, start_ts, end_ts):
+    """
+    Entries with start_ts <= data.start_ts <= end_ts, same as a TimeQuery on
+    data.start_ts
+    """
+    (start_ts_list, sorted_entries) = start_ts_index
+    return sorted_entries[bisect.bisect_left(start_ts_list, start_ts):
+                          bisect.bisect_right(start_ts_list, end_ts)]
+
+def get_trips_for_user_input_objs(ts, ui_obj_list):
+    """
+    The confirmed trip for each user input in ui_obj_list, or None, same as
+    calling get_trip_for_user_input_obj for each of them. Inputs that match
+    the same trip get the same trip object, so that changes made for one
+    input are seen by the next ones.
+    """
+    if len(ui_obj_list) == 0:
+        return []
+    ONE_DAY = 24 * 60 * 60
+    ui_start_ts_list = [ui.data.start_ts for ui in ui_obj_list]
+    tq = estt.TimeQuery("data.start_ts", min(ui_start_ts_list) - ONE_DAY,
+        max(ui_start_ts_list) + ONE_DAY)
+    trip_list = [ecwe.Entry(t) for t in ts.find_entries(["analysis/confirmed_trip"], tq)]
+    trip_map = {t.get_id(): t for t in trip_list}
+    trip_index = _get_start_ts_index(trip_list)
+    logging.debug("Matching %d user inputs against %d confirmed trips" %
+        (len(ui_obj_list), len(trip_list)))
+
+    matched_trips = []
+    for ui_obj in ui_obj_list:
+        potential_candidates = _get_entries_in_start_ts_range(trip_index,
+            ui_obj.data.start_ts - ONE_DAY, ui_obj.data.start_ts + ONE_DAY)
+        matched_trip = final_candidate(valid_trip(ts, ui_obj), potential_candidates)
+        matched_trips.append(trip_map[matched_trip.get_id()]
+            if matched_trip is not None else None)
+    return matched_trips
+
+def get_user_inputs_for_trip_objects(ts, trip_obj_list, user_input_key_list):
+    """
+    For each trip in trip_obj_list, a map from each user input key to the
+    matching user input, for the keys that have a match. Same as calling
+    get_user_input_for_trip_object for every trip and key.
+    """
+    if len(trip_obj_list) == 0:
+        return []
+    tq = estt.TimeQuery("data.start_ts",
+        min([t.data.start_ts for t in trip_obj_list]),
+        max([t.data.end_ts for t in trip_obj_list]))
+    input_list = list(ts.find_entries(user_input_key_list, tq))
+    input_index_map = {}
+    for ikey in user_input_key_list:
+        input_index_map[ikey] = _get_start_ts_index(
+            [ui for ui in input_list if ui["metadata"]["key"] == ikey])
+    logging.debug("Matching %d trips against %d user inputs" %
+        (len(trip_obj_list), len(input_list)))
+
+    matched_inputs = []
+    for trip_obj in trip_obj_list:
+        trip_inputs = {}
+        for ikey in user_input_key_list:
+            potential_candidates = _get_entries_in_start_ts_range(input_index_map[ikey],
+                trip_obj.data.start_ts, trip_obj.data.end_ts)
+            matched_input = final_candidate(valid_user_input(ts, trip_obj), potential_candidates)
+            if matched_input is not None:
+                trip_inputs[ikey] = matched_input
+        matched_inputs.append(trip_inputs)
+    return matched_inputs
+
 def filter_labeled_trips(mixed_trip_df):
     """
     mixed_trip_df: a dataframe with mixed labeled and unlabeled entries
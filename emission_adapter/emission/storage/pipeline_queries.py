@@ -268,6 +268,22 @@ def mark_stage_failed(user_id, stage):
     logging.debug("After saving state %s, list is %s" % (curr_state,
         list(edb.get_pipeline_state_db().find({"user_id": user_id}))))
 
+def mark_running_stages_failed(user_id):
+    """
+    Marks every stage of the user that is still running as failed. A stage
+    normally marks itself as done or failed, but if the process running it is
+    killed, it stays marked as running and every later run of the stage fails
+    in get_time_range_for_stage. Returns the stages that were reset.
+    """
+    running_states = list(edb.get_pipeline_state_db().find({"user_id": user_id,
+        "curr_run_ts": {"$ne": None}}))
+    running_stages = [ps.PipelineStages(s["pipeline_stage"]) for s in running_states]
+    for stage in running_stages:
+        logging.info("Stage %s of user %s is still marked as running, marking it as failed" %
+                     (stage, user_id))
+        mark_stage_failed(user_id, stage)
+    return running_stages
+
 def get_time_range_for_stage(user_id, stage):
     """
     Returns the start ts and the end ts of the entries in the stage
@@ -60,7 +60,8 @@ class TimeSeries(object):
 
         edb.url = new_url
         print("Connecting to new URL "+edb.url+" resetting _current_db link")
-        edb._current_db = MongoClient(edb.url).Stage_database
+        edb._current_db = MongoClient(edb.url, **edb.client_config).Stage_database
+        edb._reset_indexed_collections()
         print("After changing URL, connection is %s" % edb._current_db)
 
         import emission.storage.timeseries.builtin_timeseries as bits
@@ -72,11 +73,12 @@ class TimeSeries(object):
 
 
     def find_entries(self, key_list=None, time_query=None, geo_query=None,
-                     extra_query_list=None):
+                     extra_query_list=None, projection=None):
         """
         Find the entries for the specified time query
         :param geo_query:
         :param extra_query_list:
+        :param projection: list of fields to read, None for all fields
         """
         pass
 
@@ -86,7 +88,8 @@ class TimeSeries(object):
     def get_entry_from_id(self, key, entry_id):
         pass
 
-    def get_data_df(self, key, time_query = None, geo_query=None, extra_query_list=None):
+    def get_data_df(self, key, time_query = None, geo_query=None, extra_query_list=None,
+                    map_fn=None, projection=None):
         """
         Returns a dataframe of the specified entries. A single key is required,
         since we want to retrieve objects of the same type - the dataframe is
@@ -95,6 +98,17 @@ class TimeSeries(object):
         """
         pass
 
+    def get_data_df_chunks(self, key, time_query = None, geo_query = None,
+                           extra_query_list=None, projection = None,
+                           chunk_size = 10000):
+        """
+        Same as get_data_df, but returns an iterator over dataframes of at
+        most chunk_size entries each, so that the entries of a large user can
+        be processed without reading all of them into memory at once.
+        Duplicates are only removed within a chunk.
+        """
+        pass
+
     def get_first_value_for_field(self, key, sort_order, field):
         """
         Currently used to get the max value of the location values so that we can send data
@@ -131,6 +145,24 @@ class TimeSeries(object):
     def insert_data(self, user_id, key, data):
         pass
 
+    def insert_buffered(self, entry):
+        """
+        Same as insert, but the entry may only be written when the buffered
+        entries are flushed.
+        :return: the object ID of the entry
+        """
+        pass
+
+    def insert_data_buffered(self, user_id, key, data):
+        pass
+
+    def flush(self):
+        """
+        Writes all the entries that were saved with insert_buffered.
+        :return: the number of entries written
+        """
+        pass
+
     def insert_error(self, entry):
         pass
 
@@ -6,14 +6,18 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import *
 import logging
+import numpy as np
 import pandas as pd
 import pymongo
 import itertools
+import collections
+import bson.objectid as boi
 
 import emission.core.get_database as edb
 import emission.storage.timeseries.abstract_timeseries as esta
 
 import emission.core.wrapper.entry as ecwe
+import emission.core.wrapper.wrapperbase as ecwb
 
 ts_enum_map = {
     esta.EntryType.DATA_TYPE: edb.get_timeseries_db(),
@@ -22,6 +26,14 @@ ts_enum_map = {
 
 INVALID_QUERY = {'metadata.key': 'invalid'}
 
+# Fields that are always read, even if the caller asks for a projection,
+# since they are needed to wrap the documents into entries
+REQUIRED_PROJECTION_FIELDS = ["_id", "user_id", "metadata"]
+
+# Number of entries saved with insert_buffered that are kept in memory before
+# they are written to the database
+WRITE_BUFFER_SIZE = 1000
+
 class BuiltinTimeSeries(esta.TimeSeries):
     def __init__(self, user_id):
         super(BuiltinTimeSeries, self).__init__(user_id)
@@ -89,6 +101,9 @@ class BuiltinTimeSeries(esta.TimeSeries):
                 "analysis/confirmed_trip": self.analysis_timeseries_db,
                 "analysis/confirmed_section": self.analysis_timeseries_db
             }
+        # full collection name -> (collection, entries), see insert_buffered
+        self._write_buffer = collections.OrderedDict()
+        self._write_buffer_len = 0
 
 
     @staticmethod
@@ -119,10 +134,13 @@ class BuiltinTimeSeries(esta.TimeSeries):
         ret_query = {}
         ret_query.update(self.user_query)
         if key_list is not None and len(key_list) > 0:
-            key_query_list = []
-            for key in key_list:
-                key_query_list.append(self.key_query(key))
-            ret_query.update({"$or": key_query_list})
+            # An $in (instead of an $or of key queries) can use the compound
+            # (user_id, metadata.key, <time>) indices for both the filter and
+            # the sort
+            if len(key_list) == 1:
+                ret_query.update(self.key_query(key_list[0]))
+            else:
+                ret_query.update({"metadata.key": {"$in": list(key_list)}})
         if time_query is not None:
             ret_query.update(time_query.get_query())
         if geo_query is not None:
@@ -184,8 +202,25 @@ class BuiltinTimeSeries(esta.TimeSeries):
             self.get_timeseries_db(key) == self.analysis_timeseries_db]
         return (orig_ts_db_keys, analysis_ts_db_keys)
 
+    @staticmethod
+    def _get_projection(projection):
+        """
+        Converts a list of fields to read into a mongodb projection that also
+        includes the REQUIRED_PROJECTION_FIELDS. None reads all fields.
+        """
+        if projection is None:
+            return None
+        ret_projection = {field: True for field in REQUIRED_PROJECTION_FIELDS}
+        ret_projection.update({field: True for field in projection})
+        return ret_projection
+
     def find_entries(self, key_list = None, time_query = None, geo_query = None,
-                     extra_query_list=None):
+                     extra_query_list=None, projection=None):
+        """
+        :param projection: list of fields (e.g. ["data.ts", "data.loc"]) to
+        read from every entry, in addition to the _id, user_id and metadata.
+        None reads all fields.
+        """
         sort_key = self._get_sort_key(time_query)
         logging.debug("curr_query = %s, sort_key = %s" % 
             (self._get_query(key_list, time_query, geo_query,
@@ -194,32 +229,33 @@ class BuiltinTimeSeries(esta.TimeSeries):
         logging.debug("orig_ts_db_keys = %s, analysis_ts_db_keys = %s" % 
             (orig_ts_db_keys, analysis_ts_db_keys))
 
-        (orig_ts_db_count, orig_ts_db_result) = self._get_entries_for_timeseries(self.timeseries_db,
+        orig_ts_db_result = self._get_entries_for_timeseries(self.timeseries_db,
                                                              orig_ts_db_keys,
                                                              time_query,
                                                              geo_query,
                                                              extra_query_list,
-                                                             sort_key)
+                                                             sort_key,
+                                                             projection)
 
-        (analysis_ts_db_count, analysis_ts_db_result) = self._get_entries_for_timeseries(self.analysis_timeseries_db,
+        analysis_ts_db_result = self._get_entries_for_timeseries(self.analysis_timeseries_db,
                                                                  analysis_ts_db_keys,
                                                                  time_query,
                                                                  geo_query,
                                                                  extra_query_list,
-                                                                 sort_key)
-        logging.debug("orig_ts_db_matches = %s, analysis_ts_db_matches = %s" %
-            (orig_ts_db_count, analysis_ts_db_count))
+                                                                 sort_key,
+                                                                 projection)
         return itertools.chain(orig_ts_db_result, analysis_ts_db_result)
 
     def _get_entries_for_timeseries(self, tsdb, key_list, time_query, geo_query,
-                                    extra_query_list, sort_key):
+                                    extra_query_list, sort_key, projection=None):
         # workaround for https://github.com/e-mission/e-mission-server/issues/271
         # during the migration
         if key_list is None or len(key_list) > 0:
             ts_query = self._get_query(key_list, time_query, geo_query,
                                 extra_query_list)
-            ts_db_cursor = tsdb.find(ts_query)
-            ts_db_count = tsdb.count_documents(ts_query)
+            # We don't count the matching documents, since that is a second
+            # query that would only be used for logging
+            ts_db_cursor = tsdb.find(ts_query, self._get_projection(projection))
             if sort_key is None:
                 ts_db_result = ts_db_cursor
             else:
@@ -236,10 +272,9 @@ class BuiltinTimeSeries(esta.TimeSeries):
             ts_db_result.limit(edb.result_limit)
         else:
             ts_db_result = tsdb.find(INVALID_QUERY)
-            ts_db_count = 0
 
-        logging.debug("finished querying values for %s, count = %d" % (key_list, ts_db_count))
-        return (ts_db_count, ts_db_result)
+        logging.debug("finished querying values for %s" % (key_list))
+        return ts_db_result
 
     def get_entry_at_ts(self, key, ts_key, ts):
         import numpy as np
@@ -253,7 +288,7 @@ class BuiltinTimeSeries(esta.TimeSeries):
 
     def get_data_df(self, key, time_query = None, geo_query = None,
                     extra_query_list=None,
-                    map_fn = None):
+                    map_fn = None, projection = None):
         """
         Retuns a dataframe for the specified query.
         :param key: the metadata key we are querying for. Only supports one key
@@ -264,11 +299,74 @@ class BuiltinTimeSeries(esta.TimeSeries):
         test phones, for example)
         :param map_fn: the function that maps the entry to a suitable dict for dataframe conversion
         entry -> dict
+        :param projection: the fields to read, see find_entries. The dataframe
+        only has columns for these fields (and the _id, user_id and
+        metadata_write_ts)
         :return:
         """
-        result_it = self.find_entries([key], time_query, geo_query, extra_query_list)
+        result_it = self.find_entries([key], time_query, geo_query, extra_query_list,
+                                      projection)
         return self.to_data_df(key, result_it, map_fn)
 
+    def get_data_df_chunks(self, key, time_query = None, geo_query = None,
+                           extra_query_list=None, projection = None,
+                           chunk_size = 10000):
+        """
+        Same as get_data_df, but returns an iterator over dataframes of at
+        most chunk_size entries each, so that the entries of a large user can
+        be processed without reading all of them into memory at once.
+        Duplicates are only removed within a chunk.
+        """
+        result_it = self.find_entries([key], time_query, geo_query, extra_query_list,
+                                      projection)
+        while True:
+            chunk_df = self.to_data_df(key, itertools.islice(result_it, chunk_size))
+            if len(chunk_df) == 0:
+                return
+            yield chunk_df
+
+    @staticmethod
+    def _get_local_dates(key):
+        wrapper_name = ecwe.Entry._getData2Wrapper()[key]
+        return ecwb.WrapperBase._get_class(wrapper_name).local_dates
+
+    @staticmethod
+    def _to_df_columns(key, entry_it):
+        """
+        Reads the entries directly into columns, without wrapping every entry
+        into an Entry and building an intermediate dict per entry. The columns
+        are the same as the ones generated by _to_df_entry: the data fields
+        with the local dates expanded, and the _id, user_id and write_ts.
+        Fields that are missing in an entry are NaN, as they would be in a
+        dataframe created from a list of dicts.
+        """
+        local_dates = BuiltinTimeSeries._get_local_dates(key)
+        columns = {}
+        n_rows = 0
+        for entry_dict in entry_it:
+            data = entry_dict["data"]
+            row = [(field_key, value) for field_key, value in data.items()
+                   if field_key not in local_dates]
+            for ld_key in local_dates:
+                if ld_key in data:
+                    row.extend(("%s_%s" % (ld_key, field_key), value)
+                               for field_key, value in data[ld_key].items())
+            row.append(("_id", entry_dict["_id"]))
+            row.append(("user_id", entry_dict["user_id"]))
+            row.append(("metadata_write_ts", entry_dict["metadata"]["write_ts"]))
+            for column_name, value in row:
+                column = columns.get(column_name)
+                if column is None:
+                    column = [np.nan] * n_rows
+                    columns[column_name] = column
+                column.append(value)
+            n_rows = n_rows + 1
+            if len(row) < len(columns):
+                for column in columns.values():
+                    if len(column) < n_rows:
+                        column.append(np.nan)
+        return pd.DataFrame(columns)
+
     @staticmethod
     def to_data_df(key, entry_it, map_fn = None):
         """
@@ -278,9 +376,10 @@ class BuiltinTimeSeries(esta.TimeSeries):
         :return: A dataframe composed of the entries in the iterator
         """
         if map_fn is None:
-            map_fn = BuiltinTimeSeries._to_df_entry
-        # Dataframe doesn't like to work off an iterator - it wants everything in memory
-        df = pd.DataFrame([map_fn(e) for e in entry_it])
+            df = BuiltinTimeSeries._to_df_columns(key, entry_it)
+        else:
+            # Dataframe doesn't like to work off an iterator - it wants everything in memory
+            df = pd.DataFrame([map_fn(e) for e in entry_it])
         logging.debug("Found %s results" % len(df))
         if len(df) > 0:
             dedup_check_list = [item for item in ecwe.Entry.get_dedup_list(key)
@@ -341,11 +440,7 @@ class BuiltinTimeSeries(esta.TimeSeries):
                 logging.info("Got errors %s while saving %d entries" % 
                     (e.details['writeErrors'], len(entries)))
 
-    def insert(self, entry):
-        """
-        Inserts the specified entry and returns the object ID 
-        """
-        logging.debug("insert called with entry of type %s" % type(entry))
+    def _check_entry(self, entry):
         if type(entry) == dict:
             entry = ecwe.Entry(entry)
         if "user_id" not in entry or entry["user_id"] is None:
@@ -355,11 +450,59 @@ class BuiltinTimeSeries(esta.TimeSeries):
 		(entry, entry["user_id"], self.user_id))
         else:
             logging.debug("entry was fine, no need to fix it")
+        return entry
 
+    def insert(self, entry):
+        """
+        Inserts the specified entry and returns the object ID 
+        """
+        logging.debug("insert called with entry of type %s" % type(entry))
+        entry = self._check_entry(entry)
         logging.debug("Inserting entry %s into timeseries" % entry)
         ins_result = self.get_timeseries_db(entry.metadata.key).insert_one(entry)
         return ins_result.inserted_id
 
+    def insert_buffered(self, entry):
+        """
+        Same as insert, but the entry is only added to a write buffer, which
+        is written with one insert_many per collection when it reaches
+        WRITE_BUFFER_SIZE entries, or when flush is called. Returns the object
+        ID, which is assigned here if the entry does not have one. The caller
+        must call flush before it records that the entries have been saved,
+        e.g. before it marks a pipeline stage as done.
+        """
+        entry = self._check_entry(entry)
+        if "_id" not in entry:
+            entry["_id"] = boi.ObjectId()
+        tsdb = self.get_timeseries_db(entry.metadata.key)
+        self._write_buffer.setdefault(tsdb.full_name, (tsdb, []))[1].append(entry)
+        self._write_buffer_len = self._write_buffer_len + 1
+        if self._write_buffer_len >= WRITE_BUFFER_SIZE:
+            self.flush()
+        return entry["_id"]
+
+    def insert_data_buffered(self, user_id, key, data):
+        """
+        Same as insert_data, but with insert_buffered
+        """
+        entry = ecwe.Entry.create_entry(user_id, key, data)
+        return self.insert_buffered(entry)
+
+    def flush(self):
+        """
+        Writes the entries in the write buffer and returns how many there
+        were. The buffer is emptied even if a write fails, and the error is
+        raised so that the caller does not mark the entries as saved.
+        """
+        n_entries = self._write_buffer_len
+        write_buffer = self._write_buffer
+        self._write_buffer = collections.OrderedDict()
+        self._write_buffer_len = 0
+        for (tsdb, entries) in write_buffer.values():
+            logging.debug("Flushing %d buffered entries into %s" % (len(entries), tsdb.full_name))
+            tsdb.insert_many(entries, ordered=False)
+        return n_entries
+
     def insert_data(self, user_id, key, data):
         """
         Inserts an element for this entry when the data is specified, inserts
@@ -26,7 +26,7 @@ class NonUserTimeSeries(bits.BuiltinTimeSeries):
     # get_entry_from_id: not overridden
 
     def find_entries(self, key_list = None, time_query = None, geo_query = None,
-                     extra_query_list=None):
+                     extra_query_list=None, projection=None):
         sort_key = self._get_sort_key(time_query)
         logging.debug("curr_query = %s, sort_key = %s" % 
             (self._get_query(key_list, time_query, geo_query,
@@ -36,7 +36,8 @@ class NonUserTimeSeries(bits.BuiltinTimeSeries):
                                                              time_query,
                                                              geo_query,
                                                              extra_query_list,
-                                                             sort_key)
+                                                             sort_key,
+                                                             projection)
         return ts_db_result
 
     # _get_entries_for_timeseries is unchanged
@@ -0,0 +1,50 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+# Standard imports
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+import unittest
+import logging
+import uuid
+
+# Our imports
+import emission.analysis.intake.parallel as eaip
+import emission.core.wrapper.entry as ecwe
+import emission.core.wrapper.section as ecwc
+
+import emission.tests.common as etc
+
+class TestParallel(unittest.TestCase):
+    def testSerial(self):
+        args_list = [(i, 2) for i in range(10)]
+        self.assertEqual(list(eaip.imap_ordered(pow, args_list, n_workers=1)),
+                         [i * i for i in range(10)])
+
+    def testOrderedInPool(self):
+        args_list = [(i, 2) for i in range(50)]
+        self.assertEqual(list(eaip.imap_ordered(pow, args_list, n_workers=3, batch_size=4)),
+                         [i * i for i in range(50)])
+
+    def testErrorInPool(self):
+        results = eaip.imap_ordered(pow, [(2, 2), (0, -1), (3, 2)], n_workers=2)
+        self.assertEqual(next(results), 4)
+        with self.assertRaises(ZeroDivisionError):
+            next(results)
+
+    def testEntriesInPool(self):
+        section = ecwc.Section()
+        section.start_ts = 1440658800
+        entry = ecwe.Entry.create_entry(uuid.uuid4(), "segmentation/raw_section",
+                                        section, create_id=True)
+        # identity through a pool pickles the entries both ways
+        results = list(eaip.imap_ordered(ecwe.Entry, [(entry,), (entry,)], n_workers=2))
+        self.assertEqual(results, [entry, entry])
+        self.assertEqual(results[0].data.start_ts, 1440658800)
+        self.assertEqual(results[0].get_id(), entry.get_id())
+
+if __name__ == '__main__':
+    etc.configLogging()
+    unittest.main()
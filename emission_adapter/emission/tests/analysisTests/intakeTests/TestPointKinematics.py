@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+# Standard imports
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+import unittest
+import logging
+import numpy as np
+import attrdict as ad
+
+# Our imports
+import emission.analysis.point_features as pf
+import emission.analysis.point_kinematics as eapk
+
+import emission.tests.common as etc
+
+class TestPointKinematics(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(61)
+        n = 50
+        self.lon = -122.08 + np.cumsum(np.random.normal(0, 0.001, n))
+        self.lat = 37.39 + np.cumsum(np.random.normal(0, 0.001, n))
+        self.ts = 1440658800 + np.cumsum(np.random.choice([0, 1, 30], n))
+        self.points = [ad.AttrDict({"longitude": lon, "latitude": lat, "ts": ts})
+                       for (lon, lat, ts) in zip(self.lon, self.lat, self.ts)]
+
+    def testPointKinematics(self):
+        (distances, speeds, headings) = eapk.calPointKinematics(self.lon, self.lat, self.ts)
+        self.assertEqual(len(distances), len(self.points))
+        self.assertEqual((distances[0], speeds[0], headings[0]), (0, 0, 0))
+        for i, (p1, p2) in enumerate(zip(self.points, self.points[1:])):
+            self.assertAlmostEqual(distances[i+1], pf.calDistance(p1, p2), places=6)
+            self.assertAlmostEqual(speeds[i+1], pf.calSpeed(p1, p2), places=6)
+            self.assertAlmostEqual(headings[i+1], pf.calHeading(p1, p2), places=6)
+
+    def testHeadingChanges(self):
+        hcs = eapk.calHeadingChanges(self.lon, self.lat)
+        self.assertEqual(len(hcs), len(self.points))
+        self.assertEqual((hcs[0], hcs[1]), (0, 0))
+        for i, (p1, p2, p3) in enumerate(zip(self.points, self.points[1:], self.points[2:])):
+            self.assertAlmostEqual(hcs[i+2], pf.calHC(p1, p2, p3), places=6)
+
+    def testLaggedDistances(self):
+        lagged = eapk.calLaggedDistances(self.lon, self.lat, 3)
+        self.assertEqual(lagged.shape, (len(self.points), 4))
+        self.assertTrue(np.isnan(lagged[1, 2]))
+        for i in range(3, len(self.points)):
+            for k in range(4):
+                self.assertAlmostEqual(lagged[i, k],
+                                       pf.calDistance(self.points[i-k], self.points[i]), places=6)
+
+if __name__ == '__main__':
+    etc.configLogging()
+    unittest.main()
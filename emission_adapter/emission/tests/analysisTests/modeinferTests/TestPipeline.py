@@ -33,6 +33,7 @@ import emission.analysis.classification.inference.mode.pipeline as pipeline
 import emission.storage.timeseries.abstract_timeseries as esta
 import emission.storage.decorations.analysis_timeseries_queries as esda
 import emission.storage.decorations.section_queries as esds
+import emission.analysis.section_features as easf
 
 '''
 TODO:
@@ -120,6 +121,32 @@ class TestPipeline(unittest.TestCase):
     self.assertEqual(self.pipeline.toPredictFeatureMatrix.shape[1], len(self.pipeline.selFeatureIndices))
     self.assertEqual(self.pipeline.toPredictFeatureMatrix.shape[0], len(self.pipeline.toPredictSections))
 
+  def testLoadSectionLocationsStep(self):
+    sections = esda.get_entries(esda.CLEANED_SECTION_KEY, self.testUUID,
+        time_query=None)
+    self.assertGreater(len(sections), 2)
+    expectedHCR = [easf.calHCR(s) for s in sections]
+    # a limit that only cuts off the queries for more than one section
+    maxCount = max(len(list(esta.TimeSeries.get_time_series(self.testUUID).find_entries(
+        ["analysis/recreated_location"], esda.get_time_query_for_trip_like_object(s.data))))
+        for s in sections)
+
+    old_batch_size = pipeline.SECTION_LOCATIONS_BATCH_SIZE
+    old_result_limit = edb.result_limit
+    try:
+        for (batch_size, result_limit) in [(old_batch_size, old_result_limit),
+                                           (2, old_result_limit),
+                                           (old_batch_size, maxCount + 1)]:
+            pipeline.SECTION_LOCATIONS_BATCH_SIZE = batch_size
+            edb.result_limit = result_limit
+            sectionLocations = self.pipeline.loadSectionLocationsStep(sections)
+            self.assertEqual(len(sectionLocations), len(sections))
+            self.assertEqual([easf.calHCR(s, l) for s, l in zip(sections, sectionLocations)],
+                             expectedHCR)
+    finally:
+        pipeline.SECTION_LOCATIONS_BATCH_SIZE = old_batch_size
+        edb.result_limit = old_result_limit
+
   def testPredictedProb(self):
     self.testGenerateFeatureMatrixAndIds()
 
@@ -47,6 +47,8 @@ def dropAllCollections(db):
     else: 
       print("Dropping collection %s" % coll)
       db.drop_collection(coll)
+  # the indices were dropped with the collections
+  edb._reset_indexed_collections()
 
 def purgeSectionData(Sections, userName):
     """
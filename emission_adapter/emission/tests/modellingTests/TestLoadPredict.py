@@ -0,0 +1,111 @@
+import unittest
+import os
+import shutil
+import tempfile
+import uuid
+import jsonpickle as jpickle
+import numpy as np
+import attrdict as ad
+
+import emission.tests.common as etc
+
+import emission.analysis.modelling.tour_model.load_predict as eamtl
+import emission.analysis.modelling.tour_model_first_only.load_predict as eamtf
+import emission.analysis.modelling.tour_model.data_preprocessing as preprocess
+
+class TestLoadPredict(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(61)
+        self.test_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        # the models are read from the working directory
+        os.chdir(self.test_dir)
+        eamtl.clear_model_cache()
+        self.user = uuid.uuid4()
+        centers = np.array([-122.08, 37.39, -122.06, 37.40]) + \
+            np.random.normal(0, 0.01, (5, 4))
+        self.bin_locations = {str(i): (c + np.random.normal(0, 0.0005, (3, 4))).tolist()
+            for i, c in enumerate(centers)}
+        self.user_labels = {k: [{"labels": {"mode_confirm": "walk", "purpose_confirm": k}, "p": 1.0}]
+            for k in self.bin_locations}
+        self.save("locations_first_round_" + str(self.user), self.bin_locations)
+        self.save("user_labels_first_round_" + str(self.user), self.user_labels)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.test_dir)
+        eamtl.clear_model_cache()
+
+    def save(self, filename, model):
+        with open(filename, "w") as fd:
+            fd.write(jpickle.dumps(model))
+
+    def make_trip(self, loc_feat, user=None):
+        return ad.AttrDict({"user_id": self.user if user is None else user,
+            "data": {"start_loc": {"coordinates": list(loc_feat[0:2])},
+                     "end_loc": {"coordinates": list(loc_feat[2:4])},
+                     "distance": 1000, "duration": 600, "start_fmt_time": "test"}})
+
+    def predict_labels_with_n_unbatched(self, trip):
+        # the prediction without the model cache and the bin index: load the
+        # models and check every bin in turn
+        try:
+            bin_locations = eamtf.loadModelStage('locations_first_round_' + str(trip['user_id']))
+            user_labels = eamtf.loadModelStage('user_labels_first_round_' + str(trip['user_id']))
+        except IOError:
+            return [], -1
+        trip_loc_feat = preprocess.extract_features([trip])[0][0:4]
+        for fl, sel_loc_feat in bin_locations.items():
+            if eamtf.in_bin(sel_loc_feat, trip_loc_feat, eamtf.RADIUS):
+                return user_labels[fl], len(bin_locations[fl])
+        return [], 0
+
+    def testFindBinVectorized(self):
+        bin_index = eamtl.get_bin_index(self.bin_locations)
+        points = np.random.normal(0, 0.0005, (100, 4)) + \
+            np.array([self.bin_locations[str(i % 5)][0] for i in range(100)])
+        for radius in [50, 100, 500, 5000]:
+            for loc_feat in points:
+                expected = None
+                for fl, sel_loc_feat in self.bin_locations.items():
+                    if eamtl.in_bin(sel_loc_feat, loc_feat, radius):
+                        expected = fl
+                        break
+                self.assertEqual(eamtl.find_bin_vectorized(bin_index, loc_feat, radius), expected)
+
+    def testModelCache(self):
+        filename = "locations_first_round_" + str(self.user)
+        model = eamtl.loadModelStageCached(filename)
+        self.assertEqual(model, self.bin_locations)
+        self.assertIs(eamtl.loadModelStageCached(filename), model)
+        # a rebuilt model is reloaded
+        self.save(filename, {"0": self.bin_locations["0"]})
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(list(eamtl.loadModelStageCached(filename).keys()), ["0"])
+        with self.assertRaises(IOError):
+            eamtl.loadModelStageCached("locations_first_round_" + str(uuid.uuid4()))
+
+    def testPredictLabelsBatch(self):
+        trips = [self.make_trip(self.bin_locations[k][0]) for k in self.bin_locations]
+        # near the bins, within and outside the radius
+        trips.extend([self.make_trip(np.array(self.bin_locations[k][1]) + np.random.normal(0, 0.003, 4))
+            for k in self.bin_locations for i in range(10)])
+        trips.append(self.make_trip([0, 0, 1, 1]))
+        trips.append(self.make_trip(self.bin_locations["0"][0], user=uuid.uuid4()))
+        batch = eamtf.predict_labels_with_n_batch(trips)
+        self.assertEqual(batch, [self.predict_labels_with_n_unbatched(trip) for trip in trips])
+        self.assertIn(([], 0), batch[5:-2])
+        self.assertTrue(any(n > 0 for (labels, n) in batch[5:-2]))
+        self.assertEqual(batch[-2], ([], 0))
+        self.assertEqual(batch[-1], ([], -1))
+        for (labels, n), k in zip(batch, self.bin_locations):
+            self.assertEqual(labels, self.user_labels[k])
+            self.assertEqual(n, 3)
+        # the predictions do not share the cached models
+        batch[0][0][0]["p"] = 0.5
+        self.assertEqual(eamtf.predict_labels(trips[0])[0]["p"], 1.0)
+
+if __name__ == '__main__':
+    etc.configLogging()
+    unittest.main()
@@ -7,6 +7,7 @@ import pandas as pd
 import numpy as np
 import bson.objectid as boi
 from uuid import UUID
+import attrdict as ad
 
 import emission.tests.common as etc
 
@@ -102,6 +103,30 @@ class TestSimilarityAux(unittest.TestCase):
         exp_result.loc[self.too_short_indices] = -2
         self.assertEqual(self.curr_sim.get_result_labels().to_list(), exp_result.to_list())
 
+    def testBinData(self):
+        # compare against binning every trip with match, which checks all the bins
+        np.random.seed(61)
+        places = np.random.normal(0, 0.02, (10, 2)) + [-122.08, 37.39]
+        trips = []
+        for i in range(200):
+            start = places[np.random.randint(10)] + np.random.normal(0, 0.002, 2)
+            end = places[np.random.randint(10)] + np.random.normal(0, 0.002, 2)
+            trips.append(ad.AttrDict({"_id": boi.ObjectId(), "data": {
+                "start_loc": {"coordinates": start.tolist()},
+                "end_loc": {"coordinates": end.tolist()}}}))
+        for radius in [0, 100, 500, 5000]:
+            self.curr_sim = eamts.similarity(trips, radius)
+            self.curr_sim.bin_data()
+            exp_bins = []
+            for a in range(len(trips)):
+                matched = [b for b in exp_bins if self.curr_sim.match(a, b)]
+                if len(matched) > 0:
+                    matched[0].append(a)
+                else:
+                    exp_bins.append([a])
+            exp_bins.sort(key=lambda bin: len(bin), reverse=True)
+            self.assertEqual(self.curr_sim.bins, exp_bins)
+
 if __name__ == '__main__':
     etc.configLogging()
     unittest.main()
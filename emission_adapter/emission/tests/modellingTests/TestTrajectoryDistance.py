@@ -0,0 +1,91 @@
+import unittest
+import logging
+import numpy as np
+
+import emission.core.common as ec
+import emission.tests.common as etc
+
+import emission.analysis.modelling.tour_model.trajectory_matching.trajectory_distance as eatd
+import emission.analysis.modelling.tour_model.trajectory_matching.DTW as eatmd
+
+# Reference implementations that call ec.calDistance for every cell, so that
+# we can check the vectorized versions against the textbook recurrences
+
+def reference_dtw_cost(route1, route2):
+    cost = np.full((len(route1) + 1, len(route2) + 1), np.inf)
+    cost[0, 0] = 0
+    for i in range(1, len(route1) + 1):
+        for j in range(1, len(route2) + 1):
+            cost[i, j] = ec.calDistance(route1[i-1], route2[j-1]) + \
+                min(cost[i-1, j], cost[i, j-1], cost[i-1, j-1])
+    return cost[-1, -1]
+
+def reference_lcs(route1, route2, radius):
+    lengths = np.zeros((len(route1) + 1, len(route2) + 1), dtype=int)
+    for i, p1 in enumerate(route1):
+        for j, p2 in enumerate(route2):
+            if ec.calDistance(p1, p2) <= radius:
+                lengths[i+1, j+1] = lengths[i, j] + 1
+            else:
+                lengths[i+1, j+1] = max(lengths[i+1, j], lengths[i, j+1])
+    return lengths[-1, -1]
+
+class TestTrajectoryDistance(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(61)
+        self.routes = [(np.array([-122.08, 37.39]) +
+                        np.cumsum(np.random.normal(0, 0.002, (n, 2)), axis=0)).tolist()
+                       for n in [30, 45, 12, 30]]
+
+    def testDtw(self):
+        r1, r2 = self.routes[0], self.routes[1]
+        expected = reference_dtw_cost(r1, r2)
+        self.assertAlmostEqual(eatd.dtw(r1, r2, "sum"), expected / (len(r1) + len(r2)), places=6)
+        self.assertAlmostEqual(eatmd.DtwSym(r1, r2).calculate(),
+            eatmd.DtwSym(r2, r1).calculate(), places=6)
+        dtw = eatmd.Dtw(r1, r2, ec.calDistance)
+        self.assertAlmostEqual(dtw.calculate(), expected, places=6)
+        path = dtw.get_path()
+        self.assertEqual((path[0], path[-1]), ((len(r1) - 1, len(r2) - 1), (0, 0)))
+        self.assertAlmostEqual(dtw.calculate_distance(), expected / len(path), places=6)
+
+    def testDtwBandAndEarlyAbandon(self):
+        r1, r2 = self.routes[0], self.routes[1]
+        full = eatd.dtw(r1, r2, "sum")
+        # a band that covers the whole matrix does not change anything
+        self.assertAlmostEqual(eatd.dtw(r1, r2, "sum", window=len(r2)), full, places=6)
+        # a narrower band can only restrict the warping paths
+        self.assertGreaterEqual(eatd.dtw(r1, r2, "sum", window=2), full - 1e-6)
+        self.assertAlmostEqual(eatd.dtw(r1, r2, "sum", max_distance=full * 1.01), full, places=6)
+        self.assertEqual(eatd.dtw(r1, r2, "sum", max_distance=full * 0.5), np.inf)
+
+    def testLcs(self):
+        r1, r2 = self.routes[0], self.routes[1]
+        for radius in [100, 500, 2000]:
+            expected = reference_lcs(r1, r2, radius)
+            self.assertEqual(eatd.lcs(r1, r2, radius), expected)
+            self.assertAlmostEqual(eatd.lcs_score(r1, r2, radius), 1 - expected / len(r1))
+        self.assertEqual(eatd.lcs_score(r1, r1, 1), 0)
+
+    def testFrechet(self):
+        r1, r2 = self.routes[0], self.routes[1]
+        cost = eatd.get_cost_matrix(r1, r2)
+        f = eatd.frechet(r1, r2)
+        self.assertGreaterEqual(f, max(cost[0, 0], cost[-1, -1]))
+        self.assertLessEqual(f, cost.max())
+        self.assertAlmostEqual(f, eatd.frechet(r2, r1), places=6)
+
+    def testRouteDistanceMatrix(self):
+        for method in ["lcs", "dtw", "DTW", "DTWAsym"]:
+            distances = eatd.route_distance_matrix(self.routes, method, 500)
+            self.assertEqual(distances.shape, (len(self.routes), len(self.routes)))
+            for i, r1 in enumerate(self.routes):
+                for j, r2 in enumerate(self.routes):
+                    self.assertAlmostEqual(distances[i, j],
+                        eatd.route_distance(r1, r2, method, 500), places=6)
+        partial = eatd.route_distance_matrix(self.routes, "lcs", 500, pairs=[(0, 1)])
+        self.assertEqual(np.count_nonzero(~np.isnan(partial)), 2)
+
+if __name__ == '__main__':
+    etc.configLogging()
+    unittest.main()
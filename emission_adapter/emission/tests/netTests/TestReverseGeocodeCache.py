@@ -0,0 +1,112 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+# Standard imports
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+import unittest
+import logging
+import json
+import time
+import threading
+import urllib.parse
+import http.server
+
+# Our imports
+import emission.core.get_database as edb
+import emission.net.ext_service.geocoder.nominatim as eco
+import emission.net.ext_service.geocoder.reverse_cache as eco_cache
+
+import emission.tests.common as etc
+
+class StubNominatimHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.path)
+        time.sleep(server.delay)
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        result = {"lat": params["lat"][0], "lon": params["lon"][0],
+                  "address": {"road": "Road at %s" % params["lat"][0], "city": "Stub City"}}
+        body = json.dumps(result).encode("utf-8")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class TestReverseGeocodeCache(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubNominatimHandler)
+        self.server.requests = []
+        self.server.delay = 0
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.orig_query_url = getattr(eco, "NOMINATIM_QUERY_URL", None)
+        eco.NOMINATIM_QUERY_URL = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.orig_cache_config = eco.NOMINATIM_CACHE_CONFIG
+        eco.NOMINATIM_CACHE_CONFIG = {"timeout_secs": 0.5, "backoff_secs": 60}
+        edb.get_geocode_cache_db().delete_many({})
+        eco_cache.clear_memory_cache()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.orig_query_url is None:
+            del eco.NOMINATIM_QUERY_URL
+        else:
+            eco.NOMINATIM_QUERY_URL = self.orig_query_url
+        eco.NOMINATIM_CACHE_CONFIG = self.orig_cache_config
+        edb.get_geocode_cache_db().delete_many({})
+        eco_cache.clear_memory_cache()
+
+    def testBatchLookup(self):
+        # the first two points round to the same key
+        coords = [(37.39141, -122.08611), (37.39139, -122.08609), (37.87, -122.26), (37.39141, -122.08611)]
+        results = eco_cache.get_json_reverse_batch(coords)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual([r["lat"] for r in results], ["37.3914", "37.3914", "37.87", "37.3914"])
+        self.assertEqual(results[2]["address"]["road"], "Road at 37.87")
+
+        # from memory
+        self.assertEqual(eco_cache.get_json_reverse(37.87, -122.26), results[2])
+        # from the database
+        eco_cache.clear_memory_cache()
+        self.assertEqual(eco_cache.get_json_reverse_batch(coords), results)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(edb.get_geocode_cache_db().count_documents({}), 2)
+
+    def testExpiry(self):
+        eco_cache.get_json_reverse(37.87, -122.26)
+        edb.get_geocode_cache_db().update_many({}, {"$set": {"write_ts": time.time() - 31 * 24 * 60 * 60}})
+        eco_cache.clear_memory_cache()
+        self.assertEqual(eco_cache.get_json_reverse(37.87, -122.26)["lat"], "37.87")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(edb.get_geocode_cache_db().count_documents({}), 1)
+
+    def testSlowGeocoder(self):
+        self.server.delay = 2
+        coords = [(37 + i * 0.01, -122) for i in range(20)]
+        start = time.time()
+        results = eco_cache.get_json_reverse_batch(coords)
+        # the lookups that are in flight time out, and the others are skipped
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(results, [None] * 20)
+        self.assertLessEqual(len(self.server.requests), eco_cache.CACHE_CONFIG_DEFAULTS["max_workers"])
+        self.assertEqual(edb.get_geocode_cache_db().count_documents({}), 0)
+        # and there are no lookups until the backoff is over
+        self.server.delay = 0
+        n_requests = len(self.server.requests)
+        self.assertIsNone(eco_cache.get_json_reverse(37.87, -122.26))
+        self.assertEqual(len(self.server.requests), n_requests)
+
+if __name__ == '__main__':
+    etc.configLogging()
+    unittest.main()
@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+import unittest
+import logging
+import time
+import uuid
+
+# Our imports
+import emission.core.get_database as edb
+import emission.core.wrapper.entry as ecwe
+import emission.core.wrapper.pipelinestate as ecwp
+import emission.storage.timeseries.abstract_timeseries as esta
+import emission.storage.decorations.stats_queries as esds
+import emission.storage.decorations.analysis_timeseries_queries as esda
+import emission.storage.pipeline_queries as epq
+import emission.pipeline.intake_stage as epi
+import emission.pipeline.scheduler as eps
+
+# Test imports
+import emission.tests.common as etc
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.heavyUUID = uuid.uuid4()
+        self.slowUUID = uuid.uuid4()
+        self.idleUUID = uuid.uuid4()
+        self.testUUIDs = [self.idleUUID, self.heavyUUID, self.slowUUID]
+        self.now = now = time.time()
+        for i in range(20):
+            self.insertLocation(self.heavyUUID, now - 100 + i)
+        self.insertLocation(self.slowUUID, now)
+        for stage in ["USERCACHE", "TRIP_SEGMENTATION"]:
+            esds.store_pipeline_time(self.slowUUID, stage, now, 30)
+
+    def tearDown(self):
+        for u in self.testUUIDs:
+            edb.get_timeseries_db().delete_many({"user_id": u})
+            edb.get_analysis_timeseries_db().delete_many({"user_id": u})
+            edb.get_usercache_db().delete_many({"user_id": u})
+            edb.get_pipeline_state_db().delete_many({"user_id": u})
+
+    def insertLocation(self, user_id, ts):
+        entry = ecwe.Entry.create_entry(user_id, "background/location",
+            {"ts": ts, "latitude": 37.39, "longitude": -122.08})
+        entry["metadata"]["write_ts"] = ts
+        esta.TimeSeries.get_time_series(user_id).insert(entry)
+
+    def testPendingEntryCount(self):
+        self.assertEqual(eps.get_pending_entry_count(self.heavyUUID), 20)
+        self.assertEqual(eps.get_pending_entry_count(self.idleUUID), 0)
+        edb.get_pipeline_state_db().insert_one({"user_id": self.heavyUUID,
+            "pipeline_stage": ecwp.PipelineStages.TRIP_SEGMENTATION.value,
+            "last_processed_ts": self.now - 100 + 14})
+        self.assertEqual(eps.get_pending_entry_count(self.heavyUUID), 5)
+
+    def testRecentPipelineTime(self):
+        self.assertEqual(eps.get_recent_pipeline_time(self.slowUUID), 60)
+        self.assertEqual(eps.get_recent_pipeline_time(self.heavyUUID), 0)
+
+    def testJobCosts(self):
+        jobs_df = eps.get_job_costs(self.testUUIDs, seconds_per_entry=1)
+        self.assertEqual(jobs_df.user_id.tolist(),
+                         [self.slowUUID, self.heavyUUID, self.idleUUID])
+        self.assertEqual(jobs_df.cost.tolist(), [61, 20, 0])
+
+    def getRunningStages(self, user_id):
+        return list(edb.get_pipeline_state_db().find({"user_id": user_id,
+            "curr_run_ts": {"$ne": None}}))
+
+    def testMarkRunningStagesFailed(self):
+        epq.get_time_range_for_usercache(self.heavyUUID)
+        epq.mark_usercache_done(self.heavyUUID, None)
+        epq.get_time_range_for_clean_resampling(self.heavyUUID)
+        self.assertEqual(len(self.getRunningStages(self.heavyUUID)), 1)
+        self.assertEqual(epq.mark_running_stages_failed(self.heavyUUID),
+                         [ecwp.PipelineStages.CLEAN_RESAMPLING])
+        self.assertEqual(self.getRunningStages(self.heavyUUID), [])
+        # the stage can run again
+        epq.get_time_range_for_clean_resampling(self.heavyUUID)
+        self.assertEqual(epq.mark_running_stages_failed(self.idleUUID), [])
+
+    def testDispatchQueueTimeout(self):
+        etc.setupRealExample(self, "emission/tests/data/real_examples/shankari_2015-aug-27")
+        self.testUUIDs.append(self.testUUID)
+        # every user times out as soon as the scheduler sees that it started
+        eps.dispatch_queue([self.testUUID], n_workers=1, user_timeout=0)
+        self.assertEqual(self.getRunningStages(self.testUUID), [])
+        errors = list(esta.TimeSeries.get_time_series(self.testUUID).find_entries(
+            ["stats/pipeline_error"]))
+        self.assertEqual([e["data"]["name"] for e in errors], ["WHOLE_PIPELINE"])
+
+        # and the next run processes the user
+        epi.run_intake_pipeline_for_user(self.testUUID)
+        self.assertEqual(self.getRunningStages(self.testUUID), [])
+        self.assertGreater(len(esda.get_entries(esda.CLEANED_TRIP_KEY, self.testUUID, None)), 0)
+
+if __name__ == '__main__':
+    etc.configLogging()
+    unittest.main()
@@ -11,6 +11,7 @@ import datetime as pydt
 import logging
 import json
 import pymongo
+import pandas as pd
 
 # Our imports
 import emission.core.get_database as edb
@@ -18,6 +19,7 @@ import emission.storage.timeseries.timequery as estt
 import emission.storage.timeseries.tcquery as esttc
 import emission.storage.timeseries.abstract_timeseries as esta
 import emission.storage.timeseries.aggregate_timeseries as estag
+import emission.storage.timeseries.builtin_timeseries as bits
 
 import emission.core.wrapper.localdate as ecwl
 
@@ -70,6 +72,47 @@ class TestTimeSeries(unittest.TestCase):
         logging.debug("df.columns = %s" % df.columns)
         self.assertEqual(len(df.columns), 21)
 
+    def testGetDataDfProjection(self):
+        ts = esta.TimeSeries.get_time_series(self.testUUID)
+        tq = estt.TimeQuery("metadata.write_ts", 1440658800, 1440745200)
+        df = ts.get_data_df("background/filtered_location", tq,
+                            projection=["data.ts", "data.latitude", "data.longitude"])
+        self.assertEqual(len(df), 327)
+        self.assertEqual(sorted(df.columns), ["_id", "latitude", "longitude",
+            "metadata_write_ts", "ts", "user_id"])
+
+    def testGetDataDfChunks(self):
+        ts = esta.TimeSeries.get_time_series(self.testUUID)
+        tq = estt.TimeQuery("metadata.write_ts", 1440658800, 1440745200)
+        chunks = list(ts.get_data_df_chunks("background/filtered_location", tq,
+                                            chunk_size=100))
+        self.assertEqual([len(c) for c in chunks], [100, 100, 100, 27])
+        df = ts.get_data_df("background/filtered_location", tq)
+        self.assertEqual(pd.concat(chunks).ts.tolist(), df.ts.tolist())
+
+    def testInsertBuffered(self):
+        ts = esta.TimeSeries.get_time_series(self.testUUID)
+        count = lambda key: edb.get_analysis_timeseries_db().count_documents(
+            {"user_id": self.testUUID, "metadata.key": key})
+        trip_id = ts.insert_data_buffered(self.testUUID, "analysis/inferred_trip", {"end_ts": 1})
+        label_id = ts.insert_data_buffered(self.testUUID, "inference/labels", {"trip_id": trip_id})
+        self.assertEqual(count("analysis/inferred_trip"), 0)
+        self.assertEqual(ts.flush(), 2)
+        self.assertEqual(ts.get_entry_from_id("inference/labels", label_id).data.trip_id, trip_id)
+        self.assertEqual(ts.flush(), 0)
+
+        old_buffer_size = bits.WRITE_BUFFER_SIZE
+        bits.WRITE_BUFFER_SIZE = 3
+        try:
+            for i in range(4):
+                ts.insert_data_buffered(self.testUUID, "analysis/inferred_trip", {"end_ts": i})
+            self.assertEqual(count("analysis/inferred_trip"), 4)
+            self.assertEqual(ts.flush(), 1)
+            self.assertEqual(count("analysis/inferred_trip"), 5)
+        finally:
+            bits.WRITE_BUFFER_SIZE = old_buffer_size
+            edb.get_analysis_timeseries_db().delete_many({"user_id": self.testUUID})
+
     def testExtraQueries(self):
         ts = esta.TimeSeries.get_time_series(self.testUUID)
         # Query for all of Aug
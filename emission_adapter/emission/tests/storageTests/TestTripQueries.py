@@ -193,6 +193,61 @@ class TestTripQueries(unittest.TestCase):
         self.assertEqual(new_mc, user_input.data)
         self.assertEqual(user_input.data.label, "bike")
 
+    def testBatchUserInputMatching(self):
+        """
+        Test that the batch matching returns the same matches as the per
+        object queries, with one trip that has two inputs, one with none
+        and one input that does not match any trip
+        """
+        MODE_CONFIRM_KEY = "manual/mode_confirm"
+        PURPOSE_CONFIRM_KEY = "manual/purpose_confirm"
+        ts = esta.TimeSeries.get_time_series(self.testUserId)
+
+        trips = []
+        for i in range(3):
+            new_ct = ecwct.Confirmedtrip()
+            new_ct["start_ts"] = i * 1000 + 5
+            new_ct["end_ts"] = i * 1000 + 600
+            new_ct["duration"] = 595
+            new_ct["start_fmt_time"] = "%s secs" % new_ct["start_ts"]
+            new_ct["end_fmt_time"] = "%s secs" % new_ct["end_ts"]
+            new_ct["user_input"] = {}
+            new_ct["end_place"] = None
+            trip_id = ts.insert_data(self.testUserId, "analysis/confirmed_trip", new_ct)
+            trips.append(ts.get_entry_from_id("analysis/confirmed_trip", trip_id))
+
+        for (key, start_ts, end_ts, label) in [(MODE_CONFIRM_KEY, 10, 500, "car"),
+                                               (PURPOSE_CONFIRM_KEY, 2010, 2500, "work"),
+                                               (MODE_CONFIRM_KEY, 10, 500, "bike"),
+                                               (MODE_CONFIRM_KEY, 5010, 5500, "walk")]:
+            new_label = ecul.Userlabel()
+            new_label["start_ts"] = start_ts
+            new_label["end_ts"] = end_ts
+            new_label["label"] = label
+            ts.insert_data(self.testUserId, key, new_label)
+        ui_list = [ecwe.Entry(e) for e in
+            ts.find_entries([MODE_CONFIRM_KEY, PURPOSE_CONFIRM_KEY])]
+        self.assertEqual([ui.data.label for ui in ui_list], ["car", "work", "bike", "walk"])
+
+        matched_trips = esdt.get_trips_for_user_input_objs(ts, ui_list)
+        self.assertEqual([t.get_id() if t is not None else None for t in matched_trips],
+            [trips[0].get_id(), trips[2].get_id(), trips[0].get_id(), None])
+        # the same trip object, so that both labels end up in it
+        self.assertIs(matched_trips[0], matched_trips[2])
+        for ui, trip in zip(ui_list, matched_trips):
+            expected_trip = esdt.get_trip_for_user_input_obj(ts, ui)
+            self.assertEqual(trip, expected_trip)
+
+        matched_inputs = esdt.get_user_inputs_for_trip_objects(ts, trips,
+            [MODE_CONFIRM_KEY, PURPOSE_CONFIRM_KEY])
+        self.assertEqual(matched_inputs[0][MODE_CONFIRM_KEY].data.label, "bike")
+        self.assertEqual(matched_inputs[1], {})
+        self.assertEqual(matched_inputs[2][PURPOSE_CONFIRM_KEY].data.label, "work")
+        for trip, trip_inputs in zip(trips, matched_inputs):
+            for key in [MODE_CONFIRM_KEY, PURPOSE_CONFIRM_KEY]:
+                self.assertEqual(trip_inputs.get(key),
+                    esdt.get_user_input_for_trip_object(ts, trip, key))
+
     def testUserInputRealData(self):
         np.random.seed(61297777)
         dataFile = "emission/tests/data/real_examples/shankari_single_positional_indexer.dec-12"
@@ -19,11 +19,8 @@ import requests
 from transport_co2 import estimate_co2
 
 from mtk_common.model import ngsi_template_section_observed
-from mtk_common.utils import compute_carbon_footprint, translate_transport_mode
-
-
-def pandas_compute_carbon_footprint(x):
-    return compute_carbon_footprint(x.sensed_mode, x.distance)
+from mtk_common.utils import (compute_carbon_footprint_batch, get_broker_client,
+                              translate_transport_mode)
 
 
 def create_payloads(is_df, logger):
@@ -58,7 +55,14 @@ def post_payloads(payloads, broker_url, logger):
     url = broker_url + "/ngsi-ld/v1/entities"
     headers = {"Content-Type": "application/ld+json"}
     for e in payloads:
-        r = requests.post(url, data=json.dumps(e), headers=headers)
+        try:
+            r = get_broker_client().post(url, data=json.dumps(e), headers=headers)
+        except requests.exceptions.RequestException as ex:
+            logger.error(
+                "Something went wrong connecting to the NGSI-LD broker. Maybe server is down. %s",
+                ex,
+            )
+            continue
         if r.status_code != 201:
             logger.warning("request failed: %s", r.status_code)
     logger.info("Pushed %s payloads", len(payloads))
@@ -195,7 +199,7 @@ if __name__ == "__main__":
                 continue
             new_data = True
             is_df["speed"] = is_df.distance / is_df.duration
-            is_df["co2"] = is_df.apply(pandas_compute_carbon_footprint, axis=1)
+            is_df["co2"] = compute_carbon_footprint_batch(is_df.sensed_mode, is_df.distance)
             payloads = create_payloads(is_df, logger=LOGGER)
             post_payloads(payloads, broker_url=args.url, logger=LOGGER)
         if not new_data:
@@ -6,20 +6,30 @@ import logging
 import random
 import signal
 import sys
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone
 from pathlib import Path
 from random import randrange, uniform
 
+import numpy as np
 import requests
 from mtk_common.model import (ngsi_template_emissionobserved,
                               ngsi_template_vehicle, traffic_sensor_locations,
                               transport_modes_model)
-from mtk_common.utils import (compute_carbon_footprint, get_entities,
-                              get_request, get_temporal_entities,
+from mtk_common.utils import (BrokerRequestError, RateLimiter,
+                              compute_carbon_footprint,
+                              configure_broker_client, get_broker_client,
+                              get_entities, get_request, get_temporal_entities,
                               get_transport_mode, post_payloads,
-                              translate_transport_mode)
+                              sample_transport_modes, translate_transport_mode)
+
+from notification_server import NotificationServer
+from poll_state import PollState
+from road_network_cache import RoadNetworkCache, parse_road_network
+from section_index import SectionIndex
 
 
 class GreenTransportTwin(object):
@@ -39,17 +49,52 @@ class GreenTransportTwin(object):
         poll_intervall: int,
         simulate_mode: bool,
         logger: logging.Logger,
+        workers: int = 1,
+        rate_limit: float = 0,
+        cache_file: str = ":memory:",
+        cache_ttl: int = 7 * 24 * 3600,
+        seed: int = None,
+        state_file: str = "",
+        notification_port: int = 0,
+        notification_url: str = "",
+        batch_size: int = 1000,
+        overpass_urls: list = None,
+        retry_delay: float = 30,
     ):
         self.broker_url = broker_url
         self.poll_intervall = poll_intervall
         self.simulate_mode = simulate_mode
         self.logger = logger
+        self.workers = max(1, workers)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.rng = np.random.default_rng(seed)
         self.logger.info("Green Transport Twin Created")
         self.logger.info("Broker URL: %s", self.broker_url)
         self.logger.info("Poll Intervall: %s", self.poll_intervall)
         self.logger.info("Simulate vehicle data: %s", self.simulate_mode)
-
-        self.overpass_cache = {}
+        self.logger.info("Estimation workers: %s", self.workers)
+        self.logger.info("Rate limit per host: %s requests/s", rate_limit)
+        self.logger.info("Road network cache: %s", cache_file)
+        self.notification_port = notification_port
+        self.notification_url = notification_url
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        if self.notification_port:
+            self.logger.info("Notification URL: %s", self.notification_url)
+
+        self.overpass_urls = overpass_urls or [
+            "https://overpass-api.de/api/interpreter",
+            # "http://overpass.openstreetmap.fr/api/interpreter",
+        ]
+        self.overpass_query_template = Path("./overpass_template").read_text()
+        self.road_network = RoadNetworkCache(
+            path=cache_file, logger=self.logger, ttl=cache_ttl
+        )
+        # striped locks, so that a tile is only fetched once at a time
+        self.road_network_locks = [threading.Lock() for _ in range(64)]
+        self.sections = SectionIndex(max_distance=2000)
+        self.sections_refreshed_ts = None
+        self.state = PollState(state_file, self.logger)
 
         self.running = False
         signal.signal(signal.SIGINT, self.stop)
@@ -57,27 +102,16 @@ class GreenTransportTwin(object):
 
     def start(self):
         self.running = True
+        if self.notification_port:
+            self.listen()
+            return
         while self.running:
             if self.simulate_mode:
                 self.simulate_vehicle_data()
                 sleep_time = uniform(1, 10)
             else:
-                results = []
                 t0 = time.time()
-                vehicles = get_entities(
-                    entity_type="Vehicle",
-                    observedAt_property="speed",
-                    intervall=self.poll_intervall,
-                    url=self.broker_url,
-                    logger=self.logger,
-                )
-                if len(vehicles) > 0:
-                    results = results + self.get_entity_data(vehicles)
-                tf_obs = self.get_trafficflow_entities()
-                if len(tf_obs) > 0:
-                    results = results + self.get_entity_data(tf_obs)
-                if len(results) > 0:
-                    self.estimate_emission(results, days=7, section_observed=False)
+                vehicles, tf_obs = self.poll()
                 t1 = time.time()
                 delta = t1 - t0
                 self.logger.info(
@@ -86,7 +120,7 @@ class GreenTransportTwin(object):
                     len(tf_obs),
                     delta,
                 )
-                sleep_time = args.intervall - delta
+                sleep_time = self.poll_intervall - delta
                 sleep_time = (
                     sleep_time * 0.95
                 )  # sleeping a bit less so we make sure to process all data
@@ -99,6 +133,147 @@ class GreenTransportTwin(object):
                 if not self.running:
                     break
 
+    def poll(self) -> tuple:
+        """
+        fetch and process the Vehicle and TrafficFlowObserved entities
+        observed since the last poll, returns both entity lists. If a query
+        fails, nothing is processed and the watermarks stay where they are.
+        """
+
+        try:
+            vehicles = get_entities(
+                entity_type="Vehicle",
+                observedAt_property="speed",
+                intervall=self.poll_intervall,
+                url=self.broker_url,
+                logger=self.logger,
+                since=self.state.get_watermark("Vehicle", self.poll_intervall),
+            )
+            tf_obs = self.get_trafficflow_entities()
+        except BrokerRequestError as e:
+            self.logger.warning("Poll failed, retrying in the next poll: %s", e)
+            return [], []
+        self.process_entities(vehicles, tf_obs)
+        return vehicles, tf_obs
+
+    def process_entities(self, vehicles: list, tf_obs: list) -> bool:
+        """
+        estimate and push EmissionObserved for Vehicle and TrafficFlowObserved
+        entities that have not been processed yet and advance the watermarks.
+        Returns False if the estimates could not be pushed.
+        """
+
+        vehicle_results = self.state.filter_new(self.get_entity_data(vehicles))
+        tf_results = self.state.filter_new(self.get_entity_data(tf_obs))
+        results = vehicle_results + tf_results
+        if len(results) > 0:
+            if not self.estimate_emission(results, days=7, section_observed=False):
+                return False
+            self.state.commit("Vehicle", vehicle_results)
+            self.state.commit("TrafficFlowObserved", tf_results)
+        return True
+
+    def listen(self):
+        """
+        subscribe to Vehicle and TrafficFlowObserved changes and estimate
+        emissions for the notified entities in batches instead of polling.
+        Failed subscriptions are retried, and a batch that could not be pushed
+        is put back on the queue and retried after retry_delay seconds.
+        """
+
+        server = NotificationServer(self.notification_port, self.logger)
+        server.start()
+        for entity_type, watched_attribute in [
+            ("Vehicle", "speed"),
+            ("TrafficFlowObserved", "intensity"),
+        ]:
+            while self.running and not self.subscribe(
+                entity_type, watched_attribute
+            ):
+                self.logger.warning(
+                    "Retrying subscription in %s seconds", self.retry_delay
+                )
+                self.sleep(self.retry_delay)
+        while self.running:
+            entities = server.next_batch(self.batch_size, batch_timeout=1)
+            if not entities:
+                continue
+            t0 = time.time()
+            vehicles = [e for e in entities if e["type"] == "Vehicle"]
+            tf_obs = [e for e in entities if e["type"] == "TrafficFlowObserved"]
+            if not self.process_entities(vehicles, tf_obs):
+                self.logger.warning(
+                    "Could not push estimates for %s notified entities, retrying in %s seconds",
+                    len(entities),
+                    self.retry_delay,
+                )
+                server.requeue(entities)
+                self.sleep(self.retry_delay)
+                continue
+            self.logger.info(
+                "Processed %s notified Vehicles and %s TrafficFlowObserved in %s seconds",
+                len(vehicles),
+                len(tf_obs),
+                time.time() - t0,
+            )
+        server.stop()
+
+    def sleep(self, seconds: float) -> None:
+        """
+        sleep up to seconds, waking up every second to check whether the twin
+        was stopped
+        """
+
+        end = time.time() + seconds
+        while self.running and time.time() < end:
+            time.sleep(min(1, end - time.time()))
+
+    def subscribe(self, entity_type: str, watched_attribute: str) -> bool:
+        """
+        create or update the NGSI-LD subscription that notifies the
+        notification endpoint about changes of watched_attribute
+        """
+
+        subscription_id = "urn:ngsi-ld:Subscription:GreenTransportTwin:" + entity_type
+        payload = {
+            "id": subscription_id,
+            "type": "Subscription",
+            "entities": [{"type": entity_type}],
+            "watchedAttributes": [watched_attribute],
+            "notification": {
+                "format": "normalized",
+                "endpoint": {
+                    "uri": self.notification_url,
+                    "accept": "application/json",
+                },
+            },
+            "@context": [
+                "https://raw.githubusercontent.com/smart-data-models/data-models/master/context.jsonld",
+                "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld",
+            ],
+        }
+        headers = {"Content-Type": "application/ld+json"}
+        url = self.broker_url + "/ngsi-ld/v1/subscriptions/"
+        try:
+            r = get_broker_client().post(url, data=json.dumps(payload), headers=headers)
+            if r.status_code == 409:
+                # subscription exists from an earlier run, make sure it is up to date
+                del payload["id"]
+                r = get_broker_client().patch(
+                    url + subscription_id, data=json.dumps(payload), headers=headers
+                )
+        except requests.exceptions.RequestException as e:
+            self.logger.error(
+                "Something went wrong connecting to the NGSI-LD broker. Maybe server is down. %s",
+                e,
+            )
+            return False
+        if r.status_code not in [201, 204]:
+            self.logger.warning("Subscription failed %s %s", r.status_code, r.text)
+            return False
+        self.logger.info("Subscribed to %s notifications", entity_type)
+        return True
+
     def stop(self, *args):
         self.logger.info("Shutting down...")
         self.running = False
@@ -106,11 +281,13 @@ class GreenTransportTwin(object):
 
     def get_trafficflow_entities(self):
         """
-        get all versions of TrafficFlowObserved entities during the poll_intervall
+        get all versions of TrafficFlowObserved entities observed since the
+        TrafficFlowObserved watermark
         """
 
         entity_type = "TrafficFlowObserved"
         observedAt_property = "intensity"
+        since = self.state.get_watermark(entity_type, self.poll_intervall)
 
         # 1. get changed entities with normal query for all metadata
         entities_normal = get_entities(
@@ -119,6 +296,7 @@ class GreenTransportTwin(object):
             url=self.broker_url,
             intervall=self.poll_intervall,
             logger=self.logger,
+            since=since,
         )
         if not entities_normal:
             return []
@@ -137,6 +315,7 @@ class GreenTransportTwin(object):
             intervall=self.poll_intervall,
             url=self.broker_url,
             logger=self.logger,
+            since=since,
         )
         if not entities_temporal:
             return []
@@ -205,7 +384,7 @@ class GreenTransportTwin(object):
                         )
                         headers = {"Content-Type": "application/ld+json"}
                         try:
-                            r = requests.post(
+                            r = get_broker_client().post(
                                 self.broker_url + "/ngsi-ld/v1/entities",
                                 data=json.dumps(payload),
                                 headers=headers,
@@ -242,62 +421,62 @@ class GreenTransportTwin(object):
         """
 
         self.logger.debug("get_simulated_point")
-        query_file = open("./overpass_template")
-        query_string = "".join(query_file.readlines())
-        osm_urls = [
-            "https://overpass-api.de/api/interpreter",
-            # "http://overpass.openstreetmap.fr/api/interpreter",
-        ]
-        bbox_string = "around:%s,%s,%s" % (radius, lat, lon)
-        if bbox_string in self.overpass_cache:
-            res_json = self.overpass_cache[bbox_string]
-        else:
-            overpass_public_transit_query_template = query_string
-            overpass_query = overpass_public_transit_query_template.replace(
-                "bbox", bbox_string
-            )
-            status_code = 404
-            while status_code != 200:
-                osm_url = random.choice(osm_urls)
-                try:
-                    response = requests.post(osm_url, data=overpass_query, timeout=60.0)
-                    status_code = response.status_code
-                    if status_code != 200:
-                        self.logger.debug(
-                            "Connection to OSM failed, status code %s", status_code
-                        )
-                        time.sleep(30)
-                except:
-                    self.logger.error(
-                        "Something went wrong connecting to the OSM server, trying again."
+        key, tile_lon, tile_lat, tile_radius = self.road_network.get_tile(
+            lon, lat, radius
+        )
+        ways = self.road_network.get(key)
+        if ways is None:
+            lock = self.road_network_locks[hash(key) % len(self.road_network_locks)]
+            with lock:
+                ways = self.road_network.get(key)
+                if ways is None:
+                    ways = parse_road_network(
+                        self.query_overpass(tile_lon, tile_lat, tile_radius)
                     )
-                    time.sleep(30)
+                    self.road_network.put(key, ways)
 
-            res_json = response.json()
-            self.overpass_cache[bbox_string] = res_json
-        ways = {}
-        nodes = {}
-        for e in res_json["elements"]:
-            if e["type"] == "way":
-                if e["tags"]["highway"] not in ways:
-                    ways[e["tags"]["highway"]] = []
-                ways[e["tags"]["highway"]].append(random.choice(e["nodes"]))
-            if e["type"] == "node":
-                nodes[e["id"]] = [e["lon"], e["lat"]]
-
-        common_keys = set(ways) & set(transport_modes_model[transport_mode]["highways"])
+        highways = transport_modes_model[transport_mode].get("highways", {})
+        common_keys = set(ways) & set(highways)
         aggregated = {}
         if not common_keys:
             self.logger.warning("No common paths between OSM and transport mode found")
             return []
         for key in common_keys:
             length = len(ways[key])
-            weight = transport_modes_model[transport_mode]["highways"][key]
+            weight = highways[key]
             aggregated[key] = length + weight
         choice = random.choices(
             population=list(aggregated.keys()), weights=list(aggregated.values()), k=1
         )[0]
-        return nodes[random.choice(ways[choice])]
+        return random.choice(random.choice(ways[choice]))
+
+    def query_overpass(self, lon: float, lat: float, radius: int) -> dict:
+        """
+        query all highways within radius meters around a point from Overpass,
+        retrying until the query succeeds
+        """
+
+        osm_urls = self.overpass_urls
+        bbox_string = "around:%s,%s,%s" % (radius, lat, lon)
+        overpass_query = self.overpass_query_template.replace("bbox", bbox_string)
+        status_code = 404
+        while status_code != 200:
+            osm_url = random.choice(osm_urls)
+            self.rate_limiter.wait(osm_url)
+            try:
+                response = requests.post(osm_url, data=overpass_query, timeout=60.0)
+                status_code = response.status_code
+                if status_code != 200:
+                    self.logger.debug(
+                        "Connection to OSM failed, status code %s", status_code
+                    )
+                    time.sleep(30)
+            except:
+                self.logger.error(
+                    "Something went wrong connecting to the OSM server, trying again."
+                )
+                time.sleep(30)
+        return response.json()
 
     def get_entity_data(self, entities: list) -> list:
         """
@@ -337,98 +516,133 @@ class GreenTransportTwin(object):
                     )
         return results
 
-    def get_means(
-        self, vehicle_transport_mode: str, coordinates: list, days: int
-    ) -> list:
+    def refresh_sections(self, days: int) -> None:
         """
-        get distance and speed means based on available SectionObserved entities
+        incrementally update the SectionObserved index with the sections
+        observed since the last refresh and drop sections older than days. If
+        the query fails, the next refresh starts from the last successful one.
         """
 
-        payload = {"type": "SectionObserved", "timerel": "after"}
-        payload["time"] = (
-            datetime.datetime.now() - datetime.timedelta(days=days)
-        ).strftime("%Y-%m-%dT%H:%M:%SZ")
-        payload["georel"] = "near;maxDistance==2000"
-        payload["geometry"] = "Point"
-        payload["coordinates"] = str(coordinates).replace(" ", "")
-        broker_temp_url = self.broker_url + "/ngsi-ld/v1/temporal/entities/"
+        now = time.time()
+        oldest_ts = now - days * 24 * 3600
+        since = oldest_ts
+        if self.sections_refreshed_ts:
+            # overlap a bit with the last refresh, re-adding a section is harmless
+            since = max(oldest_ts, self.sections_refreshed_ts - 60)
+        params = {
+            "type": "SectionObserved",
+            "timerel": "after",
+            "time": datetime.datetime.fromtimestamp(since, timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+        }
+        added = 0
         try:
-            r = requests.get(broker_temp_url, params=payload)
-            sections = r.json()
-        except requests.exceptions.RequestException as e:
-            self.logger.error(
-                "Something went wrong connecting to the NGSI-LD broker. Maybe server is down."
+            sections = get_request(
+                url=self.broker_url + "/ngsi-ld/v1/temporal/entities/",
+                params=params,
+                headers={},
+                logger=self.logger,
+                raise_errors=True,
             )
-            return []
-        matching_sections = []
-        for s in sections:
-            if "odala:transportMode" not in s:
-                continue
-            if vehicle_transport_mode == translate_transport_mode(
-                s["odala:transportMode"]["value"]
-            ):
-                distance = s["odala:distance"]["value"]
-                speed = s["odala:speed"]["value"]  # FIXME
-                matching_sections.append([distance, speed])
-        sums = [sum(x) for x in zip(*matching_sections)]
-        means = [x / len(matching_sections) for x in sums]
-        return means
-
-    def estimate_emission(self, results: list, days=7, section_observed=False) -> None:
+            added = self.sections.update(sections)
+            self.sections_refreshed_ts = now
+        except BrokerRequestError as e:
+            self.logger.warning("Could not refresh SectionObserved index: %s", e)
+        removed = self.sections.prune(oldest_ts)
+        self.logger.info(
+            "SectionObserved index: %s added, %s expired, %s total",
+            added,
+            removed,
+            len(self.sections.sections),
+        )
+
+    def estimate_emission(self, results: list, days=7, section_observed=False) -> bool:
         """
         estimate EmissionObserved based on available SectionObserved or
-        transport_modes_model defined in model.py and push to scorpio
+        transport_modes_model defined in model.py and push to scorpio. Default
+        distances and CO2 values are sampled for all results at once. With
+        more than one worker, the remaining per-result work is done
+        concurrently on a thread pool; payloads are collected in the order of
+        the results. Returns whether all payloads were pushed successfully.
         """
 
         self.logger.debug("estimate_emission")
-        payloads = []
-        cache = {}
-        for result in results:
-            emission_obs_id = result[0]
-            observedAt = result[1]
-            vehicle_transport_mode = result[2]
-            coordinates = result[3]
-            means = []
-            if section_observed:
-                self.logger.info("Using existing SectionObserved entities")
-                if str(coordinates) in cache:
-                    self.logger.info("using cache")
-                    means = cache[str(coordinates)]
-                else:
-                    means = self.get_means(vehicle_transport_mode, coordinates, days)
-                    cache[str(coordinates)] = means
-            if len(means) > 0:
-                # use emission based values
-                distance_avg = means[0]
-                speed_avg = means[1]
-            else:
-                self.logger.debug("using default values")
-                # use default values
-                distance_dist = transport_modes_model[vehicle_transport_mode][
-                    "distance"
-                ]
-                distance_avg = distance_dist[randrange(len(distance_dist))]
-
-                speed_dist = transport_modes_model[vehicle_transport_mode]["speed"]
-                speed_avg = speed_dist[randrange(len(speed_dist))]
+        if section_observed:
+            self.refresh_sections(days)
+        _, _, co2s = sample_transport_modes(
+            [result[2] for result in results], rng=self.rng
+        )
+        samples = list(zip(results, co2s))
+        if self.workers > 1 and len(results) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                payloads = list(
+                    executor.map(
+                        lambda sample: self.estimate_single_emission(
+                            sample[0], sample[1], section_observed
+                        ),
+                        samples,
+                    )
+                )
+        else:
+            payloads = [
+                self.estimate_single_emission(result, co2, section_observed)
+                for result, co2 in samples
+            ]
+        payloads = [payload for payload in payloads if payload]
+        return post_payloads(
+            payloads=payloads, broker_url=self.broker_url, logger=self.logger
+        )
 
-            co2 = compute_carbon_footprint(vehicle_transport_mode, distance_avg)
+    def estimate_single_emission(
+        self,
+        result: tuple,
+        default_co2: float,
+        section_observed: bool,
+    ) -> dict:
+        """
+        estimate a single EmissionObserved payload for a (id, observedAt,
+        transport mode, coordinates) tuple returned by get_entity_data.
+        default_co2 is used if no SectionObserved means are available.
+        """
 
-            coordinates_sim = self.get_simulated_point(
-                vehicle_transport_mode, coordinates[0], coordinates[1], 500
+        emission_obs_id = result[0]
+        observedAt = result[1]
+        vehicle_transport_mode = result[2]
+        coordinates = result[3]
+        means = []
+        if section_observed:
+            self.logger.debug("Using existing SectionObserved entities")
+            means = self.sections.get_means(vehicle_transport_mode, coordinates)
+        if len(means) > 0:
+            # use emission based values
+            co2 = compute_carbon_footprint(vehicle_transport_mode, means[0])
+        else:
+            self.logger.debug("using default values")
+            co2 = default_co2
+        if np.isnan(co2):
+            self.logger.warning(
+                "No transport model for %s, skipping %s",
+                vehicle_transport_mode,
+                emission_obs_id,
             )
-            if not coordinates_sim:
-                continue
+            return {}
+        co2 = float(co2)
 
-            emission_observed = copy.deepcopy(ngsi_template_emissionobserved)
-            emission_observed["id"] = emission_obs_id
-            emission_observed["location"]["observedAt"] = observedAt
-            emission_observed["location"]["value"]["coordinates"] = coordinates_sim
-            emission_observed["co2"]["observedAt"] = observedAt
-            emission_observed["co2"]["value"] = co2
-            # emission_observed["abstractionLevel"] = {"type": "Property", "value": 17}
-            payloads.append(emission_observed)
-        post_payloads(payloads=payloads, broker_url=self.broker_url, logger=self.logger)
+        coordinates_sim = self.get_simulated_point(
+            vehicle_transport_mode, coordinates[0], coordinates[1], 500
+        )
+        if not coordinates_sim:
+            return {}
+
+        emission_observed = copy.deepcopy(ngsi_template_emissionobserved)
+        emission_observed["id"] = emission_obs_id
+        emission_observed["location"]["observedAt"] = observedAt
+        emission_observed["location"]["value"]["coordinates"] = coordinates_sim
+        emission_observed["co2"]["observedAt"] = observedAt
+        emission_observed["co2"]["value"] = co2
+        # emission_observed["abstractionLevel"] = {"type": "Property", "value": 17}
+        return emission_observed
 
 
 if __name__ == "__main__":
@@ -476,6 +690,87 @@ if __name__ == "__main__":
         help="Simulate vehicle data, 0|1",
     )
 
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        required=False,
+        default=8,
+        help="Number of concurrent workers for emission estimation",
+    )
+
+    parser.add_argument(
+        "--rate_limit",
+        dest="rate_limit",
+        type=float,
+        required=False,
+        default=10,
+        help="Maximum requests per second to the same host, 0 for no limit",
+    )
+
+    parser.add_argument(
+        "--cache_file",
+        dest="cache_file",
+        type=str,
+        required=False,
+        default="./road_network_cache.sqlite",
+        help="SQLite file for the OpenStreetMap road network cache",
+    )
+
+    parser.add_argument(
+        "--cache_ttl",
+        dest="cache_ttl",
+        type=int,
+        required=False,
+        default=7 * 24 * 3600,
+        help="Time in seconds after which cached road networks are refreshed",
+    )
+
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        required=False,
+        default=None,
+        help="Seed for sampling from the transport model",
+    )
+
+    parser.add_argument(
+        "--state_file",
+        dest="state_file",
+        type=str,
+        required=False,
+        default="./green_transport_twin_state.json",
+        help="JSON file to persist poll watermarks across restarts",
+    )
+
+    parser.add_argument(
+        "--notification_port",
+        dest="notification_port",
+        type=int,
+        required=False,
+        default=0,
+        help="Port for NGSI-LD notifications, 0 to poll the broker instead",
+    )
+
+    parser.add_argument(
+        "--notification_url",
+        dest="notification_url",
+        type=str,
+        required=False,
+        default="http://green_transport_twin:8080/notify",
+        help="URL under which the broker reaches the notification port",
+    )
+
+    parser.add_argument(
+        "--batch_size",
+        dest="batch_size",
+        type=int,
+        required=False,
+        default=1000,
+        help="Maximum number of notified entities estimated in one batch",
+    )
+
     args = parser.parse_args()
 
     LOGGER = logging.getLogger("green_transport_twin")
@@ -497,11 +792,22 @@ if __name__ == "__main__":
         LOGGER.addHandler(sh)
 
     LOGGER.info("Green Transport Twin starting...")
+    # one pooled connection per estimation worker plus the main thread
+    configure_broker_client(pool_size=args.workers + 1)
     green_transport_twin = GreenTransportTwin(
         broker_url=args.url,
         poll_intervall=args.intervall,
         simulate_mode=bool(args.simulate),
         logger=LOGGER,
+        workers=args.workers,
+        rate_limit=args.rate_limit,
+        cache_file=args.cache_file,
+        cache_ttl=args.cache_ttl,
+        seed=args.seed,
+        state_file=args.state_file,
+        notification_port=args.notification_port,
+        notification_url=args.notification_url,
+        batch_size=args.batch_size,
     )
 
     green_transport_twin.start()
@@ -0,0 +1,84 @@
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    """
+    Accepts NGSI-LD notifications and puts the notified entities on the queue
+    of the server.
+    """
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            notification = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.server.logger.warning("Received invalid notification")
+            self.send_response(400)
+            self.end_headers()
+            return
+        entities = notification.get("data", [])
+        for e in entities:
+            self.server.notifications.put(e)
+        self.server.logger.debug(
+            "Received notification %s with %s entities",
+            notification.get("id", ""),
+            len(entities),
+        )
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format, *args)
+
+
+class NotificationServer(ThreadingHTTPServer):
+    """
+    Small HTTP endpoint for NGSI-LD subscriptions, running in a background
+    thread. Notified entities are collected in notifications and can be taken
+    out in batches with next_batch.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int, logger: logging.Logger):
+        super().__init__(("", port), NotificationHandler)
+        self.logger = logger
+        self.notifications = queue.Queue()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+        self.logger.info("Listening for notifications on port %s", self.server_port)
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def requeue(self, entities: list) -> None:
+        """
+        put entities that could not be processed back on the queue
+        """
+
+        for e in entities:
+            self.notifications.put(e)
+
+    def next_batch(self, batch_size: int, batch_timeout: float) -> list:
+        """
+        wait up to batch_timeout seconds for notified entities and return at
+        most batch_size of them, [] if nothing was notified
+        """
+
+        try:
+            entities = [self.notifications.get(timeout=batch_timeout)]
+        except queue.Empty:
+            return []
+        while len(entities) < batch_size:
+            try:
+                entities.append(self.notifications.get_nowait())
+            except queue.Empty:
+                break
+        return entities
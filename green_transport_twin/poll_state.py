@@ -0,0 +1,88 @@
+import datetime
+import json
+import logging
+import os
+from datetime import timezone
+
+
+def parse_observed_at(observed_at: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(observed_at.replace("Z", "+00:00"))
+
+
+def format_observed_at(observed_at: datetime.datetime) -> str:
+    return observed_at.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class PollState(object):
+    """
+    Persistent polling state of the Green Transport Twin: the high-watermark
+    (latest processed observedAt) per entity type and the (id, observedAt)
+    keys of already emitted EmissionObserved entities. Entities are queried
+    from the watermark on (inclusive), so observations sharing the watermark
+    second are fetched again and filtered out with the emitted keys. Keys
+    older than the oldest watermark can not be fetched again and are pruned.
+    The state is written to a JSON file so restarts resume where they stopped.
+    """
+
+    def __init__(self, path: str, logger: logging.Logger):
+        self.path = path
+        self.logger = logger
+        self.watermarks = {}
+        self.emitted = set()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+                self.watermarks = state.get("watermarks", {})
+                self.emitted = set(tuple(k) for k in state.get("emitted", []))
+                self.logger.info("Resuming from watermarks %s", self.watermarks)
+            except (ValueError, OSError) as e:
+                self.logger.error("Could not read poll state %s: %s", path, e)
+
+    def get_watermark(self, entity_type: str, intervall: int) -> str:
+        """
+        get the watermark of entity_type, or intervall seconds before now if
+        there is none yet
+        """
+
+        if entity_type in self.watermarks:
+            return self.watermarks[entity_type]
+        return format_observed_at(
+            datetime.datetime.now(timezone.utc) - datetime.timedelta(seconds=intervall)
+        )
+
+    def filter_new(self, results: list) -> list:
+        """
+        filter out (id, observedAt, ...) results that have already been emitted
+        """
+
+        return [r for r in results if (r[0], r[1]) not in self.emitted]
+
+    def commit(self, entity_type: str, results: list) -> None:
+        """
+        mark results of entity_type as emitted, advance its watermark to the
+        latest observedAt and save the state
+        """
+
+        if not results:
+            return
+        self.emitted.update((r[0], r[1]) for r in results)
+        latest = max(parse_observed_at(r[1]) for r in results)
+        if entity_type in self.watermarks:
+            latest = max(latest, parse_observed_at(self.watermarks[entity_type]))
+        self.watermarks[entity_type] = format_observed_at(latest)
+        oldest = min(parse_observed_at(w) for w in self.watermarks.values())
+        self.emitted = set(
+            k for k in self.emitted if parse_observed_at(k[1]) >= oldest
+        )
+        self.save()
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"watermarks": self.watermarks, "emitted": sorted(self.emitted)}, f
+            )
+        os.replace(tmp_path, self.path)
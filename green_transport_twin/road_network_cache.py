@@ -0,0 +1,192 @@
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lon: float, lat: float, precision: int) -> str:
+    """
+    Encode a coordinate as a geohash string with the given number of
+    characters.
+    """
+
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        value, value_range = (lon, lon_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits = bits << 1
+        if value >= mid:
+            bits = bits | 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count = bit_count + 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def geohash_bbox(geohash: str) -> tuple:
+    """
+    Decode a geohash string to its bounding box (lon_min, lat_min, lon_max,
+    lat_max).
+    """
+
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    even = True
+    for c in geohash:
+        bits = GEOHASH_ALPHABET.index(c)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return lon_range[0], lat_range[0], lon_range[1], lat_range[1]
+
+
+def parse_road_network(res_json: dict) -> dict:
+    """
+    Parse an Overpass response into the node coordinates of all ways, grouped
+    by highway type: {highway: [[[lon, lat], ...], ...]}.
+    """
+
+    nodes = {}
+    for e in res_json["elements"]:
+        if e["type"] == "node":
+            nodes[e["id"]] = [e["lon"], e["lat"]]
+    ways = {}
+    for e in res_json["elements"]:
+        if e["type"] != "way" or "highway" not in e.get("tags", {}):
+            continue
+        way = [nodes[n] for n in e["nodes"] if n in nodes]
+        if way:
+            ways.setdefault(e["tags"]["highway"], []).append(way)
+    return ways
+
+
+class RoadNetworkCache(object):
+    """
+    Persistent cache of the road network around traffic sensors. Entries are
+    keyed by geohash tile, so sensors that are only a few metres apart share
+    one entry, and are stored already parsed by parse_road_network. Recently
+    used entries are kept in memory (LRU), all entries are stored in SQLite so
+    they survive restarts and expire after ttl seconds. Memory hits update
+    last_used in SQLite at most every touch_interval seconds per entry, so the
+    hottest entries are not the first ones evicted from SQLite.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        logger: logging.Logger,
+        precision: int = 7,
+        ttl: int = 7 * 24 * 3600,
+        max_entries: int = 1000,
+        touch_interval: int = 60,
+    ):
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.logger = logger
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS road_network "
+            "(key TEXT PRIMARY KEY, fetched_at REAL, last_used REAL, ways TEXT)"
+        )
+        self.db.commit()
+
+    def get_tile(self, lon: float, lat: float, radius: int) -> tuple:
+        """
+        get the cache key for a coordinate and the (lon, lat, radius) of the
+        query that covers the radius around every point of its tile
+        """
+
+        geohash = geohash_encode(lon, lat, self.precision)
+        lon_min, lat_min, lon_max, lat_max = geohash_bbox(geohash)
+        center_lon = (lon_min + lon_max) / 2
+        center_lat = (lat_min + lat_max) / 2
+        half_diagonal = 0.5 * math.hypot(
+            (lon_max - lon_min) * 111320 * math.cos(math.radians(center_lat)),
+            (lat_max - lat_min) * 110540,
+        )
+        key = "%s:%s" % (geohash, radius)
+        return key, center_lon, center_lat, int(math.ceil(radius + half_diagonal))
+
+    def get(self, key: str) -> dict:
+        """
+        get the parsed road network for a key, None if it is not cached or
+        expired
+        """
+
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                fetched_at, used_at, ways = self.memory[key]
+                if now - fetched_at < self.ttl:
+                    self.memory.move_to_end(key)
+                    if now - used_at >= self.touch_interval:
+                        self.db.execute(
+                            "UPDATE road_network SET last_used = ? WHERE key = ?",
+                            (now, key),
+                        )
+                        self.db.commit()
+                        self.memory[key] = (fetched_at, now, ways)
+                    return ways
+                del self.memory[key]
+            row = self.db.execute(
+                "SELECT fetched_at, ways FROM road_network WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[0] >= self.ttl:
+                self.db.execute("DELETE FROM road_network WHERE key = ?", (key,))
+                self.db.commit()
+                return None
+            ways = json.loads(row[1])
+            self.db.execute(
+                "UPDATE road_network SET last_used = ? WHERE key = ?", (now, key)
+            )
+            self.db.commit()
+            self.remember(key, row[0], now, ways)
+            return ways
+
+    def put(self, key: str, ways: dict) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO road_network VALUES (?, ?, ?, ?)",
+                (key, now, now, json.dumps(ways)),
+            )
+            self.db.execute(
+                "DELETE FROM road_network WHERE key NOT IN "
+                "(SELECT key FROM road_network ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self.db.commit()
+            self.remember(key, now, now, ways)
+
+    def remember(self, key: str, fetched_at: float, used_at: float, ways: dict) -> None:
+        self.memory[key] = (fetched_at, used_at, ways)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,188 @@
+import datetime
+import math
+import time
+
+from mtk_common.utils import translate_transport_mode
+
+METERS_PER_DEGREE = 111320
+
+
+def last_instance(attribute):
+    """
+    temporal queries return a list of instances for attributes with more than
+    one instance and a single dict otherwise
+    """
+
+    if isinstance(attribute, list):
+        return attribute[-1] if attribute else None
+    return attribute
+
+
+def point_segment_distance(point: list, start: list, end: list) -> float:
+    """
+    approximate distance in meters between a point and a segment, using an
+    equirectangular projection around the point
+    """
+
+    scale_x = METERS_PER_DEGREE * math.cos(math.radians(point[1]))
+    px, py = 0.0, 0.0
+    ax, ay = (start[0] - point[0]) * scale_x, (start[1] - point[1]) * METERS_PER_DEGREE
+    bx, by = (end[0] - point[0]) * scale_x, (end[1] - point[1]) * METERS_PER_DEGREE
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    t = 0.0
+    if length_sq > 0:
+        t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+    return math.hypot(ax + t * dx - px, ay + t * dy - py)
+
+
+class SectionIndex(object):
+    """
+    In-memory grid index over SectionObserved linestrings. Every section is
+    registered in all grid cells touched by the bounding boxes of its
+    segments, so a query only has to look at the sections in the cells around
+    a location instead of asking the broker for a geo-query. Cells are
+    max_distance degrees of latitude high and wide, so the cells within
+    max_distance of a point are its neighbours in latitude and
+    1/cos(latitude) neighbours in longitude.
+    """
+
+    def __init__(self, max_distance: int = 2000):
+        self.max_distance = max_distance
+        self.cell_size = max_distance / METERS_PER_DEGREE
+        self.sections = {}
+        self.cells = {}
+
+    def cell(self, lon: float, lat: float) -> tuple:
+        return int(math.floor(lon / self.cell_size)), int(
+            math.floor(lat / self.cell_size)
+        )
+
+    def section_cells(self, coordinates: list) -> set:
+        cells = set()
+        if len(coordinates) == 1:
+            coordinates = coordinates * 2
+        for start, end in zip(coordinates, coordinates[1:]):
+            x0, y0 = self.cell(min(start[0], end[0]), min(start[1], end[1]))
+            x1, y1 = self.cell(max(start[0], end[0]), max(start[1], end[1]))
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    cells.add((x, y))
+        return cells
+
+    def add(
+        self,
+        section_id: str,
+        transport_mode: str,
+        distance: float,
+        speed: float,
+        coordinates: list,
+        observed_ts: float,
+    ) -> None:
+        """
+        add or replace a section
+        """
+
+        self.remove(section_id)
+        cells = self.section_cells(coordinates)
+        self.sections[section_id] = {
+            "transport_mode": translate_transport_mode(transport_mode),
+            "distance": distance,
+            "speed": speed,
+            "coordinates": coordinates,
+            "observed_ts": observed_ts,
+            "cells": cells,
+        }
+        for c in cells:
+            self.cells.setdefault(c, set()).add(section_id)
+
+    def remove(self, section_id: str) -> None:
+        section = self.sections.pop(section_id, None)
+        if section is None:
+            return
+        for c in section["cells"]:
+            self.cells[c].discard(section_id)
+            if not self.cells[c]:
+                del self.cells[c]
+
+    def update(self, sections: list) -> int:
+        """
+        add SectionObserved entities as returned by a temporal query, returns
+        the number of sections that were added
+        """
+
+        added = 0
+        for s in sections:
+            mode = last_instance(s.get("odala:transportMode"))
+            distance = last_instance(s.get("odala:distance"))
+            speed = last_instance(s.get("odala:speed"))
+            location = last_instance(s.get("location"))
+            if not mode or not distance or not speed or not location:
+                continue
+            observed_ts = time.time()
+            if "observedAt" in distance:
+                observed_ts = (
+                    datetime.datetime.strptime(
+                        distance["observedAt"][:19], "%Y-%m-%dT%H:%M:%S"
+                    )
+                    .replace(tzinfo=datetime.timezone.utc)
+                    .timestamp()
+                )
+            coordinates = location["value"]["coordinates"]
+            if location["value"]["type"] == "Point":
+                coordinates = [coordinates]
+            self.add(
+                s["id"],
+                mode["value"],
+                distance["value"],
+                speed["value"],
+                coordinates,
+                observed_ts,
+            )
+            added = added + 1
+        return added
+
+    def prune(self, oldest_ts: float) -> int:
+        """
+        remove all sections observed before oldest_ts, returns the number of
+        removed sections
+        """
+
+        expired = [
+            section_id
+            for section_id, section in self.sections.items()
+            if section["observed_ts"] < oldest_ts
+        ]
+        for section_id in expired:
+            self.remove(section_id)
+        return len(expired)
+
+    def get_means(self, transport_mode: str, coordinates: list) -> list:
+        """
+        get [distance, speed] means of all sections of transport_mode within
+        max_distance of coordinates, [] if there are none
+        """
+
+        x, y = self.cell(coordinates[0], coordinates[1])
+        dx = int(math.ceil(1 / max(math.cos(math.radians(coordinates[1])), 0.01)))
+        candidates = set()
+        for cx in range(x - dx, x + dx + 1):
+            for cy in range(y - 1, y + 2):
+                candidates.update(self.cells.get((cx, cy), ()))
+        matching_sections = []
+        for section_id in candidates:
+            section = self.sections[section_id]
+            if section["transport_mode"] != transport_mode:
+                continue
+            points = section["coordinates"]
+            if len(points) == 1:
+                points = points * 2
+            if any(
+                point_segment_distance(coordinates, start, end) <= self.max_distance
+                for start, end in zip(points, points[1:])
+            ):
+                matching_sections.append([section["distance"], section["speed"]])
+        if not matching_sections:
+            return []
+        sums = [sum(x) for x in zip(*matching_sections)]
+        return [x / len(matching_sections) for x in sums]
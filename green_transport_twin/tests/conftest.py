@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the twin is run from its own directory, with its modules next to it
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,170 @@
+import json
+import logging
+import signal
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+from mtk_common import utils
+
+from green_transport_twin import GreenTransportTwin
+from poll_state import parse_observed_at
+
+LOGGER = logging.getLogger("test_green_transport_twin")
+
+VEHICLE = {
+    "id": "urn:ngsi-ld:Vehicle:1",
+    "type": "Vehicle",
+    "vehicleType": {"type": "Property", "value": "car"},
+    "location": {
+        "type": "GeoProperty",
+        "value": {"type": "Point", "coordinates": [8.0, 49.0]},
+    },
+    "speed": {"type": "Property", "value": 50, "observedAt": "2026-10-18T12:00:00Z"},
+}
+
+
+class StubBrokerHandler(BaseHTTPRequestHandler):
+    """
+    Accepts subscriptions and upserts and answers queries with [], failing
+    the first server.failures[path] requests to a path with status code 500.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        failed = self.server.failures.get(url.path, 0) > 0
+        if failed:
+            self.server.failures[url.path] -= 1
+        self.server.requests.append((url.path, parse_qs(url.query), not failed))
+        body = b"[]"
+        self.send_response(500 if failed else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        failed = self.server.failures.get(self.path, 0) > 0
+        if failed:
+            self.server.failures[self.path] -= 1
+        self.server.requests.append((self.path, body, not failed))
+        self.send_response(500 if failed else 201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def broker():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBrokerHandler)
+    server.failures = {}
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    utils.configure_broker_client(retries=0)
+    yield server
+    server.shutdown()
+    server.server_close()
+    utils.configure_broker_client()
+
+
+@pytest.fixture
+def twin(broker, monkeypatch):
+    # the overpass template is read from the working directory
+    monkeypatch.chdir(Path(__file__).resolve().parent.parent)
+    handlers = {s: signal.getsignal(s) for s in [signal.SIGINT, signal.SIGTERM]}
+    port = get_free_port()
+    twin = GreenTransportTwin(
+        broker_url="http://127.0.0.1:%s" % broker.server_port,
+        poll_intervall=600,
+        simulate_mode=False,
+        logger=LOGGER,
+        seed=61,
+        notification_port=port,
+        notification_url="http://127.0.0.1:%s/notify" % port,
+        retry_delay=0.1,
+    )
+    # no Overpass queries for the tile of the vehicle
+    key = twin.road_network.get_tile(8.0, 49.0, 500)[0]
+    twin.road_network.put(key, {"primary": [[[8.0, 49.0], [8.001, 49.0]]]})
+    yield twin
+    twin.running = False
+    for s, handler in handlers.items():
+        signal.signal(s, handler)
+
+
+def test_listen(broker, twin):
+    subscriptions = "/ngsi-ld/v1/subscriptions/"
+    upsert = "/ngsi-ld/v1/entityOperations/upsert"
+    broker.failures = {subscriptions: 2, upsert: 1}
+    twin.running = True
+    thread = threading.Thread(target=twin.listen, daemon=True)
+    thread.start()
+
+    # the rejected subscriptions are retried
+    wait_for(
+        lambda: [ok for path, _, ok in broker.requests if path == subscriptions]
+        == [False, False, True, True]
+    )
+    r = requests.post(
+        twin.notification_url, data=json.dumps({"id": "n1", "data": [VEHICLE]})
+    )
+    assert r.status_code == 204
+
+    # the batch that could not be pushed is retried
+    wait_for(lambda: any(ok for path, _, ok in broker.requests if path == upsert))
+    upserts = [(body, ok) for path, body, ok in broker.requests if path == upsert]
+    assert [ok for _, ok in upserts] == [False, True]
+    assert [e["id"] for e in upserts[1][0]] == ["EmissionObserved:1"]
+    assert twin.state.watermarks["Vehicle"] == "2026-10-18T12:00:00Z"
+
+    # a notified observation that was already emitted is not pushed again
+    r = requests.post(
+        twin.notification_url, data=json.dumps({"id": "n2", "data": [VEHICLE]})
+    )
+    assert r.status_code == 204
+    time.sleep(1.5)
+    assert len([path for path, _, _ in broker.requests if path == upsert]) == 2
+
+    twin.running = False
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_refresh_sections_failed(broker, twin):
+    temporal = "/ngsi-ld/v1/temporal/entities/"
+    broker.failures = {temporal: 1}
+    twin.refresh_sections(days=7)
+    assert twin.sections_refreshed_ts is None
+    t0 = time.time()
+    twin.refresh_sections(days=7)
+    assert twin.sections_refreshed_ts >= t0
+    # the refresh after the failed one still queries the full 7 days
+    times = [
+        parse_observed_at(params["time"][0]).timestamp()
+        for path, params, _ in broker.requests
+        if path == temporal
+    ]
+    assert len(times) == 2
+    assert times[1] < t0 - 7 * 24 * 3600 + 5
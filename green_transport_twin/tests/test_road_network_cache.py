@@ -0,0 +1,24 @@
+import logging
+import time
+
+from road_network_cache import RoadNetworkCache
+
+LOGGER = logging.getLogger("test_road_network_cache")
+
+
+def test_memory_hits_are_used(tmp_path):
+    path = str(tmp_path / "road_network_cache.sqlite")
+    cache = RoadNetworkCache(path, LOGGER, max_entries=2, touch_interval=0)
+    cache.put("a", {"primary": [[[8.0, 49.0]]]})
+    time.sleep(0.01)
+    cache.put("b", {"primary": [[[8.1, 49.0]]]})
+    time.sleep(0.01)
+    # a memory hit, which also counts as a use in SQLite
+    assert cache.get("a") == {"primary": [[[8.0, 49.0]]]}
+    time.sleep(0.01)
+    cache.put("c", {"primary": [[[8.2, 49.0]]]})
+
+    cache = RoadNetworkCache(path, LOGGER, max_entries=2)
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
@@ -19,16 +19,12 @@ from requests_pkcs12 import get, post
 from mtk_common.model import (ngsi_template_emissionobserved,
                    ngsi_template_trafficflow_observed, ngsi_template_vehicle,
                    traffic_sensor_locations, transport_modes_model)
-from mtk_common.utils import compute_carbon_footprint, translate_transport_mode, post_payloads
+from mtk_common.utils import translate_transport_mode, post_payloads
 
 ENTITY_TYPE = "TrafficFlowObserved"
 # ENTITY_TYPE = "Vehicle"
 
 
-def pandas_compute_carbon_footprint(x):
-    return compute_carbon_footprint(x.sensed_mode, x.distance)
-
-
 def create_payloads(parsed, logger):
     payloads = []
     for v in parsed:
@@ -1,10 +1,22 @@
 import datetime
 import enum
+import gzip
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone
+from urllib.parse import urlparse
 
+import numpy as np
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from transport_co2 import estimate_co2
+from urllib3.util.retry import Retry
+
+from mtk_common.model import transport_modes_model
 
 
 class PredictedModeTypes(enum.IntEnum):
@@ -20,6 +32,83 @@ class PredictedModeTypes(enum.IntEnum):
     LIGHT_RAIL = 9
 
 
+TRANSPORT_MODE_TRANSLATIONS = {
+    "bicycle": "bicycle",
+    "bike": "bicycle",
+    "bicycling": "bicycle",
+    PredictedModeTypes.BICYCLING: "bicycle",
+    "bus": "bus",
+    "minibus": "bus",
+    PredictedModeTypes.BUS: "bus",
+    "qbus": "bus",
+    "car": "car",
+    "auto": "car",
+    "qkfz": "car",
+    "qpkw": "car",
+    PredictedModeTypes.CAR: "car",
+    "large_car": "large_car",
+    "caravan": "large_car",
+    "van": "large_car",
+    "qlfw": "large_car",
+    "motorcycle": "motorcycle",
+    "motorbike": "motorcycle",
+    "qkrad": "motorcycle",
+    "moped": "motorcycle",
+    "motorcycleWithSideCar": "motorcycle",
+    "motorscooter": "motorcycle",
+    "tram": "tram",
+    PredictedModeTypes.TRAM: "tram",
+    "carwithcaravan": "large_car",
+    "carwithtrailer": "large_car",
+    "qpkwa": "large_car",
+    "truck": "truck",
+    "lorry": "truck",
+    "trailer": "truck",
+    "qlkw": "truck",
+    "qlkwa": "truck",
+    "qsattel-kfz": "truck",
+    "walk": "walk",
+    "walking": "walk",
+    PredictedModeTypes.WALKING: "walk",
+    "subway": "subway",
+    PredictedModeTypes.SUBWAY: "subway",
+    "train": "train",
+    PredictedModeTypes.TRAIN: "train",
+    "light rail": "light_rail",
+    "light_rail": "light_rail",
+    PredictedModeTypes.LIGHT_RAIL: "light_rail",
+    "unknown": "unknown",
+    PredictedModeTypes.UNKNOWN: "unknown",
+    "airplane": "airplane",
+    "air": "airplane",
+    PredictedModeTypes.AIR_OR_HSR: "airplane",
+    "air_or_hsr": "airplane",
+}
+
+# mapping of canonical transport modes to transport_co2 modes
+CO2_MODE_MAPPING = {
+    "unknown": "walk",
+    "walk": "walk",
+    "bicycle": "bicycle",
+    "bus": "bus",
+    "car": "car",
+    "large_car": "large_car",
+    "airplane": "airplane",
+    "light_rail": "light_rail",
+    "train": "rail",
+    "subway": "subway",
+    "truck": "large_car",
+    "tram": "tram",
+    "motorcycle": "scooter",
+}
+
+# gCO2 per km for every canonical transport mode
+CO2_FACTORS = {
+    mode: estimate_co2(mode=mode_co2, distance_in_km=1)
+    for mode, mode_co2 in CO2_MODE_MAPPING.items()
+}
+
+
 def get_transport_mode(e: dict, logger: logging.Logger) -> str:
     """
     Get transport mode aka vehicleType from NGSI-LD object (either Vehicle or
@@ -55,98 +144,198 @@ def translate_transport_mode(value: str) -> str:
     Translate transport modes to cononical form.
     """
 
-    translation_dic = {
-        "bicycle": "bicycle",
-        "bike": "bicycle",
-        "bicycling": "bicycle",
-        PredictedModeTypes.BICYCLING: "bicycle",
-        "bus": "bus",
-        "minibus": "bus",
-        PredictedModeTypes.BUS: "bus",
-        "qbus": "bus",
-        "car": "car",
-        "auto": "car",
-        "qkfz": "car",
-        "qpkw": "car",
-        PredictedModeTypes.CAR: "car",
-        "large_car": "large_car",
-        "caravan": "large_car",
-        "van": "large_car",
-        "qlfw": "large_car",
-        "motorcycle": "motorcycle",
-        "motorbike": "motorcycle",
-        "qkrad": "motorcycle",
-        "moped": "motorcycle",
-        "motorcycleWithSideCar": "motorcycle",
-        "motorscooter": "motorcycle",
-        "tram": "tram",
-        PredictedModeTypes.TRAM: "tram",
-        "carwithcaravan": "large_car",
-        "carwithtrailer": "large_car",
-        "qpkwa": "large_car",
-        "truck": "truck",
-        "lorry": "truck",
-        "trailer": "truck",
-        "qlkw": "truck",
-        "qlkwa": "truck",
-        "qsattel-kfz": "truck",
-        "walk": "walk",
-        "walking": "walk",
-        PredictedModeTypes.WALKING: "walk",
-        "subway": "subway",
-        PredictedModeTypes.SUBWAY: "subway",
-        "train": "train",
-        PredictedModeTypes.TRAIN: "train",
-        "light rail": "light_rail",
-        "light_rail": "light_rail",
-        PredictedModeTypes.LIGHT_RAIL: "light_rail",
-        "unknown": "unknown",
-        PredictedModeTypes.UNKNOWN: "unknown",
-        "airplane": "airplane",
-        "air": "airplane",
-        PredictedModeTypes.AIR_OR_HSR: "airplane",
-        "air_or_hsr": "airplane",
-    }
 
     if hasattr(value, "lower"):
         value = value.lower()
-    if value in translation_dic:
-        return translation_dic[value]
+    if value in TRANSPORT_MODE_TRANSLATIONS:
+        return TRANSPORT_MODE_TRANSLATIONS[value]
     else:
         return "unknown"
 
 
 def compute_carbon_footprint(mode: str, distance: float) -> float:
-    from transport_co2 import estimate_co2
-
-    co2_mode_mapping = {
-        "unknown": "walk",
-        "walk": "walk",
-        "bicycle": "bicycle",
-        "bus": "bus",
-        "car": "car",
-        "large_car": "large_car",
-        "airplane": "airplane",
-        "light_rail": "light_rail",
-        "train": "rail",
-        "subway": "subway",
-        "truck": "large_car",
-        "tram": "tram",
-        "motorcycle": "scooter",
-    }
+    """
+    Compute the CO2 footprint in kg for a distance in m travelled with mode.
+    """
 
     mode = translate_transport_mode(mode)
-    mode_co2 = co2_mode_mapping[mode]
-    co2 = estimate_co2(mode=mode_co2, distance_in_km=distance / 1000)
+    return CO2_FACTORS[mode] * distance / 1000000
+
+
+def compute_carbon_footprint_batch(modes, distances):
+    """
+    Compute the CO2 footprint in kg for arrays of transport modes and
+    distances in m. Accepts NumPy arrays, lists or pandas Series; if distances
+    is a Series, a Series with the same index is returned, and a modes Series
+    is aligned to it. Missing or unknown modes count as "unknown", like in
+    compute_carbon_footprint.
+    """
+
+    if isinstance(modes, pd.Series) and isinstance(distances, pd.Series):
+        if not modes.index.equals(distances.index):
+            modes = modes.reindex(distances.index)
+    # factorize does not sort, so modes of different types can be mixed
+    codes, unique_modes = pd.factorize(np.asarray(modes, dtype=object), sort=False)
+    # missing modes get the code -1, i.e. the last factor
+    unique_factors = np.array(
+        [CO2_FACTORS[translate_transport_mode(mode)] for mode in unique_modes]
+        + [CO2_FACTORS["unknown"]]
+    )
+    factors = unique_factors[codes]
+    if not isinstance(distances, pd.Series):
+        distances = np.asarray(distances, dtype=float)
+    return distances * factors / 1000000
+
+
+def sample_transport_modes(modes, rng: np.random.Generator = None) -> tuple:
+    """
+    Sample a distance (m), speed (km/h) and CO2 footprint (kg) for every
+    transport mode in modes from the distributions in transport_modes_model.
+    Returns three arrays aligned with modes; modes that are not part of the
+    model get NaN values. Pass a seeded rng for reproducible samples.
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+    modes = np.asarray(modes, dtype=str)
+    distances = np.full(len(modes), np.nan)
+    speeds = np.full(len(modes), np.nan)
+    unique_modes, inverse = np.unique(modes, return_inverse=True)
+    for i, mode in enumerate(unique_modes):
+        if mode not in transport_modes_model:
+            continue
+        mask = inverse == i
+        n = np.count_nonzero(mask)
+        distance_dist = transport_modes_model[mode]["distance"]
+        distances[mask] = distance_dist[rng.integers(len(distance_dist), size=n)]
+        speed_dist = transport_modes_model[mode]["speed"]
+        speeds[mask] = speed_dist[rng.integers(len(speed_dist), size=n)]
+    co2 = compute_carbon_footprint_batch(modes, distances)
+    return distances, speeds, co2
+
+
+class RateLimiter(object):
+    """
+    Per-host rate limiter. Requests to the same host are spaced out so that at
+    most max_per_second requests are sent to it; requests to different hosts
+    do not wait for each other. A max_per_second of 0 disables rate limiting.
+    """
+
+    def __init__(self, max_per_second: float = 0):
+        self.min_intervall = 1.0 / max_per_second if max_per_second > 0 else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url: str) -> None:
+        if not self.min_intervall:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_intervall
+        if slot > now:
+            time.sleep(slot - now)
+
 
-    return co2 / 1000
+class BrokerClient(object):
+    """
+    HTTP client for NGSI-LD broker calls. All requests share one
+    requests.Session with a pool of keep-alive connections, a default timeout
+    and retries with exponential backoff on connection errors and 429/5xx
+    responses. Responses are accepted gzip-compressed; with compress=True,
+    request bodies are sent gzip-compressed as well.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeout: float = 60,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        compress: bool = False,
+    ):
+        self.timeout = timeout
+        self.compress = compress
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        data = kwargs.get("data")
+        if self.compress and data:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            kwargs["data"] = gzip.compress(data)
+            kwargs["headers"] = dict(kwargs.get("headers") or {})
+            kwargs["headers"]["Content-Encoding"] = "gzip"
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+
+broker_client = BrokerClient()
+
+
+def configure_broker_client(**kwargs) -> BrokerClient:
+    """
+    replace the shared broker client, e.g., with a larger pool for
+    concurrent requests. Takes the arguments of BrokerClient.
+    """
+
+    global broker_client
+    broker_client = BrokerClient(**kwargs)
+    return broker_client
+
+
+def get_broker_client() -> BrokerClient:
+    return broker_client
+
+
+class BrokerRequestError(Exception):
+    """
+    raised if a query to the NGSI-LD broker failed, so that callers can tell a
+    failed query from one without results
+    """
 
 
 def get_request(
-    url: str, params: dict, headers: dict, logger: logging.Logger, timeout=60
+    url: str,
+    params: dict,
+    headers: dict,
+    logger: logging.Logger,
+    timeout=60,
+    raise_errors: bool = False,
 ) -> list:
+    """
+    get the entities of a query, [] if the request failed or, with
+    raise_errors, BrokerRequestError
+    """
+
     try:
-        r = requests.get(
+        r = get_broker_client().get(
             url,
             params=params,
             headers=headers,
@@ -157,48 +346,204 @@ def get_request(
             logger.warning(
                 "Request to NGSI-LD Broker failed, status code: %s", r.status_code
             )
+            if raise_errors:
+                raise BrokerRequestError("status code %s" % r.status_code)
             return []
         entities = r.json()
         logger.debug("Received entities%s", len(entities))
         return entities
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, ValueError) as e:
         logger.error(
             "Something went wrong connecting to the NGSI-LD broker. Maybe server is down."
         )
+        if raise_errors:
+            raise BrokerRequestError(str(e)) from e
         return []
 
+
+def get_paginated_request(
+    url: str,
+    params: dict,
+    headers: dict,
+    logger: logging.Logger,
+    page_size: int = 1000,
+    timeout=60,
+) -> list:
+    """
+    get all entities of a query page by page using limit and offset. Raises
+    BrokerRequestError if any page fails, instead of returning partial results.
+    """
+
+    entities = []
+    offset = 0
+    while True:
+        page_params = dict(params, limit=page_size, offset=offset)
+        page = get_request(
+            url=url,
+            params=page_params,
+            headers=headers,
+            logger=logger,
+            timeout=timeout,
+            raise_errors=True,
+        )
+        entities.extend(page)
+        if len(page) < page_size:
+            return entities
+        offset = offset + page_size
+
+
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
+
+def chunks_by_size(serialized: list, max_bytes: int, max_entities: int):
+    """
+    Yield successive chunks of (index, serialized entity) tuples with at most
+    max_entities entities and, unless a single entity is larger, at most
+    max_bytes bytes.
+    """
+
+    chunk = []
+    chunk_bytes = 0
+    for i, entity in enumerate(serialized):
+        size = len(entity) + 1
+        if chunk and (chunk_bytes + size > max_bytes or len(chunk) >= max_entities):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append((i, entity))
+        chunk_bytes = chunk_bytes + size
+    if chunk:
+        yield chunk
+
+
+def post_chunk(chunk: list, payloads: list, url: str, logger: logging.Logger) -> dict:
+    """
+    upsert one chunk and return {payload index: error or None}. A 207
+    multi-status body is parsed so that only the failed entities are marked
+    as failed.
+    """
+
+    headers = {"Content-Type": "application/ld+json"}
+    data = "[" + ",".join(entity for _, entity in chunk) + "]"
+    try:
+        r = get_broker_client().post(url, data=data, headers=headers)
+    except requests.exceptions.RequestException as e:
+        logger.error(
+            "Something went wrong connecting to the NGSI-LD broker. Maybe server is down."
+        )
+        return {i: str(e) for i, _ in chunk}
+    if r.status_code in [201, 204]:
+        return {i: None for i, _ in chunk}
+    if r.status_code != 207:
+        logger.warning("request failed: %s", r.status_code)
+        logger.warning(r.text)
+        return {i: "status code %s" % r.status_code for i, _ in chunk}
+    try:
+        errors = {
+            error["entityId"]: error.get("error", "failed")
+            for error in r.json().get("errors", [])
+        }
+    except (ValueError, AttributeError, KeyError, TypeError):
+        return {i: "invalid multi-status response" for i, _ in chunk}
+    return {i: errors.get(payloads[i].get("id")) for i, _ in chunk}
+
+
+def version_rounds(payloads: list) -> list:
+    """
+    Split the payload indices into rounds with at most one payload per entity
+    id each: the k-th round holds the k-th version of every entity, in the
+    order of payloads.
+    """
+
+    rounds = []
+    versions = {}
+    for i, payload in enumerate(payloads):
+        entity_id = payload.get("id")
+        k = versions.get(entity_id, 0)
+        if entity_id is not None:
+            versions[entity_id] = k + 1
+        if k == len(rounds):
+            rounds.append([])
+        rounds[k].append(i)
+    return rounds
+
+
+def upsert_entities(
+    payloads: list,
+    broker_url: str,
+    logger: logging.Logger,
+    max_bytes: int = 1000000,
+    max_entities: int = 1000,
+    max_in_flight: int = 4,
+    retries: int = 1,
+) -> list:
+    """
+    Upsert payloads in chunks bounded by serialized size and entity count,
+    with up to max_in_flight chunks posted concurrently. Entities that fail
+    are retried individually (in new chunks) up to retries times. Several
+    versions of an entity (e.g., of a TrafficFlowObserved) are upserted one
+    after the other by version_rounds, so that the last one ends up as the
+    current value. Returns a list aligned with payloads holding None for
+    every upserted entity and the error otherwise.
+    """
+
+    url = broker_url + "/ngsi-ld/v1/entityOperations/upsert"
+    serialized = [json.dumps(payload) for payload in payloads]
+    results = [None] * len(payloads)
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        for pending in version_rounds(payloads):
+            for attempt in range(retries + 1):
+                if not pending:
+                    break
+                if attempt > 0:
+                    logger.info("Retrying %s failed payloads", len(pending))
+                pending_chunks = [
+                    [(pending[j], entity) for j, entity in chunk]
+                    for chunk in chunks_by_size(
+                        [serialized[i] for i in pending], max_bytes, max_entities
+                    )
+                ]
+                chunk_results = list(
+                    executor.map(
+                        lambda chunk: post_chunk(chunk, payloads, url, logger),
+                        pending_chunks,
+                    )
+                )
+                pending = []
+                for chunk_result in chunk_results:
+                    for i, error in chunk_result.items():
+                        results[i] = error
+                        if error is not None:
+                            pending.append(i)
+    failed = sum(1 for error in results if error is not None)
+    logger.info("Pushed %s payloads", len(payloads) - failed)
+    if failed:
+        logger.warning("Failed to push %s payloads", failed)
+    return results
+
+
 def post_payloads(payloads: list, broker_url: str, logger: logging.Logger) -> bool:
-    success = True
-    for chunk in chunks(payloads, 100):
-        try:
-            url = broker_url + "/ngsi-ld/v1/entityOperations/upsert"
-            print(url)
-            headers = {"Content-Type": "application/ld+json"}
-            r = requests.post(url, data=json.dumps(chunk), headers=headers)
-            if r.status_code not in [201, 204, 207]:
-                logger.warning("request failed: %s", r.status_code)
-                logger.warning(r.text)
-                success = False
-            else:
-                logger.info("Pushed %s payloads", len(chunk))
-        except requests.exceptions.RequestException as e:
-            logger.error(
-                "Something went wrong connecting to the NGSI-LD broker. Maybe server is down."
-            )
-            success = False
-    return success
+    """
+    upsert payloads, returns whether all of them were upserted successfully
+    """
+
+    results = upsert_entities(payloads=payloads, broker_url=broker_url, logger=logger)
+    return all(error is None for error in results)
 
 
 def get_temporal_entities(
-    entity_type: str, intervall: int, url: str, logger: logging.Logger
+    entity_type: str,
+    intervall: int,
+    url: str,
+    logger: logging.Logger,
+    since: str = None,
 ) -> list:
     """
-    get temporal entities during poll intervall
+    get temporal entities during poll intervall, or observed after since if
+    given. Raises BrokerRequestError if the query failed.
     """
 
     headers = {
@@ -207,11 +552,12 @@ def get_temporal_entities(
     params = {
         "type": entity_type,
         "timerel": "after",
-        "timeAt": (
+        "timeAt": since
+        or (
             datetime.datetime.now(timezone.utc) - datetime.timedelta(seconds=intervall)
         ).strftime("%Y-%m-%dT%H:%M:%SZ"),
     }
-    entities_temporal = get_request(
+    entities_temporal = get_paginated_request(
         url=url + "/ngsi-ld/v1/temporal/entities/",
         params=params,
         headers=headers,
@@ -226,9 +572,11 @@ def get_entities(
     intervall: int,
     url: str,
     logger: logging.Logger,
+    since: str = None,
 ) -> list:
     """
-    get entities during poll intervall
+    get entities during poll intervall, or observed at or after since if given.
+    Raises BrokerRequestError if the query failed.
     """
     headers = {
         "Link": '<https://raw.githubusercontent.com/smart-data-models/data-models/master/context.jsonld>; rel="http://www.w3.org/ns/json-ld#context"; type="application/ld+json"'
@@ -239,12 +587,15 @@ def get_entities(
             observedAt_property
             + ".observedAt>="
             + (
-                datetime.datetime.now(timezone.utc)
-                - datetime.timedelta(seconds=intervall)
-            ).strftime("%Y-%m-%dT%H:%M:%SZ")
+                since
+                or (
+                    datetime.datetime.now(timezone.utc)
+                    - datetime.timedelta(seconds=intervall)
+                ).strftime("%Y-%m-%dT%H:%M:%SZ")
+            )
         ),
     }
-    entities = get_request(
+    entities = get_paginated_request(
         url=url + "/ngsi-ld/v1/entities/",
         params=params,
         headers=headers,
@@ -0,0 +1,236 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pytest
+from mtk_common import utils
+
+LOGGER = logging.getLogger("test_utils")
+
+
+class StubBrokerHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.entities page by page and fails the requests for the
+    offsets in server.failing_offsets. Upserts are recorded in server.upserts,
+    the entities in server.failing_ids fail once with a 207 multi-status
+    response, and an entity that is upserted while another request for it is
+    still in flight is recorded in server.overlapping.
+    """
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        limit = int(params["limit"][0])
+        offset = int(params["offset"][0])
+        self.server.offsets.append(offset)
+        if offset in self.server.failing_offsets:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.entities[offset : offset + limit]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        entities = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        ids = [e["id"] for e in entities]
+        with self.server.lock:
+            self.server.overlapping.extend(set(ids) & self.server.in_flight)
+            self.server.in_flight.update(ids)
+            self.server.upserts.append(entities)
+            failed = [i for i in ids if i in self.server.failing_ids]
+            self.server.failing_ids.difference_update(failed)
+        time.sleep(0.01)
+        with self.server.lock:
+            self.server.in_flight.difference_update(ids)
+        if not failed:
+            self.send_response(204)
+            self.end_headers()
+            return
+        body = json.dumps(
+            {
+                "success": [i for i in ids if i not in failed],
+                "errors": [
+                    {"entityId": i, "error": {"title": "failed"}} for i in failed
+                ],
+            }
+        ).encode()
+        self.send_response(207)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def broker():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBrokerHandler)
+    server.entities = [{"id": "urn:ngsi-ld:Vehicle:%s" % i} for i in range(25)]
+    server.failing_offsets = set()
+    server.offsets = []
+    server.lock = threading.Lock()
+    server.upserts = []
+    server.failing_ids = set()
+    server.in_flight = set()
+    server.overlapping = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # no retries, the stub fails for good
+    utils.configure_broker_client(retries=0)
+    yield server
+    server.shutdown()
+    server.server_close()
+    utils.configure_broker_client()
+
+
+def get_paginated(server):
+    return utils.get_paginated_request(
+        url="http://127.0.0.1:%s/ngsi-ld/v1/entities/" % server.server_port,
+        params={"type": "Vehicle"},
+        headers={},
+        logger=LOGGER,
+        page_size=10,
+    )
+
+
+def test_get_paginated_request(broker):
+    assert get_paginated(broker) == broker.entities
+    assert broker.offsets == [0, 10, 20]
+
+
+def test_get_paginated_request_failed_page(broker):
+    broker.failing_offsets = {10}
+    with pytest.raises(utils.BrokerRequestError):
+        get_paginated(broker)
+    assert broker.offsets == [0, 10]
+
+
+def test_get_request_failed(broker):
+    broker.failing_offsets = {0}
+    url = "http://127.0.0.1:%s/ngsi-ld/v1/entities/" % broker.server_port
+    params = {"type": "Vehicle", "limit": 10, "offset": 0}
+    assert utils.get_request(url, params, {}, LOGGER) == []
+    with pytest.raises(utils.BrokerRequestError):
+        utils.get_request(url, params, {}, LOGGER, raise_errors=True)
+
+
+def test_compute_carbon_footprint_batch():
+    modes = list(utils.CO2_FACTORS) + list(utils.TRANSPORT_MODE_TRANSLATIONS)
+    distances = np.arange(len(modes)) * 1000.0
+    expected = [utils.compute_carbon_footprint(m, d) for m, d in zip(modes, distances)]
+    assert np.allclose(utils.compute_carbon_footprint_batch(modes, distances), expected)
+
+
+def test_compute_carbon_footprint_batch_missing_modes():
+    modes = ["car", None, np.nan, 5, "Bus", "spaceship", 5.0]
+    distances = [1000] * len(modes)
+    expected = [utils.compute_carbon_footprint(m, d) for m, d in zip(modes, distances)]
+    result = utils.compute_carbon_footprint_batch(pd.Series(modes), distances)
+    assert np.allclose(result, expected)
+    assert result[1] == result[2] == 0
+
+
+def test_compute_carbon_footprint_batch_series():
+    df = pd.DataFrame(
+        {"sensed_mode": [5, 3, None], "distance": [1000.0, 2000.0, 3000.0]},
+        index=[10, 3, 7],
+    )
+    result = utils.compute_carbon_footprint_batch(df.sensed_mode, df.distance)
+    assert list(result.index) == [10, 3, 7]
+    expected = [
+        utils.compute_carbon_footprint(m, d) for m, d in zip([5, 3, None], df.distance)
+    ]
+    assert np.allclose(result, expected)
+    # a modes Series is aligned to the index of the distances
+    result = utils.compute_carbon_footprint_batch(
+        df.sensed_mode.iloc[::-1], df.distance
+    )
+    assert list(result.index) == [10, 3, 7]
+    assert result[10] == utils.compute_carbon_footprint(5, 1000.0)
+    assert len(utils.compute_carbon_footprint_batch(pd.Series([], dtype=object), [])) == 0
+
+
+def test_chunks_by_size():
+    serialized = ["a" * 9, "b" * 9, "c" * 30, "d" * 4, "e" * 4, "f" * 4]
+    chunks = list(utils.chunks_by_size(serialized, max_bytes=20, max_entities=2))
+    # one byte per entity for the separator, an oversized entity gets its own chunk
+    assert [[i for i, _ in chunk] for chunk in chunks] == [[0, 1], [2], [3, 4], [5]]
+    assert [entity for chunk in chunks for _, entity in chunk] == serialized
+    assert list(utils.chunks_by_size([], max_bytes=20, max_entities=2)) == []
+
+
+def test_post_chunk_multi_status(broker):
+    url = "http://127.0.0.1:%s/ngsi-ld/v1/entityOperations/upsert" % (
+        broker.server_port
+    )
+    payloads = [{"id": "urn:ngsi-ld:EmissionObserved:%s" % i} for i in range(3)]
+    chunk = [(i, json.dumps(p)) for i, p in enumerate(payloads)]
+    broker.failing_ids = {payloads[1]["id"]}
+    result = utils.post_chunk(chunk, payloads, url, LOGGER)
+    assert result[0] is None and result[2] is None
+    assert result[1] == {"title": "failed"}
+    assert utils.post_chunk(chunk, payloads, url, LOGGER) == {0: None, 1: None, 2: None}
+
+
+def test_upsert_entities_retries_failed(broker):
+    payloads = [{"id": "urn:ngsi-ld:EmissionObserved:%s" % i} for i in range(10)]
+    broker.failing_ids = {payloads[3]["id"], payloads[7]["id"]}
+    results = utils.upsert_entities(
+        payloads,
+        "http://127.0.0.1:%s" % broker.server_port,
+        LOGGER,
+        max_entities=4,
+    )
+    assert results == [None] * 10
+    # three chunks and one retry with only the failed entities
+    assert [[e["id"] for e in upsert] for upsert in broker.upserts[3:]] == [
+        [payloads[3]["id"], payloads[7]["id"]]
+    ]
+    assert len(broker.upserts) == 4
+
+    broker.upserts = []
+    broker.failing_ids = {payloads[0]["id"]}
+    results = utils.upsert_entities(
+        payloads, "http://127.0.0.1:%s" % broker.server_port, LOGGER, retries=0
+    )
+    assert results[0] == {"title": "failed"}
+    assert results[1:] == [None] * 9
+    assert len(broker.upserts) == 1
+
+
+def test_upsert_entities_versions_in_order(broker):
+    # several versions of each entity, as for TrafficFlowObserved
+    payloads = [
+        {"id": "urn:ngsi-ld:EmissionObserved:%s-0" % (i % 5), "version": i // 5}
+        for i in range(40)
+    ]
+    broker.failing_ids = {payloads[12]["id"]}
+    results = utils.upsert_entities(
+        payloads,
+        "http://127.0.0.1:%s" % broker.server_port,
+        LOGGER,
+        max_entities=2,
+        max_in_flight=4,
+    )
+    assert results == [None] * 40
+    assert broker.overlapping == []
+    for upsert in broker.upserts:
+        assert len(set(e["id"] for e in upsert)) == len(upsert)
+    versions = {}
+    for upsert in broker.upserts:
+        for e in upsert:
+            versions.setdefault(e["id"], []).append(e["version"])
+    # the failed first version is retried before the next version is upserted
+    assert versions[payloads[12]["id"]] == [0, 0, 1, 2, 3, 4, 5, 6, 7]
+    for entity_id, entity_versions in versions.items():
+        assert entity_versions == sorted(entity_versions)
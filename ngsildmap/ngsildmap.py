@@ -10,7 +10,6 @@ from threading import Thread
 
 import dash_leaflet as dl
 import dash_leaflet.express as dlx
-import requests
 import schedule
 from dash import Dash, dcc, html
 from dash.dependencies import Input, Output
@@ -179,7 +178,7 @@ def leafCallback(n, entityTypeAttrib):
     if observedAt:
       #print("observedAt callback")
       url = url + "&q=" + splitted[1] + ".observedAt>=" + date
-    entities = requests.get(url
+    entities = utils.get_broker_client().get(url
         ,headers={
             "Link": "<"
             + defaultAtContext
@@ -199,9 +198,15 @@ def leafCallback_temporal(n, entityTypeAttrib):
     splitted = entityTypeAttrib.split(";")
     global defaultRange
     # print(defaultHost + '/ngsi-ld/v1/entities?type='+splitted[0]+'&limit=' + str(defaultLimit) + '&q=' + splitted[1] + '.observedAt>=' + date)
-    entities = utils.get_temporal_entities(
-        entity_type=splitted[0], intervall=defaultRange, url=defaultHost, logger=LOGGER
-    )
+    try:
+        entities = utils.get_temporal_entities(
+            entity_type=splitted[0],
+            intervall=defaultRange,
+            url=defaultHost,
+            logger=LOGGER,
+        )
+    except utils.BrokerRequestError:
+        return None
     clearedGeoJson = clearGeoJson_temporal(entities, splitted[1])
     if clearedGeoJson == None:
         return None
@@ -347,7 +352,7 @@ def initialSetup(app):
               url = url + "&q=" + attrib + ".observedAt>=" + date
             mapSet = initialMapSetup(
                 app,
-                requests.get(
+                utils.get_broker_client().get(
                     url,
                     headers={
                         "Link": "<"